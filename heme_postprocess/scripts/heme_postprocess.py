@@ -8,14 +8,16 @@ snippet
 
 Variant report and VCF file:
 Create accepted and rejected VCFs where NOT_REPORTED variants
-are in the rejected VCF and all others in the accepted VCF
+are in the rejected VCF and all others in the accepted VCF, optionally
+bgzip compressed with tabix index
 
 Depth report: 
 Sort depth files by min depth, highlight rows < 200 and
 save as Excel file.
 
 SNV and indel depth reports:
-Create text file with low coverage comment.
+Create text file with low coverage comment and table of per-gene
+coverage.
 
 Fusion reports with transcripts:
 Add transcripts to fusions.filtered.txt files
@@ -26,8 +28,30 @@ import os
 import sys
 import re
 import datetime
+import fnmatch
+import gzip
+import heapq
+import json
+import multiprocessing
+import struct
+import tempfile
+import time
+import zlib
 from collections import defaultdict
 from argparse import ArgumentParser
+from StringIO import StringIO
+from multiprocessing.pool import ThreadPool
+try: # os.scandir is python 3.5+; scandir backport for python 2
+    from os import scandir
+except ImportError:
+    try:
+        from scandir import scandir
+    except ImportError:
+        scandir = None
+try: # htslib; otherwise bgzip and tabix index are written in python
+    import pysam
+except ImportError:
+    pysam = None
 
 import openpyxl
 import xlsxwriter
@@ -58,9 +82,17 @@ def datetime_string():
     dt = datetime.datetime.now().strftime("%Y%m%d-%H%M%S")
     return dt
 
+def replace_file(src, dst):
+    """Rename src to dst, replacing dst.  os.rename does not replace an
+    existing file on Windows."""
+    if os.name=='nt' and os.path.exists(dst):
+        os.remove(dst)
+    os.rename(src, dst)
+
 
 MINCOVERAGE = 200 # min depth coverage for Heme-STAMP
 MALE_MINCOV = 60 # chrY min coverage to determine if sample likely male
+COVERAGE_THRESHOLDS = (100, MINCOVERAGE, 500) # for gene coverage table
 LOWCOV_TEXT = "Portions of the following gene(s) failed to meet the"+\
     " minimum coverage of {}x: GENELIST.".format(MINCOVERAGE) +\
     " Low coverage may adversely affect the sensitivity of the assay."+\
@@ -115,6 +147,87 @@ def is_float(v):
         return False
     return True
 
+# Types of known STAMP report columns.  Types of other columns are 
+# inferred from their first COLUMN_TYPE_ROWS values; 'str' (values never
+# converted) is only used for columns declared here.
+COLUMN_TYPES = {
+    'Position': 'int',
+    'Start': 'int',
+    'End': 'int',
+    'Min Depth': 'int',
+    'Min_Depth': 'int',
+    'Max Depth': 'int',
+    'Max_Depth': 'int',
+    'Mean Depth': 'float',
+    'Mean_Depth': 'float',
+}
+COLUMN_TYPE_ROWS = 100
+MISSING_VALUES = set(['', '.', 'NA', 'N/A', '-'])
+
+def to_number(v):
+    """int if all digits, float if a number, else unchanged"""
+    if v.isdigit():
+        return int(v)
+    elif is_float(v):
+        return float(v)
+    return v
+
+def to_int(v):
+    try:
+        return int(v)
+    except ValueError:
+        return to_number(v)
+
+def to_float(v):
+    try:
+        return float(v)
+    except ValueError:
+        return v
+
+# 'auto' columns have mixed or non-numeric values so each value is checked
+CONVERTERS = { 'int': to_int, 'float': to_float, 'str': None, 
+               'auto': to_number, }
+
+def infer_column_type(values):
+    """int or float if all values are numbers, else auto, so numbers after
+    the values checked are still converted"""
+    values = [ v for v in values if v not in MISSING_VALUES ]
+    if not values:
+        return 'auto'
+    if all([ v.isdigit() for v in values ]):
+        return 'int'
+    if all([ is_float(v) for v in values ]):
+        return 'float'
+    return 'auto'
+
+def column_schema(fields, rows, numrows=COLUMN_TYPE_ROWS):
+    """Return list of column types (int, float, str or auto) for rows of 
+    a report with given fields"""
+    firstrows = rows[:numrows]
+    schema = []
+    for j, f in enumerate(fields):
+        if f in COLUMN_TYPES:
+            schema.append(COLUMN_TYPES[f])
+        else:
+            schema.append(infer_column_type([ r[j] for r in firstrows \
+                                              if j < len(r) ]))
+    return schema
+
+def typed_rows(schema, rows):
+    """Yield copies of rows with values converted to the type of their 
+    column in schema.  Values that do not convert stay strings."""
+    converters = [ (j, CONVERTERS[t]) for j, t in enumerate(schema) \
+                   if CONVERTERS[t] ]
+    numcols = len(schema)
+    for row in rows:
+        newrow = list(row)
+        for j, convert in converters:
+            if j < len(row):
+                newrow[j] = convert(row[j])
+        for j in range(numcols, len(row)): # columns without field names
+            newrow[j] = to_number(row[j])
+        yield newrow
+
 #----spreadsheet.py-----------------------------------------------------------
 
 class ExcelRowData:
@@ -133,11 +246,19 @@ def add_formats_to_workbook(workbook):
     wbformat['green'] = workbook.add_format({'bg_color': '#92D050', })
     return wbformat
 
-def print_spreadsheet_excel(header, data, outfile, sheetname=None, hide=[]):
+def print_spreadsheet_excel(header, data, outfile, sheetname=None, hide=[],
+                            compat=False, constant_memory=False):
+    """Write rows of ExcelRowData to outfile.  Values are written as given,
+    so report data should already be converted, see typed_rows.  data can
+    be an iterator; with constant_memory set, rows are flushed to disk as
+    they are written.  If compat is set, the file
+    is also loaded and saved again with openpyxl, as older versions of this
+    script always did, for any reader that needs openpyxl-written files."""
 #    sys.stderr.write("  Writing {}\n".format(outfile))
     if sheetname and len(sheetname)>30:
         sheetname = sheetname[:30]
-    workbook = xlsxwriter.Workbook(outfile)
+    workbook = xlsxwriter.Workbook(outfile, 
+                                   {'constant_memory': constant_memory})
     sheets = [(sheetname, data)]
     if header:
         sheets.append(('info', header))
@@ -148,21 +269,20 @@ def print_spreadsheet_excel(header, data, outfile, sheetname=None, hide=[]):
         for i, rowdat in enumerate(rows):
             fmt = wbformat[rowdat.highlight] if rowdat.highlight else None
             numlines[wsname] += 1
-            for j, r in enumerate(rowdat.data):
-                if r.isdigit():
-                    r = int(r)
-                elif is_float(r):
-                    r = float(r)
-                if not rowdat.cell or j==rowdat.cell:
-                    worksheet.write(i, j, r, fmt)
-                else:
-                    worksheet.write(i, j, r)
+            if not rowdat.cell:
+                worksheet.write_row(i, 0, rowdat.data, fmt)
+            else:
+                worksheet.write_row(i, 0, rowdat.data)
+                if rowdat.cell < len(rowdat.data):
+                    worksheet.write(i, rowdat.cell, 
+                                    rowdat.data[rowdat.cell], fmt)
             if i in hide: # hide row
                 worksheet.set_row(i, None, None, {'hidden': True})
 #    worksheet.freeze_panes(len(header), 0)
     workbook.close()
-    wb = openpyxl.load_workbook(outfile)
-    wb.save(outfile)
+    if compat:
+        wb = openpyxl.load_workbook(outfile)
+        wb.save(outfile)
     return numlines[sheetname]
 
 
@@ -170,13 +290,15 @@ def print_spreadsheet_excel(header, data, outfile, sheetname=None, hide=[]):
 
 class TabData:
     def __init__(self, tabfile=None, data=None, fields=None, header=None, 
-                 numlines=None, outfile=None):
+                 numlines=None, outfile=None, schema=None, coverage=None):
         self.tabfile = tabfile
         self.data = data
         self.fields = fields
         self.header = header
         self.numlines = numlines
         self.outfile = outfile
+        self.schema = schema
+        self.coverage = coverage
 
 def parse_tab_file(tabfile, outfile=None, commentstart='#'):
     header = []
@@ -202,78 +324,385 @@ def outfile_name(report, outdir=None, outext='', inext='.txt'):
         outfile = os.path.join(outdir, os.path.basename(outfile))
     return outfile
 
+def open_text(filename):
+    """Open text file, or gzip (including bgzip) file if it ends in .gz"""
+    if filename.endswith('.gz'):
+        return gzip.open(filename, 'rb')
+    return open(filename, 'r')
+
+#----bgzf.py------------------------------------------------------------------
+
+BGZF_BLOCK_SIZE = 0xff00 # max uncompressed bytes per block, as htslib
+BGZF_EOF = '\x1f\x8b\x08\x04\x00\x00\x00\x00\x00\xff\x06\x00BC\x02\x00' +\
+           '\x1b\x00\x03\x00\x00\x00\x00\x00\x00\x00\x00\x00'
+TABIX_WINDOW_SHIFT = 14 # 16kb linear index windows
+
+class BgzfWriter:
+    """Writes BGZF (blocked gzip) file, readable by gzip and indexable by
+    tabix.  tell() returns the virtual offset of the next byte written:
+    file offset of its block << 16 | offset within the block."""
+    def __init__(self, filename, level=6):
+        self.fh = open(filename, 'wb')
+        self.level = level
+        self.buffer = []
+        self.buflen = 0
+        self.blockstart = 0
+
+    def tell(self):
+        return (self.blockstart << 16) | self.buflen
+
+    def write(self, data):
+        self.buffer.append(data)
+        self.buflen += len(data)
+        if self.buflen >= BGZF_BLOCK_SIZE:
+            data = ''.join(self.buffer)
+            while len(data) >= BGZF_BLOCK_SIZE:
+                self.write_block(data[:BGZF_BLOCK_SIZE])
+                data = data[BGZF_BLOCK_SIZE:]
+            self.buffer = [data]
+            self.buflen = len(data)
+
+    def write_block(self, data):
+        compressor = zlib.compressobj(self.level, zlib.DEFLATED, -15)
+        cdata = compressor.compress(data) + compressor.flush()
+        # gzip header with BC extra field holding block size - 1
+        self.fh.write(struct.pack('<BBBBIBBHBBHH', 31, 139, 8, 4, 0, 0, 255,
+                                  6, 66, 67, 2, len(cdata)+25))
+        self.fh.write(cdata)
+        self.fh.write(struct.pack('<II', zlib.crc32(data) & 0xffffffff, 
+                                  len(data)))
+        self.blockstart += len(cdata) + 26
+
+    def close(self):
+        if self.buflen:
+            self.write_block(''.join(self.buffer))
+        self.buffer = []
+        self.buflen = 0
+        self.fh.write(BGZF_EOF)
+        self.fh.close()
+
+def reg2bin(beg, end):
+    """Returns UCSC/tabix bin of 0-based region [beg, end)"""
+    end -= 1
+    for shift, offset in ((14, 4681), (17, 585), (20, 73), (23, 9), (26, 1)):
+        if beg >> shift == end >> shift:
+            return offset + (beg >> shift)
+    return 0
+
+class TabixIndex:
+    """Tabix index of sorted VCF records as they are written to a
+    BgzfWriter"""
+    def __init__(self):
+        self.names = []
+        self.bins = {}
+        self.offsets = {}
+
+    def add(self, chrom, beg, end, vstart, vend):
+        """Add record of 0-based [beg, end) on chrom written from virtual
+        offset vstart to vend"""
+        if chrom not in self.bins:
+            self.names.append(chrom)
+            self.bins[chrom] = defaultdict(list)
+            self.offsets[chrom] = []
+        chunks = self.bins[chrom][reg2bin(beg, end)]
+        if chunks and chunks[-1][1] == vstart:
+            chunks[-1][1] = vend
+        else:
+            chunks.append([vstart, vend])
+        offsets = self.offsets[chrom]
+        lastwindow = (end - 1) >> TABIX_WINDOW_SHIFT
+        if len(offsets) <= lastwindow:
+            offsets.extend([None] * (lastwindow + 1 - len(offsets)))
+        for w in range(beg >> TABIX_WINDOW_SHIFT, lastwindow + 1):
+            if offsets[w] is None:
+                offsets[w] = vstart
+
+    def write(self, filename):
+        out = BgzfWriter(filename)
+        names = ''.join([ n+'\0' for n in self.names ])
+        # VCF: 1-based, seq col 1, begin col 2, no end col, '#' comments
+        out.write(struct.pack('<4s8i', 'TBI\1', len(self.names), 2, 1, 2, 
+                              0, ord('#'), 0, len(names)))
+        out.write(names)
+        for chrom in self.names:
+            bins = self.bins[chrom]
+            out.write(struct.pack('<i', len(bins)))
+            for b in sorted(bins):
+                out.write(struct.pack('<Ii', b, len(bins[b])))
+                for vstart, vend in bins[b]:
+                    out.write(struct.pack('<QQ', vstart, vend))
+            offsets = list(self.offsets[chrom])
+            first = [ o for o in offsets if o is not None ][0]
+            for w, offset in enumerate(offsets): # fill windows without 
+                if offset is None:               # records starting there
+                    offsets[w] = offsets[w-1] if w else first
+            out.write(struct.pack('<i', len(offsets)))
+            out.write(struct.pack('<{}Q'.format(len(offsets)), *offsets))
+        out.close()
+
+def write_bgzip_vcf(outfile, headlines, lines):
+    """Write VCF header and sorted record lines to outfile (ending in .gz)
+    with tabix index outfile.tbi"""
+    if pysam:
+        plainfile = outfile[:-len('.gz')]
+        with open(plainfile, 'w') as ofh:
+            ofh.write(''.join(headlines))
+            ofh.write(''.join(lines))
+        pysam.tabix_index(plainfile, preset='vcf', force=True)
+        return outfile
+    out = BgzfWriter(outfile)
+    out.write(''.join(headlines))
+    index = TabixIndex()
+    for line in lines:
+        vstart = out.tell()
+        out.write(line)
+        row = line.split('\t', 4)
+        beg = int(row[1]) - 1
+        index.add(row[0], beg, beg + len(row[3]), vstart, out.tell())
+    out.close()
+    index.write(outfile + '.tbi')
+    return outfile
+
 #-----------------------------------------------------------------------------
 
+DEPTH_CHUNK_ROWS = 100000 # depth report rows sorted in memory at a time
+
+def region_gene(description):
+    # '_' for STAMPv1 regions; '-' for STAMPv2 regions
+    return description.split('_')[0].split('-')[0]
+
+class GeneCoverage:
+    """Depth of the regions of one gene.  numbelow counts regions with 
+    min depth below each of COVERAGE_THRESHOLDS; lowchr is the chromosome
+    of the last region below MINCOVERAGE."""
+    def __init__(self, gene):
+        self.gene = gene
+        self.chroms = set()
+        self.numregions = 0
+        self.mindepth = None
+        self.sumdepth = 0.0
+        self.numdepth = 0
+        self.numbelow = [0] * len(COVERAGE_THRESHOLDS)
+        self.lowchr = None
+
+    def add(self, chrom, mindepth, meandepth=None):
+        self.chroms.add(chrom)
+        self.numregions += 1
+        if self.mindepth is None or mindepth < self.mindepth:
+            self.mindepth = mindepth
+        if meandepth is not None:
+            self.sumdepth += meandepth
+            self.numdepth += 1
+        for i, threshold in enumerate(COVERAGE_THRESHOLDS):
+            if mindepth < threshold:
+                self.numbelow[i] += 1
+        if mindepth < MINCOVERAGE:
+            self.lowchr = chrom
+
+    def merge(self, other):
+        self.chroms.update(other.chroms)
+        self.numregions += other.numregions
+        if other.mindepth is not None and (self.mindepth is None or \
+           other.mindepth < self.mindepth):
+            self.mindepth = other.mindepth
+        self.sumdepth += other.sumdepth
+        self.numdepth += other.numdepth
+        self.numbelow = [ a+b for a, b in zip(self.numbelow, other.numbelow) ]
+        if other.lowchr:
+            self.lowchr = other.lowchr
+
+    def meandepth(self):
+        return self.sumdepth/self.numdepth if self.numdepth else None
+
+class DepthCoverage:
+    """Per-gene coverage and chrY coverage in a depth report, collected
+    while the report is read"""
+    def __init__(self):
+        self.numrows = 0
+        self.numlow = 0
+        self.genes = {}
+        self.region_genes = {} # region description -> gene, for this report
+        self.male_chrY = False
+
+    def add(self, row, mindepth, i_chr, i_description, i_meandepth=None):
+        self.numrows += 1
+        if mindepth < MINCOVERAGE:
+            self.numlow += 1
+        if i_chr is None:
+            return
+        if i_description is not None:
+            description = row[i_description]
+            try:
+                gene = self.region_genes[description]
+            except KeyError:
+                gene = region_gene(description)
+                self.region_genes[description] = gene
+            if gene not in self.genes:
+                self.genes[gene] = GeneCoverage(gene)
+            meandepth = None
+            if i_meandepth is not None and is_float(row[i_meandepth]):
+                meandepth = float(row[i_meandepth])
+            self.genes[gene].add(row[i_chr], mindepth, meandepth)
+        if row[i_chr]=='chrY' and mindepth >= MALE_MINCOV:
+            self.male_chrY = True
+
+def merge_gene_coverage(depthinfos):
+    """Return dict of GeneCoverage keyed by gene for all depth reports"""
+    genes = {}
+    for tabdata in depthinfos:
+        for gene, genecov in tabdata.coverage.genes.items():
+            if gene not in genes:
+                genes[gene] = GeneCoverage(gene)
+            genes[gene].merge(genecov)
+    return genes
+
+def spill_depth_rows(rows):
+    """Write sorted (mindepth, linenum, line) rows to a temporary file"""
+    tmpfh = tempfile.TemporaryFile()
+    for mindepth, n, line in rows:
+        tmpfh.write('{}\t{}\t{}\n'.format(mindepth, n, line))
+    tmpfh.seek(0)
+    return tmpfh
+
+def read_spilled_depth_rows(tmpfh):
+    try:
+        for line in tmpfh:
+            mindepth, n, line = line.rstrip('\n').split('\t', 2)
+            yield int(mindepth), int(n), line
+    finally:
+        tmpfh.close()
+
+def sorted_depth_rows(runs, chunk):
+    """Yield rows of sorted chunk merged with spilled sorted runs"""
+    chunk.sort()
+    if runs:
+        merged = heapq.merge(chunk, *[ read_spilled_depth_rows(r) \
+                                       for r in runs ])
+    else:
+        merged = chunk
+    for mindepth, n, line in merged:
+        yield line.split('\t')
+
+def field_index(fields, names):
+    for name in names:
+        if name in fields:
+            return fields.index(name)
+    return None
+
+def read_depth_report(tabfile, outfile=None, lowest=None, 
+                      chunkrows=DEPTH_CHUNK_ROWS):
+    """Read depth report in one pass, sorting rows by min depth (rows with
+    the same min depth stay in file order).  At most chunkrows rows are 
+    held in memory; sorted chunks of larger reports are spilled to 
+    temporary files and merged.  If lowest is set, only that many rows 
+    with the lowest min depth are kept.  Returns TabData whose data is an
+    iterator of the sorted rows, with the column schema and coverage of
+    all rows."""
+    header = []
+    fields = []
+    numlines = 0
+    firstrows = []
+    coverage = DepthCoverage()
+    runs = []
+    chunk = []
+    with open(tabfile, 'r') as fh:
+        for line in fh:
+            numlines += 1
+            if line.startswith('#'):
+                header.append(line.rstrip())
+                continue
+            elif not fields:
+                fields = line.rstrip().split("\t")
+                i_mindepth = field_index(fields, ('Min Depth', 'Min_Depth'))
+                if i_mindepth is None:
+                    sys.exit("{} Bad format.  ".format(tabfile) +\
+                             "Min Depth column not found.")
+                i_chr = field_index(fields, ('Chr',))
+                i_description = field_index(fields, ('Description',))
+                i_meandepth = field_index(fields, ('Mean Depth', 
+                                                   'Mean_Depth'))
+                continue
+            line = line.rstrip()
+            row = line.split("\t")
+            mindepth = int(row[i_mindepth])
+            coverage.add(row, mindepth, i_chr, i_description, i_meandepth)
+            if len(firstrows) < COLUMN_TYPE_ROWS:
+                firstrows.append(row)
+            if lowest is not None: # max heap of lowest rows
+                item = (-mindepth, -numlines, line)
+                if len(chunk) < lowest:
+                    heapq.heappush(chunk, item)
+                elif chunk and item > chunk[0]:
+                    heapq.heapreplace(chunk, item)
+                continue
+            chunk.append((mindepth, numlines, line))
+            if len(chunk) >= chunkrows:
+                chunk.sort()
+                runs.append(spill_depth_rows(chunk))
+                chunk = []
+    if lowest is not None:
+        chunk = [ (-d, -n, line) for d, n, line in chunk ]
+    return TabData(tabfile, sorted_depth_rows(runs, chunk), fields, header,
+                   numlines, outfile, column_schema(fields, firstrows), 
+                   coverage)
+
+def depth_excel_rows(headerdata, tabdata, i_mindepth):
+    for rowdat in headerdata:
+        yield rowdat
+    for row in typed_rows(tabdata.schema, tabdata.data):
+        hi = 'yellow' if row[i_mindepth] < MINCOVERAGE else None
+        yield ExcelRowData(row, hi)
+
 def create_depth_report_xlsx(report, args):
     outfile = outfile_name(report, args.outdir, '.xlsx')
     if args.debug:
         sys.stderr.write("    Writing {}\n".format(outfile))
     sheetname = os.path.basename(outfile).replace('.xlsx','')
     header = []
-    fields = None
-    data = defaultdict(list)
-    tabdata = parse_tab_file(report, outfile=outfile)
+    lowest = args.depth_rows
+    tabdata = read_depth_report(report, outfile, lowest)
+    coverage = tabdata.coverage
+    numlines = tabdata.numlines
     if tabdata.header:
         tabdata.header[0] +=', '+PROGVERSION
     else:
         header.append(ExcelRowData(['#'+PROGVERSION]))
         header.append(ExcelRowData(['#filedate='+datetime_string()]))
     headerdata = [ ExcelRowData([l,]) for l in tabdata.header ]
+    if lowest is not None and coverage.numrows > lowest:
+        headerdata.append(ExcelRowData(['#lowest {} of {} rows by '.format(
+            lowest, coverage.numrows) + 'min depth; {} rows < {}'.format(
+            coverage.numlow, MINCOVERAGE)]))
+        numlines += 1 - (coverage.numrows - lowest)
     headerdata.append(ExcelRowData(tabdata.fields, 'bold'))
-    i_mindepth = None
-    if 'Min Depth' in tabdata.fields:
-        i_mindepth = tabdata.fields.index('Min Depth')
-    elif 'Min_Depth' in tabdata.fields:
-        i_mindepth = tabdata.fields.index('Min_Depth')
-    else:
-        sys.exit("{} Bad format.  ".format(report) +\
-                 "Min Depth column not found.")
-    for row in tabdata.data: # create dict keyed by min depth
-        data[int(row[i_mindepth])].append(row)
-    rows = headerdata
-    for mindepth, row in sorted(data.items()):
-        hi = 'yellow' if mindepth < MINCOVERAGE else None
-        for r in row:
-            rows.append(ExcelRowData(r, hi))
-    numxlines = print_spreadsheet_excel(header, rows, outfile, sheetname)
-    if tabdata.numlines != numxlines:
-        sys.stderr.write("    {} lines in report\n".format(tabdata.numlines))
+    i_mindepth = field_index(tabdata.fields, ('Min Depth', 'Min_Depth'))
+    rows = depth_excel_rows(headerdata, tabdata, i_mindepth)
+    numxlines = print_spreadsheet_excel(header, rows, outfile, sheetname,
+                                        compat=args.excel_compat,
+                                        constant_memory=True)
+    if numlines != numxlines:
+        sys.stderr.write("    {} lines in report\n".format(numlines))
         sys.stderr.write("    {} lines in spreadsheet\n".format(numxlines))
         sys.exit("  ERROR: Num lines don't match\n")
     return tabdata
 
+def check_coverage_fields(tabdata):
+    if 'Description' not in tabdata.fields:
+        sys.exit("{} Bad format.  ".format(tabdata.tabfile) +\
+                 "Description column not found.")
+    if 'Chr' not in tabdata.fields:
+        sys.exit("{} Bad format.  ".format(tabdata.tabfile) +\
+                 "Chr column not found.")
+
 def generate_low_coverage_comment(outlabel, dpindelinfo, dpsnvinfo):
-    low_cov_genes = {}
     is_female = True
     for tabdata in (dpindelinfo, dpsnvinfo):
-        i_chr = None
-        i_mindepth = None
-        i_description = None
-        if 'Min Depth' in tabdata.fields:
-            i_mindepth = tabdata.fields.index('Min Depth')
-        elif 'Min_Depth' in tabdata.fields:
-            i_mindepth = tabdata.fields.index('Min_Depth')
-        else:
-            sys.exit("{} Bad format.  ".format(tabdata.tabfile) +\
-                     "Min Depth column not found.")
-        if 'Description' in tabdata.fields:
-            i_description = tabdata.fields.index('Description')
-        else:
-            sys.exit("{} Bad format.  ".format(tabdata.tabfile) +\
-                     "Description column not found.")
-        if 'Chr' in tabdata.fields:
-            i_chr = tabdata.fields.index('Chr')
-        else:
-            sys.exit("{} Bad format.  ".format(tabdata.tabfile) +\
-                     "Chr column not found.")
-        for row in tabdata.data: 
-            mindepth = int(row[i_mindepth])
-            if mindepth < MINCOVERAGE:
-                # '_' for STAMPv1 regions; '-' for STAMPv2 regions
-                gene = row[i_description].split('_')[0].split('-')[0]
-                low_cov_genes[gene] = row[i_chr]
-            if row[i_chr]=='chrY' and mindepth >= MALE_MINCOV:
-                is_female = False
+        check_coverage_fields(tabdata)
+        if tabdata.coverage.male_chrY:
+            is_female = False
+    genes = merge_gene_coverage((dpindelinfo, dpsnvinfo))
+    low_cov_genes = dict([ (g, genes[g].lowchr) for g in genes \
+                           if genes[g].lowchr ])
     genestr = ', '.join(sorted(low_cov_genes))
     genestr = ', and '.join(genestr.rsplit(', ', 1))
     male_lcc = LOWCOV_TEXT.replace('GENELIST', genestr)
@@ -296,6 +725,37 @@ def generate_low_coverage_comment(outlabel, dpindelinfo, dpsnvinfo):
     sys.stderr.flush()
     return outfile, is_female
 
+def write_gene_coverage_table(outlabel, dpindelinfo, dpsnvinfo):
+    """Write min and mean depth and fraction of regions below each of 
+    COVERAGE_THRESHOLDS for each gene in the indel and snv depth reports"""
+    for tabdata in (dpindelinfo, dpsnvinfo):
+        check_coverage_fields(tabdata)
+    genes = merge_gene_coverage((dpindelinfo, dpsnvinfo))
+    outfile = outlabel + '.gene_coverage.txt'
+    fields = ['Gene', 'Chr', 'Regions', 'Min Depth', 'Mean Depth']
+    fields += [ 'Fraction < {}x'.format(t) for t in COVERAGE_THRESHOLDS ]
+    with open(outfile, 'w') as ofh:
+        ofh.write('#'+PROGVERSION+'\n')
+        ofh.write('#filedate='+datetime_string()+'\n')
+        ofh.write('\t'.join(fields)+'\n')
+        for gene in sorted(genes):
+            genecov = genes[gene]
+            meandepth = genecov.meandepth()
+            row = [gene, ','.join(sorted(genecov.chroms)), 
+                   str(genecov.numregions), str(genecov.mindepth),
+                   '{:.1f}'.format(meandepth) if meandepth is not None \
+                   else '']
+            row += [ '{:.3f}'.format(float(n)/genecov.numregions) \
+                     for n in genecov.numbelow ]
+            ofh.write('\t'.join(row)+'\n')
+    return outfile
+
+SNIPPET_CACHE_SIZE = 10000 # variants with comment snippets kept
+AA_CHANGE_PATT = re.compile(r"([A-Z])(\d+)([A-Z])$")
+START_LOSS_PATT = re.compile(r"M1(?!\d)")
+AA_RANGE_PATT = re.compile(r"[A-Z]?(\d+)(?:_[A-Z]?(\d+))?(del|dup)$")
+SPLICE_PATT = re.compile(r"\d+([+-])(\d+)")
+
 def is_substitution_bases(cdot):
     """Checks if mutation is simple substitution"""
     flag = False
@@ -307,7 +767,7 @@ def is_substitution_bases(cdot):
 
 def aa_change_names_and_codon(pdot):
     """Returns full amino acid names and codon for amino acids in AA change"""
-    match = re.match(r"([A-Z])(\d+)([A-Z])$", pdot)
+    match = AA_CHANGE_PATT.match(pdot)
     result = None
     if match:
         (aa1, codon, aa2) = match.groups()
@@ -317,7 +777,17 @@ def aa_change_names_and_codon(pdot):
             result = [aa1_name, codon, aa2_name]
     return result
 
-def add_comment_snippet(tabdata):
+def aa_range(aa):
+    """Returns 'amino acid(s) ...' for in-frame del or dup AA change"""
+    match = AA_RANGE_PATT.search(aa)
+    if not match:
+        return ''
+    start, end = match.group(1), match.group(2)
+    if end:
+        return ' of amino acids {} to {}'.format(start, end)
+    return ' of amino acid {}'.format(start)
+
+class CommentSnippets:
     """Variant comments crafted by the fellows generally start with a set
     format that can be auto-generated to save them time.  For examples:  
     1. frameshifts
@@ -326,40 +796,104 @@ def add_comment_snippet(tabdata):
     2. termination codon
     The p.Glu219Ter (c.655G>T, p.E219X) mutation in the KEAP1 gene results in a
     premature termination codon at amino acid position 219
-    3. simple substitutions: 
+    3. start codon
+    The p.Met1Ile (c.3G>A, p.M1I) mutation in the NRAS gene results in a 
+    loss of the start codon
+    4. simple substitutions: 
     The p.Thr41Ala (c.121A>G, p.T41A) mutation in the CTNNB1 gene results in a
     substitution of alanine for threonine at codon 41
-    4. If pdot and AA Change are identical
-    The p.747_753del (c.2240_2257del) mutation in the EGFR gene
+    5. in-frame deletions, duplications and insertions
+    The p.747_753del (c.2240_2257del) mutation in the EGFR gene results in an
+    in-frame deletion of amino acids 747 to 753
+    6. splice sites, also without AA Change
+    The c.1234+1G>A mutation in the RUNX1 gene affects a canonical splice site
+
+    Snippets are cached by (gene, CDS change, AA change) since the same
+    variants recur across the samples of a run.  The cache keeps two 
+    generations of up to size snippets: when the recent one is full it
+    replaces the older one, so snippets not used for a generation are 
+    dropped.  This approximates least recently used without the cost of
+    reordering an OrderedDict on every hit.
     """
+    def __init__(self, size=SNIPPET_CACHE_SIZE):
+        self.size = size
+        self.recent = {}
+        self.older = {}
+
+    def snippet(self, gene, cds, aa):
+        """Returns comment snippet, or None if there is none for variant"""
+        key = (gene, cds, aa)
+        try:
+            return self.recent[key]
+        except KeyError:
+            pass
+        if key in self.older:
+            comment = self.older[key]
+        else:
+            comment = self.build(gene, cds, aa)
+        if len(self.recent) >= self.size:
+            self.older = self.recent
+            self.recent = {}
+        self.recent[key] = comment
+        return comment
+
+    def build(self, gene, cds, aa):
+        if cds == '.':
+            return None
+        cdot = 'c.'+cds
+        splice = SPLICE_PATT.match(cds)
+        if aa == '.':
+            if not splice:
+                return None
+            pdot = None
+            mutation = cdot
+        else:
+            pdot = 'p.'+AAPATT.sub(aa_expand, aa)
+            mutation = '{} ({}, p.{})'.format(pdot, cdot, aa) \
+                if pdot != 'p.'+aa else '{} ({})'.format(pdot, cdot)
+        comment = 'The {} mutation in the {} gene'.format(mutation, gene)
+        if pdot and pdot.endswith('fs'):
+            comment += ' results in a frameshift'
+        elif pdot and pdot.endswith('Ter'):
+            comment += ' results in a premature termination codon'
+            p = aa_change_names_and_codon(aa)
+            if p:
+                comment += ' at amino acid position {}'.format(p[1])
+        elif pdot and START_LOSS_PATT.match(aa):
+            comment += ' results in a loss of the start codon'
+        elif pdot and is_substitution_bases(cds):
+            p = aa_change_names_and_codon(aa)
+            if p:
+                n = 'n' if p[2][0] in ('a','i') else ''
+                comment += ' results in a substitution of '+\
+                  'a{} {} for the wild-type {} at codon {}'.format(n,
+                  p[2], p[0], p[1])
+        elif pdot and 'delins' in aa:
+            comment += ' results in an in-frame deletion-insertion'
+        elif pdot and aa.endswith('del'):
+            comment += ' results in an in-frame deletion'+aa_range(aa)
+        elif pdot and aa.endswith('dup'):
+            comment += ' results in an in-frame duplication'+aa_range(aa)
+        elif pdot and 'ins' in aa:
+            comment += ' results in an in-frame insertion'
+        elif splice:
+            if int(splice.group(2)) <= 2:
+                comment += ' affects a canonical splice site'
+            else:
+                comment += ' is in an intron near a splice site'
+        return comment
+
+COMMENT_SNIPPETS = CommentSnippets()
+
+def add_comment_snippet(tabdata, snippets=COMMENT_SNIPPETS):
+    """Add comment snippet, see CommentSnippets, to variant report rows"""
     tabdata.fields.append('Comment snippet')
     i_aa = tabdata.fields.index('AA Change')
     i_cds = tabdata.fields.index('CDS Change')
     i_gene = tabdata.fields.index('Gene')
     for row in tabdata.data:
-        if row[i_aa] != '.' and row[i_cds] != '.':
-            pdot = 'p.'+AAPATT.sub(aa_expand, row[i_aa])
-            cdot = 'c.'+row[i_cds]
-            gene = row[i_gene]
-            mutation = '{} ({}, p.{})'.format(pdot, cdot, row[i_aa]) \
-                if pdot != 'p.'+row[i_aa] else '{} ({})'.format(pdot, cdot)
-            comment = 'The {} mutation in the {} gene'.format(mutation, gene)
-            if pdot.endswith('fs'):
-                comment += ' results in a frameshift'
-            elif pdot.endswith('Ter'):
-                comment += ' results in a premature termination codon'
-                p = aa_change_names_and_codon(row[i_aa])
-                if p:
-                    comment += ' at amino acid position {}'.format(p[1])
-            elif is_substitution_bases(row[i_cds]):
-                p = aa_change_names_and_codon(row[i_aa])
-#                sys.stderr.write("substitution p {} -> {}\n".format(row[i_aa], p))
-                if p:
-                    n = 'n' if p[2][0] in ('a','i') else ''
-                    comment += ' results in a substitution of '+\
-                      'a{} {} for the wild-type {} at codon {}'.format(n,
-                      p[2], p[0], p[1])
-#            sys.stderr.write(comment+'\n')
+        comment = snippets.snippet(row[i_gene], row[i_cds], row[i_aa])
+        if comment is not None:
             row.append(comment)
     return tabdata
 
@@ -391,17 +925,19 @@ def create_variant_report_xlsx(report, args):
     else:
         sys.exit("{} Bad format.  ".format(report) +\
                  "Status column not found.")
-    for row in tabdata.data:
+    schema = column_schema(tabdata.fields, tabdata.data)
+    for row, typedrow in zip(tabdata.data, typed_rows(schema, tabdata.data)):
         if row[i_status]=='NOT_REPORTED':
             if highlight_row:
                 data.append(highlight_row)
                 highlight_row = None
-            data.append(ExcelRowData(row))#, 'red', i_status))
+            data.append(ExcelRowData(typedrow))#, 'red', i_status))
         elif row[i_status]=='ACCEPT':
-            data.append(ExcelRowData(row))#, 'green', i_status))
+            data.append(ExcelRowData(typedrow))#, 'green', i_status))
         else:
-            data.append(ExcelRowData(row))
-    numxlines = print_spreadsheet_excel(header, data, outfile, sheetname)
+            data.append(ExcelRowData(typedrow))
+    numxlines = print_spreadsheet_excel(header, data, outfile, sheetname,
+                                        compat=args.excel_compat)
     if highlight_row:
         num_expect = tabdata.numlines
         sys.stderr.write("    No NOT_REPORTED variants\n")
@@ -413,30 +949,84 @@ def create_variant_report_xlsx(report, args):
         sys.exit("  ERROR: Unexpected num lines\n")
     return tabdata
 
+CHROM_SORTKEYS = {}
+
 def pos_sortkey(chrom, pos):
-    chrom = "%02d" % int(chrom) if chrom.isdigit() else "%-2s" % chrom
-    return "%s.%011d" % (chrom, pos)
+    try:
+        chromkey = CHROM_SORTKEYS[chrom]
+    except KeyError:
+        chromkey = "%02d" % int(chrom) if chrom.isdigit() else "%-2s" % chrom
+        CHROM_SORTKEYS[chrom] = chromkey
+    return "%s.%011d" % (chromkey, pos)
+
+class VariantStatus:
+    """Variant report Status keyed by (chrom, pos, ref, alt), with chrom 
+    interned and without 'chr' and pos an int.  Status by position is 
+    also kept, built when first needed, for VCF records whose alleles 
+    are not written as in the report; a position is NOT_REPORTED only if
+    all its variants are."""
+    def __init__(self, vinfo):
+        self.alleles = {}
+        self.positions = None
+        i_status = vinfo.fields.index('Status')
+        i_chrom = vinfo.fields.index('Chr')
+        i_pos = vinfo.fields.index('Position')
+        i_ref = field_index(vinfo.fields, ('Ref',))
+        i_alt = field_index(vinfo.fields, ('Var', 'Alt'))
+        for row in vinfo.data:
+            chrom = intern(row[i_chrom].replace('chr', ''))
+            if i_ref is None or i_alt is None:
+                key = (chrom, int(row[i_pos]), None, None)
+            else:
+                key = (chrom, int(row[i_pos]), row[i_ref], row[i_alt])
+            self.alleles[key] = row[i_status]
+
+    def position_status(self, chrom, pos):
+        if self.positions is None:
+            self.positions = {}
+            for key, status in self.alleles.items():
+                if self.positions.get(key[:2], 'NOT_REPORTED') == \
+                   'NOT_REPORTED':
+                    self.positions[key[:2]] = status
+        return self.positions.get((chrom, pos))
+
+    def status(self, chrom, pos, ref, alts):
+        """Returns status of VCF record, the first reported status of its
+        alt alleles, or None if not in variant report"""
+        if chrom.startswith('chr'):
+            chrom = chrom[3:]
+        if ',' not in alts:
+            status = self.alleles.get((chrom, pos, ref, alts))
+            if status is not None:
+                return status
+            return self.position_status(chrom, pos)
+        found = None
+        for alt in alts.split(','):
+            status = self.alleles.get((chrom, pos, ref, alt))
+            if status is None:
+                continue
+            elif status != 'NOT_REPORTED':
+                return status
+            found = status
+        if found is None:
+            found = self.position_status(chrom, pos)
+        return found
 
 def split_vcf(vcffile, vinfo, args):
-    label = vcffile.replace('.vcf', '')
+    label = re.sub(r'\.vcf(\.gz)?$', '', vcffile)
     if args.outdir:
         label = os.path.join(args.outdir, os.path.basename(label))
-    acceptfile = label + '_accepted.vcf'
-    rejectfile = label + '_rejected.vcf'
-    i_status = vinfo.fields.index('Status')
-    i_chrom = vinfo.fields.index('Chr')
-    i_pos = vinfo.fields.index('Position')
-    variantdata = defaultdict(dict)
-    for row in vinfo.data:
-        chrom = row[i_chrom].replace('chr', '')
-        pos = int(row[i_pos])
-        variantdata[chrom][pos] = row[i_status]
+    outext = '.vcf.gz' if args.bgzip else '.vcf'
+    acceptfile = label + '_accepted' + outext
+    rejectfile = label + '_rejected' + outext
+    variants = VariantStatus(vinfo)
+    numunmatched = 0
     vcfhead = []
     vcfaccept = defaultdict(list)
     vcfreject = defaultdict(list)
     header = ['##source='+PROGVERSION+'\n', 
               '##fileDate='+date_string()+'\n']
-    with open(vcffile, 'r') as fh:
+    with open_text(vcffile) as fh:
         for line in fh:
             if line.startswith('#'):
                 vcfhead.append(line)
@@ -444,24 +1034,34 @@ def split_vcf(vcffile, vinfo, args):
                     vcfhead.extend(header)
                     header = []
             else:
-                row = line.split("\t", 3)
+                row = line.split("\t", 5)
                 chrom = row[0]
                 pos = int(row[1])
                 sortkey = pos_sortkey(chrom, pos)
-                if variantdata[chrom][pos]=='NOT_REPORTED':
+                status = variants.alleles.get((chrom, pos, row[3], row[4]))
+                if status is None:
+                    status = variants.status(chrom, pos, row[3], row[4])
+                if status is None: # not in report so not reported
+                    numunmatched += 1
+                    vcfreject[sortkey].append(line)
+                elif status=='NOT_REPORTED':
                     vcfreject[sortkey].append(line)
                 else:
                     vcfaccept[sortkey].append(line)
-    with open(acceptfile, 'w') as ofh:
-        ofh.write(''.join(vcfhead))
-        ofh.write(''.join([ ''.join(vcfaccept[k]) for k in \
-                  sorted(vcfaccept)]))
+    for outfile, vcflines in ((acceptfile, vcfaccept), 
+                              (rejectfile, vcfreject)):
+        lines = [ l for k in sorted(vcflines) for l in vcflines[k] ]
+        if args.bgzip:
+            write_bgzip_vcf(outfile, vcfhead, lines)
+            continue
+        with open(outfile, 'w') as ofh:
+            ofh.write(''.join(vcfhead))
+            ofh.write(''.join(lines))
     sys.stderr.write("    Num accepted:{:4d}\n".format(len(vcfaccept)))
-    with open(rejectfile, 'w') as ofh:
-        ofh.write(''.join(vcfhead))
-        ofh.write(''.join([ ''.join(vcfreject[k]) for k in \
-                  sorted(vcfreject)]))
     sys.stderr.write("    Num rejected:{:4d}\n".format(len(vcfreject)))
+    if numunmatched:
+        sys.stderr.write("    WARNING: {} VCF records ".format(numunmatched)+\
+                         "not in variant report were rejected\n")
     return acceptfile, rejectfile
 
 def read_transcript_file(transcriptfile):
@@ -482,73 +1082,483 @@ def read_transcript_file(transcriptfile):
 #                      if "\t" in l.rstrip() and not l.startswith('#')]))
     return transcripts
 
+REGION_SPLIT_PATT = re.compile(r"[\s:;,_()|/]+")
+EXON_SUFFIX_PATT = re.compile(r"[-.]?(exon|ex|intron|int|e|i)\d+$", re.I)
+
+class TranscriptIndex:
+    """Fusion transcripts by gene.  Regions are looked up as given and 
+    otherwise normalized, so 'ALK_exon20', 'ALK-exon20', 'chr2:29446394
+    (ALK)' or 'alk' find the ALK transcript.  Resolved regions and region
+    pairs are cached."""
+    def __init__(self, transcripts):
+        self.transcripts = transcripts
+        self.genes = dict([ (g.upper(), g) for g in transcripts ])
+        self.regions = {}
+        self.pairs = {}
+
+    def gene(self, region):
+        """Returns gene in index for region, or None"""
+        if region in self.transcripts:
+            return region
+        for token in REGION_SPLIT_PATT.split(region):
+            for name in (token, EXON_SUFFIX_PATT.sub('', token)):
+                if name.upper() in self.genes:
+                    return self.genes[name.upper()]
+        return None
+
+    def transcript(self, region):
+        try:
+            return self.regions[region]
+        except KeyError:
+            gene = self.gene(region)
+            transcript = self.transcripts[gene] if gene else ''
+            self.regions[region] = transcript
+            return transcript
+
+    def pair(self, region1, region2):
+        """Returns (transcript1, transcript2), '' if region not found"""
+        try:
+            return self.pairs[(region1, region2)]
+        except KeyError:
+            pair = (self.transcript(region1), self.transcript(region2))
+            self.pairs[(region1, region2)] = pair
+            return pair
+
 def add_transcripts_to_fusion_report(fusionfile, args):
-    fields = []
-    lines = []
-    with open(fusionfile, 'r') as fh:
-        fields = fh.readline().split("\t")
-        lines = [ l for l in fh.readlines() if "\t" in l.rstrip() ]
-    if not lines: 
-        sys.stderr.write("    No fusions\n")
-        return 0
-    else:
-        sys.stderr.write("    {} fusions\n".format(len(lines)))
+    """Write fusion report with Transcript1 and Transcript2 columns after
+    Region2, reading and writing a line at a time.  Returns new file name,
+    or 0 if there are no fusions (no file written)."""
     newfile = fusionfile.replace("filtered.txt",'')+'with_transcripts.txt'
     if args.outdir:
         newfile = os.path.join(args.outdir, os.path.basename(newfile))
-    i_region1 = None
-    i_region2 = None
+    numfusions = 0
+    ofh = None
     try:
-        i_region1 = fields.index('Region1')
-        i_region2 = fields.index('Region2')
-    except:
-        sys.exit("Bad format file {}".format(fusionfile))
-    i = i_region2 + 1 # insert transcripts after Region2
-    fields[i:0] = ['Transcript1', 'Transcript2']
-    with open(newfile, 'w') as ofh:
-        ofh.write("\t".join(fields))
-        for line in lines:
-            data = line.split("\t")
-            t1 = FUSION_TRANSCRIPTS.get(data[i_region1], '')
-            t2 = FUSION_TRANSCRIPTS.get(data[i_region2], '')
-            data[i:0] = [t1, t2]
-            ofh.write("\t".join(data))
+        with open(fusionfile, 'r') as fh:
+            fields = fh.readline().rstrip('\r\n').split("\t")
+            for line in fh:
+                if "\t" not in line.rstrip():
+                    continue
+                if not ofh:
+                    try:
+                        i_region1 = fields.index('Region1')
+                        i_region2 = fields.index('Region2')
+                    except ValueError:
+                        sys.exit("Bad format file {}".format(fusionfile))
+                    i = i_region2 + 1 # insert transcripts after Region2
+                    fields[i:0] = ['Transcript1', 'Transcript2']
+                    ofh = open(newfile, 'w')
+                    ofh.write("\t".join(fields)+"\n")
+                data = line.rstrip('\r\n').split("\t")
+                data[i:0] = FUSION_TRANSCRIPTS.pair(data[i_region1], 
+                                                    data[i_region2])
+                ofh.write("\t".join(data)+"\n")
+                numfusions += 1
+    finally:
+        if ofh:
+            ofh.close()
+    if not numfusions: 
+        sys.stderr.write("    No fusions\n")
+        return 0
+    sys.stderr.write("    {} fusions\n".format(numfusions))
     return newfile
 
-def group_files_by_sample(inputfiles):
-    extensions = {
-        '.depth_report_indels.txt': 'dp_indels', 
-        '.depth_report_snvs.txt': 'dp_snvs',
-        '.fusions.filtered.txt': 'fusions',
-        '.variant_report.txt': 'v_report', 
-        '.vcf': 'vcf', }
-    samples = defaultdict(dict)
-    infiles = []
-    for in_arg in inputfiles: # input can be files or folders
+SCAN_THREADS = 8 # folders listed concurrently, for network drives
+MANIFEST_FILE = '.heme_postprocess_manifest.json' # see RunManifest
+
+# input file suffix -> file type; sample name is the file name before it.
+# None marks files written by this script or otherwise not used.
+INPUT_SUFFIXES = {
+    '.depth_report_indels.txt': 'dp_indels', 
+    '.depth_report_snvs.txt': 'dp_snvs',
+    '.fusions.filtered.txt': 'fusions',
+    '.variant_report.txt': 'v_report', 
+    '.vcf': 'vcf', 
+    '.vcf.gz': 'vcf', 
+    '_accepted.vcf': None,
+    '_rejected.vcf': None,
+    '_accepted.vcf.gz': None,
+    '_rejected.vcf.gz': None,
+    '.vcf.gz.tbi': None,
+    '.unfiltered.vcf': None,
+    '.unfiltered.vcf.gz': None,
+    '.nobarcodes.vcf': None,
+    '.nobarcodes.vcf.gz': None,
+    '.nobarcodes.variant_report.txt': None, }
+
+def compile_suffix_pattern(suffixes):
+    """Return regex matching file names ending in any of suffixes, with 
+    the name before the suffix as group 1 and suffix as group 2.  The 
+    longest suffix wins since it starts first."""
+    alts = sorted(suffixes, key=len, reverse=True)
+    return re.compile('^(.*?)({})$'.format('|'.join([ re.escape(x) \
+                                                      for x in alts ])))
+
+INPUT_PATTERN = compile_suffix_pattern(INPUT_SUFFIXES)
+
+class SampleManifest:
+    """Input files grouped by sample.
+
+    samples -- dict keyed by sample name of dicts with file paths keyed by 
+               file type (v_report, vcf, dp_indels, dp_snvs, fusions)
+    badfiles -- files that are not recognized input files
+    ambiguous -- dict keyed by sample name of files of one type found at
+                 different paths; these samples are not in samples
+    """
+    def __init__(self):
+        self.samples = defaultdict(dict)
+        self.badfiles = []
+        self.ambiguous = defaultdict(list)
+
+    def add_file(self, sample, filetype, path):
+        """Add path as the filetype file of sample and return the sample's
+        dict.  A second, different file of the same type is kept in 
+        ambiguous, see remove_ambiguous."""
+        d = self.samples[sample]
+        old = d.get(filetype)
+        if old and os.path.realpath(old)!=os.path.realpath(path):
+            paths = self.ambiguous[sample]
+            paths.extend([ f for f in (old, path) if f not in paths ])
+        else:
+            d[filetype] = path
+        return d
+
+    def remove_ambiguous(self):
+        """Remove samples with files of one type from different paths (e.g.
+        a rerun in another subfolder), as which to use is not known"""
+        for sample in self.ambiguous:
+            self.samples.pop(sample, None)
+
+def glob_match(path, patterns):
+    name = os.path.basename(path.rstrip(os.sep))
+    return any([ fnmatch.fnmatch(name, patt) for patt in patterns ])
+
+def scan_dir(dirpath):
+    """Return (files, subfolders) in dirpath"""
+    files = []
+    subdirs = []
+    try:
+        if scandir:
+            for entry in scandir(dirpath):
+                if entry.is_dir():
+                    subdirs.append(entry.path)
+                else:
+                    files.append(entry.path)
+        else:
+            for f in os.listdir(dirpath):
+                fpath = os.path.join(dirpath, f)
+                if os.path.isdir(fpath):
+                    subdirs.append(fpath)
+                else:
+                    files.append(fpath)
+    except OSError, e:
+        sys.stderr.write("Cannot read folder {}: {}\n".format(dirpath, e))
+    return files, subdirs
+
+def find_files(inputs, include=None, exclude=None):
+    """Return sorted list of files in inputs, which can be files or folders.
+    Folders are searched recursively, one level at a time with the folders
+    of each level listed concurrently.  Files found in folders are kept if
+    their name matches an include glob (if any) and no exclude glob;
+    folders matching an exclude glob are skipped.  Symlinked folders are
+    followed, but each real folder is listed only once, so links back to
+    a parent folder do not loop."""
+    files = []
+    dirs = []
+    seen = set() # real paths of folders listed
+    for in_arg in inputs:
         if os.path.isfile(in_arg):
-            infiles.append(in_arg)
+            files.append(in_arg)
         elif os.path.isdir(in_arg):
-            infiles.extend([ os.path.join(in_arg, f) for f in \
-                             os.listdir(in_arg) ])
-    badfiles = []
-    for infile in infiles:
-        if infile.endswith('_accepted.vcf') or \
-           infile.endswith('_rejected.vcf') or \
-           infile.endswith('.unfiltered.vcf') or \
-           infile.endswith('.nobarcodes.vcf') or \
-           infile.endswith('.nobarcodes.variant_report.txt'):
-            badfiles.append(infile)
+            dirs.append(in_arg)
+    if not dirs:
+        return sorted(files)
+    pool = ThreadPool(SCAN_THREADS)
+    try:
+        while dirs:
+            newdirs = []
+            for d in dirs:
+                realdir = os.path.realpath(d)
+                if realdir not in seen:
+                    seen.add(realdir)
+                    newdirs.append(d)
+            subdirs = []
+            for dirfiles, dirsubdirs in pool.map(scan_dir, newdirs):
+                files.extend([ f for f in dirfiles if \
+                    (not include or glob_match(f, include)) and \
+                    not (exclude and glob_match(f, exclude)) ])
+                subdirs.extend([ d for d in dirsubdirs if \
+                    not (exclude and glob_match(d, exclude)) ])
+            dirs = subdirs
+    finally:
+        pool.close()
+        pool.join()
+    return sorted(files)
+
+def group_files_by_sample(inputfiles, include=None, exclude=None):
+    """Returns SampleManifest of input files found"""
+    manifest = SampleManifest()
+    for infile in find_files(inputfiles, include, exclude):
+        if os.path.basename(infile)==MANIFEST_FILE:
             continue
-        notfound = True
-        for ext in extensions:
-            if infile.endswith(ext):
-                sample = os.path.basename(infile).replace(ext,'')
-                samples[sample][extensions[ext]] = infile
-                notfound = False
-                break
-        if notfound:
-            badfiles.append(infile)
-    return samples, badfiles
+        match = INPUT_PATTERN.match(os.path.basename(infile))
+        if match and INPUT_SUFFIXES[match.group(2)]:
+            sample, suffix = match.groups()
+            manifest.add_file(sample, INPUT_SUFFIXES[suffix], infile)
+        else:
+            manifest.badfiles.append(infile)
+    manifest.remove_ambiguous()
+    return manifest
+
+def write_ambiguous(manifest):
+    """Write samples left out because they were found in two folders"""
+    for sample, paths in sorted(manifest.ambiguous.items()):
+        sys.stderr.write("Skipping {}, found in more than one folder:\n".\
+                         format(sample)+''.join([ "  {}\n".format(f) \
+                                                  for f in paths ]))
+
+def file_stat(path):
+    """Return [size, mtime] of path, or None if it does not exist"""
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None
+    return [st.st_size, st.st_mtime]
+
+def output_options(args):
+    """Return dict of the program version and options that change output
+    files, to tell if saved outputs were made the same way"""
+    transcripts = os.path.abspath(args.transcripts)
+    return { 'version': PROGVERSION,
+             'bgzip': args.bgzip,
+             'depth_rows': args.depth_rows,
+             'excel_compat': args.excel_compat,
+             'transcripts': [transcripts,]+(file_stat(transcripts) or []), }
+
+class RunManifest:
+    """Input files processed for each sample with their size and mtime, 
+    and the output files made from them, grouped by run folder (the folder
+    of the sample's first input file).  Re-dropped samples are only 
+    reprocessed if an input was added or changed, an output is missing,
+    or options (see output_options) differ, which only needs a stat of 
+    each file.  If persist is set, each run folder's manifest is saved in
+    MANIFEST_FILE in that folder so this also holds for later sessions.
+    """
+    def __init__(self, filetypes, options=None, persist=True):
+        self.filetypes = filetypes
+        self.options = options
+        self.persist = persist
+        self.runs = {} # run folder -> {sample: entry}
+        self.changed = set()
+
+    def inputs(self, d):
+        """Return dict of input file paths by file type for sample dict d"""
+        return dict([ (ftype, os.path.abspath(d[ftype])) for ftype in \
+                      self.filetypes if d.get(ftype) ])
+
+    def run_entries(self, inputs):
+        folder = os.path.dirname(sorted(inputs.values())[0])
+        if folder not in self.runs:
+            self.runs[folder] = {}
+            manifestfile = os.path.join(folder, MANIFEST_FILE)
+            if self.persist and os.path.isfile(manifestfile):
+                try:
+                    with open(manifestfile, 'r') as fh:
+                        self.runs[folder] = json.load(fh)
+                except (IOError, ValueError), e:
+                    sys.stderr.write("Ignoring manifest {}: {}\n".format(
+                                     manifestfile, e))
+        return folder, self.runs[folder]
+
+    def is_current(self, sample, d, outdir=None):
+        """True if sample was already processed from the same, unchanged
+        input files into outdir with the same options and its outputs 
+        still exist"""
+        inputs = self.inputs(d)
+        if not inputs:
+            return False
+        folder, entries = self.run_entries(inputs)
+        entry = entries.get(sample)
+        if not entry or entry['outdir']!=outdir or \
+           entry.get('options')!=self.options or \
+           sorted(entry['inputs'])!=sorted(inputs):
+            return False
+        for ftype, path in inputs.items():
+            if entry['inputs'][ftype]!=[path,]+(file_stat(path) or []):
+                return False
+        return all([ os.path.isfile(f) for f in entry['outputs'] ])
+
+    def record(self, sample, d, outputs=[], outdir=None):
+        """Save current size and mtime of the sample's inputs"""
+        inputs = self.inputs(d)
+        if not inputs:
+            return
+        folder, entries = self.run_entries(inputs)
+        entries[sample] = { 
+            'inputs': dict([ (ftype, [path,]+(file_stat(path) or [])) \
+                             for ftype, path in inputs.items() ]),
+            'outputs': [ os.path.abspath(f) for f in outputs if f ],
+            'outdir': outdir,
+            'options': self.options, }
+        self.changed.add(folder)
+
+    def save(self):
+        """Write manifests of run folders with newly processed samples"""
+        folders = self.changed if self.persist else []
+        for folder in folders:
+            manifestfile = os.path.join(folder, MANIFEST_FILE)
+            try:
+                with open(manifestfile+'.tmp', 'w') as fh:
+                    json.dump(self.runs[folder], fh, indent=1, sort_keys=True)
+                replace_file(manifestfile+'.tmp', manifestfile)
+            except (IOError, OSError), e:
+                sys.stderr.write("Cannot save manifest {}: {}\n".format(
+                                 manifestfile, e))
+        self.changed = set()
+
+#----batch.py-----------------------------------------------------------------
+
+# processing steps in order, for timings in the summary
+STAGES = ['variant report', 'vcf split', 'indel depth report', 
+          'snv depth report', 'low coverage comment', 'gene coverage table',
+          'fusion transcripts']
+
+def process_sample(sample, d, args, times=None):
+    """Run all processing steps for files of one sample.  Time in seconds
+    of each step run is appended to times as (stage, seconds)."""
+    if times is None:
+        times = []
+    def timed(stage, func, *funcargs):
+        starttime = time.time()
+        result = func(*funcargs)
+        times.append((stage, time.time()-starttime))
+        return result
+    sys.stderr.write("\nSample {}\n".format(sample))
+    dpindelinfo = None
+    dpsnvinfo = None
+    vinfo = None
+    sys.stderr.write("- Formatting variant report: ")
+    if 'v_report' in d:
+        sys.stderr.write(" YES\n")
+        vinfo = timed('variant report', create_variant_report_xlsx, 
+                      d['v_report'], args)
+    else:
+        sys.stderr.write(" NO\n")
+    sys.stderr.write("- Splitting vcf: ")
+    if 'vcf' in d and vinfo:
+        sys.stderr.write(" YES\n")
+        timed('vcf split', split_vcf, d['vcf'], vinfo, args)
+    else:
+        sys.stderr.write(" NO\n")
+    sys.stderr.write("- Sorting indel depth report: ")
+    if 'dp_indels' in d:
+        sys.stderr.write(" YES\n")
+        dpindelinfo = timed('indel depth report', create_depth_report_xlsx, 
+                            d['dp_indels'], args)
+    else:
+        sys.stderr.write(" NO\n")
+    sys.stderr.write("- Sorting snv depth report: ")
+    if 'dp_snvs' in d:
+        sys.stderr.write(" YES\n")
+        dpsnvinfo = timed('snv depth report', create_depth_report_xlsx, 
+                          d['dp_snvs'], args)
+    else:
+        sys.stderr.write(" NO\n")
+    sys.stderr.write("- Generating low coverage comment: ")
+    if dpindelinfo and dpsnvinfo:
+        sys.stderr.write(" YES\n")
+        outlabel = outfile_name(dpsnvinfo.tabfile, args.outdir, 
+                                inext='.depth_report_snvs.txt')
+        lcc = timed('low coverage comment', generate_low_coverage_comment,
+                    outlabel, dpindelinfo, dpsnvinfo)
+        timed('gene coverage table', write_gene_coverage_table, outlabel,
+              dpindelinfo, dpsnvinfo)
+    else:
+        sys.stderr.write(" NO\n")
+    sys.stderr.write("- Adding transcripts to fusion file: ")
+    if 'fusions' in d:
+        sys.stderr.write(" YES\n")
+        numfusions = timed('fusion transcripts', 
+                           add_transcripts_to_fusion_report, d['fusions'], args)
+    else:
+        sys.stderr.write(" NO\n")
+    return times
+
+def run_sample(sample, d, args, capture=False):
+    """Process one sample, catching errors (including sys.exit from bad 
+    files) so other samples are still processed.  If capture is set, 
+    messages are returned in the result instead of written.  Returns dict 
+    with sample, error (None if ok), times and log."""
+    result = { 'sample': sample, 'error': None, 'times': [], 'log': '' }
+    stderr = sys.stderr
+    if capture:
+        sys.stderr = StringIO()
+    try:
+        process_sample(sample, d, args, result['times'])
+    except (Exception, SystemExit), e:
+        result['error'] = "{}: {}".format(type(e).__name__, e)
+        sys.stderr.write("  ERROR: {}\n".format(result['error']))
+    finally:
+        if capture:
+            result['log'] = sys.stderr.getvalue()
+            sys.stderr = stderr
+    return result
+
+def init_worker(transcripts):
+    """Set globals in worker processes, which are not inherited on Windows"""
+    global FUSION_TRANSCRIPTS
+    FUSION_TRANSCRIPTS = transcripts
+
+def run_sample_job(job):
+    sample, d, args = job
+    return run_sample(sample, d, args, capture=True)
+
+def process_samples(samples, args, jobs=1):
+    """Process samples (dict of sample files keyed by sample name) in 
+    sample name order, in a pool of jobs processes if jobs>1.  Messages of
+    each sample are written together in sample order.  Returns list of 
+    run_sample results in sample order."""
+    order = sorted(samples)
+    results = []
+    if jobs > 1 and len(order) > 1:
+        pool = multiprocessing.Pool(min(jobs, len(order)), init_worker,
+                                    (FUSION_TRANSCRIPTS,))
+        try:
+            for result in pool.imap(run_sample_job, 
+                                    [ (s, samples[s], args) for s in order ]):
+                sys.stderr.write(result['log'])
+                sys.stderr.flush()
+                results.append(result)
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        for sample in order:
+            results.append(run_sample(sample, samples[sample], args))
+    return results
+
+def write_summary(results, seconds):
+    failed = [ r for r in results if r['error'] ]
+    sys.stderr.write("\nProcessed {} samples in {:.1f}s: ".format(
+                     len(results), seconds) + "{} succeeded, {} failed\n".\
+                     format(len(results)-len(failed), len(failed)))
+    for r in failed:
+        sys.stderr.write("  FAILED {}: {}\n".format(r['sample'], r['error']))
+    totals = defaultdict(float)
+    counts = defaultdict(int)
+    for r in results:
+        for stage, t in r['times']:
+            totals[stage] += t
+            counts[stage] += 1
+    if counts:
+        sys.stderr.write("  {:<22s}{:>6s}{:>10s}{:>10s}\n".format('Step', 
+                         'Files', 'Total(s)', 'Mean(s)'))
+    for stage in STAGES:
+        if counts[stage]:
+            sys.stderr.write("  {:<22s}{:>6d}{:>10.2f}{:>10.2f}\n".format(
+                stage, counts[stage], totals[stage], 
+                totals[stage]/counts[stage]))
+    sys.stderr.flush()
 
 #----gui.py-------------------------------------------------------------------
 
@@ -650,6 +1660,8 @@ class FileDropProcessing(wx.FileDropTarget):
         self.num_samples = 0
         self.oldsamples = {}
         self.current_pos = 0
+        self.runmanifest = RunManifest([ t for t in INPUT_SUFFIXES.values() \
+                                         if t ], output_options(args))
 
     def ScrollWindow(self):
         pos = self.window.GetScrollRange(wx.VERTICAL)
@@ -677,7 +1689,10 @@ class FileDropProcessing(wx.FileDropTarget):
 
     def OnDropFiles(self, x, y, filenames):
         counts = {}
-        samples, badfiles = group_files_by_sample(filenames)
+        manifest = group_files_by_sample(filenames, self.args.include,
+                                         self.args.exclude)
+        samples = manifest.samples
+        badfiles = manifest.badfiles
         if badfiles:
             self.window.MoveEnd()
             for badfile in badfiles:
@@ -685,6 +1700,12 @@ class FileDropProcessing(wx.FileDropTarget):
                     normaltext="Not a recognized input file: {}\n".\
                     format(os.path.basename(badfile)))
                 self.ScrollWindow()
+        for sample, paths in sorted(manifest.ambiguous.items()):
+            self.window.MoveEnd()
+            self.WriteFormattedText(newline=False,
+                normaltext="Skipped {}, found in more than one folder:"\
+                "\n    {}\n".format(sample, '\n    '.join(paths)))
+            self.ScrollWindow()
         self.WriteFormattedText(newline=True)
         for sample, d in sorted(samples.items()):
             if sample in self.oldsamples:
@@ -699,8 +1720,14 @@ class FileDropProcessing(wx.FileDropTarget):
             self.oldsamples[sample] = d
             sys.stderr.write('Sample {}:  {}\n'.format(d['sample_num'], 
                              sample))
+            if self.runmanifest.is_current(sample, d, self.args.outdir):
+                self.WriteFormattedText('Sample {}:  '.format(
+                    d['sample_num']), sample+'  (unchanged, skipped)')
+                self.WriteFormattedText(newline=True)
+                continue
             self.WriteFormattedText('Sample {}:  '.format(d['sample_num']),
                                     sample)
+            outputs = []
             try:
                 dpindelinfo = None
                 dpsnvinfo = None
@@ -710,6 +1737,7 @@ class FileDropProcessing(wx.FileDropTarget):
                         os.path.basename(d['v_report']), True)
                     sys.stderr.write("- Formatting variant report\n")
                     vinfo = create_variant_report_xlsx(d['v_report'], self.args)
+                    outputs.append(vinfo.outfile)
                     if os.path.isfile(vinfo.outfile):
                         self.WriteFormattedText("","      --Wrote {}".format(
                             os.path.basename(vinfo.outfile)))
@@ -720,6 +1748,7 @@ class FileDropProcessing(wx.FileDropTarget):
                     if vinfo:
                         sys.stderr.write("- Splitting vcf\n")
                         outfiles = split_vcf(d['vcf'], vinfo, self.args)
+                        outputs.extend(outfiles)
                         for outfile in outfiles:
                             if os.path.isfile(outfile):
                                 self.WriteFormattedText("",
@@ -732,6 +1761,7 @@ class FileDropProcessing(wx.FileDropTarget):
                     sys.stderr.write("- Sorting indel depth report\n")
                     dpindelinfo = create_depth_report_xlsx(d['dp_indels'], 
                                                            self.args)
+                    outputs.append(dpindelinfo.outfile)
                     if os.path.isfile(dpindelinfo.outfile):
                         self.WriteFormattedText("","      --Wrote {}".format(
                             os.path.basename(dpindelinfo.outfile)))
@@ -741,6 +1771,7 @@ class FileDropProcessing(wx.FileDropTarget):
                         os.path.basename(d['dp_snvs']), True)
                     sys.stderr.write("- Sorting snv depth report\n")
                     dpsnvinfo = create_depth_report_xlsx(d['dp_snvs'], self.args)
+                    outputs.append(dpsnvinfo.outfile)
                     if os.path.isfile(dpsnvinfo.outfile):
                         self.WriteFormattedText("","      --Wrote {}".format(
                             os.path.basename(dpsnvinfo.outfile)))
@@ -751,11 +1782,18 @@ class FileDropProcessing(wx.FileDropTarget):
                                             inext='.depth_report_snvs.txt')
                     outfile, is_female = generate_low_coverage_comment(
                                    outlabel, dpindelinfo, dpsnvinfo)
+                    outputs.append(outfile)
                     if os.path.isfile(outfile):
                         gender = '(F)' if is_female else '(M)'
                         self.WriteFormattedText("",
                             "      --Wrote {} {}".format(
                             os.path.basename(outfile), gender))
+                    outfile = write_gene_coverage_table(outlabel, 
+                                  dpindelinfo, dpsnvinfo)
+                    outputs.append(outfile)
+                    if os.path.isfile(outfile):
+                        self.WriteFormattedText("","      --Wrote {}".format(
+                            os.path.basename(outfile)))
                     sys.stderr.flush()
                 if 'fusions' in d:
                     self.WriteFormattedText("Fusions:  ", 
@@ -763,6 +1801,8 @@ class FileDropProcessing(wx.FileDropTarget):
                     sys.stderr.write("- Adding transcripts to fusion file\n")
                     newfusionfile = add_transcripts_to_fusion_report(
                                          d['fusions'], self.args)
+                    if newfusionfile:
+                        outputs.append(newfusionfile)
                     if newfusionfile==0:
                         self.WriteFormattedText("","      --No fusions")
                     elif newfusionfile and os.path.isfile(newfusionfile):
@@ -773,7 +1813,9 @@ class FileDropProcessing(wx.FileDropTarget):
                 self.window.WriteText("    ERROR: {} {}\n\n".format(
                                        type(e).__name__, e))
                 raise
+            self.runmanifest.record(sample, d, outputs, self.args.outdir)
             self.WriteFormattedText(newline=True)
+        self.runmanifest.save()
 
 def run_gui(args):
     app = StampPostProcess_App(args)
@@ -781,6 +1823,7 @@ def run_gui(args):
 
 #-----------------------------------------------------------------------------
 if __name__=='__main__':
+    multiprocessing.freeze_support() # for pyinstaller executables
     descr = "This script post-processes Heme-STAMP report files."
     descr += " Depth reports will be sorted by Min depth with values less"
     descr += " than 200 highlighted and saved as Excel."
@@ -798,60 +1841,43 @@ if __name__=='__main__':
                         help="Directory to save output file(s)")
     parser.add_argument("-t", "--transcripts", default=FUSION_TRANSCRIPT_FILE,
                         help="Fusion transcript file")
+    parser.add_argument("--include", action='append',
+                        help="Of files found in folders, only use those"+\
+                             " whose name matches this glob (can be"+\
+                             " repeated).  Files given as arguments are"+\
+                             " always used.")
+    parser.add_argument("--exclude", action='append',
+                        help="Skip files and subfolders matching this glob"+\
+                             " (can be repeated)")
+    parser.add_argument("--excel-compat", default=False, 
+                        action='store_true', help="Also re-save Excel files"+\
+                        " with openpyxl (slower; for readers that need it)")
+    parser.add_argument("--bgzip", default=False, action='store_true',
+                        help="Write accepted and rejected VCFs bgzip "+\
+                             "compressed with tabix index")
+    parser.add_argument("--depth-rows", type=int,
+                        help="Only write this many depth report rows with "+\
+                             "the lowest min depth (default: all)")
+    parser.add_argument("-j", "--jobs", type=int, default=1,
+                        help="Number of samples to process in parallel "+\
+                             "(default: 1)")
     parser.add_argument("--debug", default=False, action='store_true',
                         help="Write debugging messages")
 
     args = parser.parse_args()
-    FUSION_TRANSCRIPTS = read_transcript_file(args.transcripts)
+    if args.depth_rows is not None and args.depth_rows < 0:
+        parser.error("--depth-rows must be 0 or more")
+    FUSION_TRANSCRIPTS = TranscriptIndex(read_transcript_file(
+                                         args.transcripts))
     if len(args.reports)==0:
         run_gui(args)
     else:
-        samples, badfiles = group_files_by_sample(args.reports)
-        for sample, d in sorted(samples.items()):
-            sys.stderr.write("\nSample {}\n".format(sample))
-            dpindelinfo = None
-            dpsnvinfo = None
-            vinfo = None
-            sys.stderr.write("- Formatting variant report: ")
-            if 'v_report' in d:
-                sys.stderr.write(" YES\n")
-                vinfo = create_variant_report_xlsx(d['v_report'], args)
-            else:
-                sys.stderr.write(" NO\n")
-            sys.stderr.write("- Splitting vcf: ")
-            if 'vcf' in d and vinfo:
-                sys.stderr.write(" YES\n")
-                split_vcf(d['vcf'], vinfo, args)
-            else:
-                sys.stderr.write(" NO\n")
-            sys.stderr.write("- Sorting indel depth report: ")
-            if 'dp_indels' in d:
-                sys.stderr.write(" YES\n")
-                dpindelinfo = create_depth_report_xlsx(d['dp_indels'], args)
-            else:
-                sys.stderr.write(" NO\n")
-            sys.stderr.write("- Sorting snv depth report: ")
-            if 'dp_snvs' in d:
-                sys.stderr.write(" YES\n")
-                dpsnvinfo = create_depth_report_xlsx(d['dp_snvs'], args)
-            else:
-                sys.stderr.write(" NO\n")
-            sys.stderr.write("- Generating low coverage comment: ")
-            if dpindelinfo and dpsnvinfo:
-                sys.stderr.write(" YES\n")
-                outlabel = outfile_name(dpsnvinfo.tabfile, args.outdir, 
-                                        inext='.depth_report_snvs.txt')
-                lcc = generate_low_coverage_comment(outlabel, dpindelinfo, 
-                                                    dpsnvinfo)
-            else:
-                sys.stderr.write(" NO\n")
-            sys.stderr.write("- Adding transcripts to fusion file: ")
-            if 'fusions' in d:
-                sys.stderr.write(" YES\n")
-                numfusions = add_transcripts_to_fusion_report(d['fusions'], args)
-            else:
-                sys.stderr.write(" NO\n")
-
-
-
-
+        manifest = group_files_by_sample(args.reports, args.include,
+                                         args.exclude)
+        write_ambiguous(manifest)
+        samples = manifest.samples
+        starttime = time.time()
+        results = process_samples(samples, args, args.jobs)
+        write_summary(results, time.time()-starttime)
+        if [ r for r in results if r['error'] ]:
+            sys.exit(1)
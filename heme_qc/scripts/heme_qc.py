@@ -6,17 +6,38 @@ Check STAMP control for expected variants.
 
 import os
 import sys
+import csv
 import datetime
+import fnmatch
+import hashlib
+import json
+import math
+import numpy as np
 import openpyxl
 import operator
 import re
 import sqlite3
+import threading
 import time
 import wx
 import wx.lib.agw.flatnotebook as fnb
 import xlsxwriter
 from collections import defaultdict
 from argparse import ArgumentParser
+from StringIO import StringIO
+try: # optional, for parquet export
+    import pyarrow
+    import pyarrow.parquet
+except ImportError:
+    pyarrow = None
+try: # os.scandir is python 3.5+; scandir backport for python 2
+    from os import scandir
+except ImportError:
+    try:
+        from scandir import scandir
+    except ImportError:
+        scandir = None
+from multiprocessing.pool import ThreadPool
 
 VERSION="1.0"
 BUILD="180423"
@@ -42,6 +63,13 @@ def get_ctrl_version():
 def getScriptPath():
     return os.path.dirname(os.path.realpath(sys.argv[0]))
 
+def replace_file(src, dst):
+    """Rename src to dst, replacing dst.  os.rename does not replace an
+    existing file on Windows."""
+    if os.name=='nt' and os.path.exists(dst):
+        os.remove(dst)
+    os.rename(src, dst)
+
 DEFAULT_RESOURCE_DIR = os.path.abspath(os.path.join(getScriptPath(), 
                            "..", "resources"))
 DEFAULT_RESULTS_DIR = os.path.abspath(os.path.join(getScriptPath(), 
@@ -77,16 +105,29 @@ FORMAT_VARTYPE = {
     'cnv':'CNV',
   }
 }
-REFS = {}
 CNV_CUTOFF_STR = '# mean-z-cutoffs: [12.0, 5.0, -6.0, -12.0]'
 
-def check_references(resourcedir, resultdir, ctrl_version):
-    """Populate global REFS variable with reference files found
+class ControlContext:
+    """Per-control state.  Each control has its own reference files,
+    db handle and truth set so controls can be processed independently.
+
+    refs is a dict with keys same as REFFILE_LIST (TRUTHFILE,FUSIONFILE,..)
+    """
+    def __init__(self, ctrl, clabel, refs=None):
+        self.ctrl = ctrl
+        self.clabel = clabel
+        self.refs = refs if refs else {}
+        self.dbh = None
+        self.truthset = None
+
+def check_references(resourcedir, resultdir, ctrl_version, contexts=None):
+    """Create a ControlContext for each control with reference files found
     that match ctrl_version specified.
 
-    The REFS dict is keyed by CONTROL_LIST values (TruQ3 or HD753)
-    Values are dicts with keys same as REFFILE_LIST (TRUTHFILE,FUSIONFILE,..)
+    Returns dict of contexts keyed by CONTROL_LIST values (HD701 or HD753)
     """
+    if contexts is None:
+        contexts = {}
     found = []
     for clabel, ctrl in CONTROL_LIST.items():
         # skip controls that don't match ctrl_version
@@ -96,7 +137,7 @@ def check_references(resourcedir, resultdir, ctrl_version):
         truthfile = os.path.join(resourcedir, 
             REFFILE_LIST['TRUTHFILE'].replace('CONTROL',clabel))
         if os.path.isfile(truthfile): 
-            REFS[ctrl] = {}
+            context = ControlContext(ctrl, clabel)
             found.append(clabel)
             for ftype in REFFILE_LIST:
                 # Files needed by this script will be in resourcedir
@@ -105,17 +146,21 @@ def check_references(resourcedir, resultdir, ctrl_version):
                 fpath = os.path.join(ddir,
                     REFFILE_LIST[ftype].replace('CONTROL',clabel))
                 if 'FILE' not in ftype or os.path.isfile(fpath):
-                    REFS[ctrl][ftype] = fpath
+                    context.refs[ftype] = fpath
+            contexts[ctrl] = context
     if found:
         sys.stdout.write("Truth files found for:  "+', '.join(found)+'\n')
     else:
         sys.stdout.write("No truth files found.\n")
-    controls = sorted(REFS)
     sys.stdout.flush()
-    return controls
-
-def check_existing_dbs(resultdir, ctrl_version):
-    """Look for existing DBs.  Do not need truth files if DB exists"""
+    return contexts
+
+def check_existing_dbs(resultdir, ctrl_version, contexts=None, log=None):
+    """Look for existing DBs.  Do not need truth files if DB exists.
+    Messages are written to log (default: stdout)."""
+    if contexts is None:
+        contexts = {}
+    log = log or sys.stdout
     found = []
     for clabel, ctrl in CONTROL_LIST.items():
         # skip controls that don't match ctrl_version
@@ -125,66 +170,326 @@ def check_existing_dbs(resultdir, ctrl_version):
         dbfile = os.path.join(resultdir, 
             REFFILE_LIST['SQLITEDB'].replace('CONTROL',clabel))
         if os.path.isfile(dbfile): 
-            REFS[ctrl] = {'SQLITEDB':dbfile,}
+            context = ControlContext(ctrl, clabel, {'SQLITEDB':dbfile,})
             found.append(clabel)
             for ftype in ('SPREADSHEET',):
                 fpath = os.path.join(resultdir,
                     REFFILE_LIST[ftype].replace('CONTROL',clabel))
-                REFS[ctrl][ftype] = fpath
+                context.refs[ftype] = fpath
+            contexts[ctrl] = context
     if found:
-        sys.stdout.write("DB files found for:  "+', '.join(found)+'\n')
+        log.write("DB files found for:  "+', '.join(found)+'\n')
     else:
-        sys.stdout.write("No DB files found.\n")
-    controls = sorted(REFS)
-    sys.stdout.flush()
-    return controls
+        log.write("No DB files found.\n")
+    log.flush()
+    return contexts
+
+class ThreadOutput:
+    """Stream replacing sys.stdout or sys.stderr while controls run in
+    worker threads.  Writes of a thread that has a buffer go to it; other
+    threads write to the original stream."""
+    def __init__(self, stream, local):
+        self.stream = stream
+        self.local = local
+
+    def write(self, text):
+        buffers = getattr(self.local, 'buffers', None)
+        if buffers is None:
+            self.stream.write(text)
+        else:
+            buffers[self].write(text)
+
+    def flush(self):
+        if getattr(self.local, 'buffers', None) is None:
+            self.stream.flush()
+
+    def __getattr__(self, name):
+        return getattr(self.stream, name)
+
+def run_per_control(func, contexts, *args):
+    """Call func(context, *args) for each control concurrently, one worker
+    thread per control.  Each control's messages are kept and written in
+    control order once all controls are done.  Returns dict of results 
+    keyed by control."""
+    controls = sorted(contexts)
+    if len(controls) < 2:
+        return dict([ (c, func(contexts[c], *args)) for c in controls ])
+    local = threading.local()
+    stdout = ThreadOutput(sys.stdout, local)
+    stderr = ThreadOutput(sys.stderr, local)
+    output = dict([ (c, {stdout: StringIO(), stderr: StringIO()}) \
+                    for c in controls ])
+    def run_control(ctrl):
+        local.buffers = output[ctrl]
+        try:
+            return func(contexts[ctrl], *args)
+        finally:
+            local.buffers = None
+    sys.stdout, sys.stderr = stdout, stderr
+    pool = ThreadPool(len(controls))
+    try:
+        results = pool.map(run_control, controls)
+    finally:
+        pool.close()
+        pool.join()
+        sys.stdout, sys.stderr = stdout.stream, stderr.stream
+        for ctrl in controls:
+            for stream in (stdout, stderr):
+                stream.stream.write(output[ctrl][stream].getvalue())
+                stream.stream.flush()
+    return dict(zip(controls, results))
 
 #----fileops.py---------------------------------------------------------------
 
-def group_files_by_sample(inputfiles):
-    """HD753 uses both a variant report and fusion report for each sample"""
-    extensions = {
-        '.cnvs': 'c_report',
-        '.fusions.filtered.txt': 'f_report',
-        '.variant_report.txt': 'v_report', }
-    samples = defaultdict(dict)
-    infiles = []
-    for in_arg in inputfiles: # input can be files or folders
+SCAN_THREADS = 8 # folders listed concurrently, for network drives
+MANIFEST_FILE = '.heme_qc_manifest.json' # see RunManifest
+
+# report file suffix -> file type; sample name is the file name before it
+REPORT_SUFFIXES = {
+    '.cnvs': 'c_report',
+    '.fusions.filtered.txt': 'f_report',
+    '.variant_report.txt': 'v_report', }
+# off target and tile cnv files
+IGNORE_PATTERN = re.compile(r'\.tiles\.cnv|\.offtarget\.', re.I)
+CONTROL_PATTERNS = [ (re.compile('hd.*701', re.I), 'HD701'), 
+                     (re.compile('hd.*753', re.I), 'HD753'), ]
+
+def compile_suffix_pattern(suffixes):
+    """Return regex matching file names ending in any of suffixes, with 
+    the name before the suffix as group 1 and suffix as group 2.  The 
+    longest suffix wins since it starts first."""
+    alts = sorted(suffixes, key=len, reverse=True)
+    return re.compile('^(.*?)({})$'.format('|'.join([ re.escape(x) \
+                                                      for x in alts ])))
+
+REPORT_PATTERN = compile_suffix_pattern(REPORT_SUFFIXES)
+
+class SampleManifest:
+    """Input files grouped by sample.
+
+    samples -- dict keyed by sample name of dicts with file paths keyed by 
+               file type (v_report, f_report, c_report), plus run and 
+               control names
+    badfiles -- files that are not reports of a known control
+    ambiguous -- dict keyed by sample name of reports of one type found at
+                 different paths; these samples are not in samples
+    """
+    def __init__(self):
+        self.samples = defaultdict(dict)
+        self.badfiles = []
+        self.ambiguous = defaultdict(list)
+
+    def add_file(self, sample, filetype, path):
+        """Add path as the filetype file of sample and return the sample's
+        dict.  A second, different file of the same type is kept in 
+        ambiguous, see remove_ambiguous."""
+        d = self.samples[sample]
+        old = d.get(filetype)
+        if old and os.path.realpath(old)!=os.path.realpath(path):
+            paths = self.ambiguous[sample]
+            paths.extend([ f for f in (old, path) if f not in paths ])
+        else:
+            d[filetype] = path
+        return d
+
+    def remove_ambiguous(self):
+        """Remove samples with files of one type from different paths (e.g.
+        a rerun in another subfolder), as which to use is not known"""
+        for sample in self.ambiguous:
+            self.samples.pop(sample, None)
+
+def glob_match(path, patterns):
+    name = os.path.basename(path.rstrip(os.sep))
+    return any([ fnmatch.fnmatch(name, patt) for patt in patterns ])
+
+def scan_dir(dirpath):
+    """Return (files, subfolders) in dirpath"""
+    files = []
+    subdirs = []
+    try:
+        if scandir:
+            for entry in scandir(dirpath):
+                if entry.is_dir():
+                    subdirs.append(entry.path)
+                else:
+                    files.append(entry.path)
+        else:
+            for f in os.listdir(dirpath):
+                fpath = os.path.join(dirpath, f)
+                if os.path.isdir(fpath):
+                    subdirs.append(fpath)
+                else:
+                    files.append(fpath)
+    except OSError, e:
+        sys.stderr.write("Cannot read folder {}: {}\n".format(dirpath, e))
+    return files, subdirs
+
+def find_files(inputs, include=None, exclude=None):
+    """Return sorted list of files in inputs, which can be files or folders.
+    Folders are searched recursively, one level at a time with the folders
+    of each level listed concurrently.  Files found in folders are kept if
+    their name matches an include glob (if any) and no exclude glob;
+    folders matching an exclude glob are skipped.  Symlinked folders are
+    followed, but each real folder is listed only once, so links back to
+    a parent folder do not loop."""
+    files = []
+    dirs = []
+    seen = set() # real paths of folders listed
+    for in_arg in inputs:
         if os.path.isfile(in_arg):
-            infiles.append(in_arg)
+            files.append(in_arg)
         elif os.path.isdir(in_arg):
-            infiles.extend([ os.path.join(in_arg, f) for f in \
-                             os.listdir(in_arg) ])
-    badfiles = []
-    for infile in infiles:
-        fname = os.path.basename(infile).lower()
-        control = None
-        if '.tiles.cnv' in fname or '.offtarget.' in fname:
-            # ignore off target and tile cnv files
-            badfiles.append(infile)
-            continue
-        if re.search('hd.*701', fname):
-            control = 'HD701'
-        elif re.search('hd.*753', fname):
-            control = 'HD753'
-        else:
-            badfiles.append(infile)
+            dirs.append(in_arg)
+    if not dirs:
+        return sorted(files)
+    pool = ThreadPool(SCAN_THREADS)
+    try:
+        while dirs:
+            newdirs = []
+            for d in dirs:
+                realdir = os.path.realpath(d)
+                if realdir not in seen:
+                    seen.add(realdir)
+                    newdirs.append(d)
+            subdirs = []
+            for dirfiles, dirsubdirs in pool.map(scan_dir, newdirs):
+                files.extend([ f for f in dirfiles if \
+                    (not include or glob_match(f, include)) and \
+                    not (exclude and glob_match(f, exclude)) ])
+                subdirs.extend([ d for d in dirsubdirs if \
+                    not (exclude and glob_match(d, exclude)) ])
+            dirs = subdirs
+    finally:
+        pool.close()
+        pool.join()
+    return sorted(files)
+
+def report_run_name(sample):
+    runnum = sample.lstrip('HDhd70153').lstrip('_').lstrip('HEME')
+    runnum = runnum.split('_')[0]
+    # sort validation runs first from regular runs
+    if runnum.startswith("V"):
+      runnum = " "+runnum
+    if runnum.isdigit():
+        runnum = "{:04d}".format(int(runnum))
+    return "HEME{}".format(runnum) if runnum else ''
+
+def group_files_by_sample(inputfiles, include=None, exclude=None):
+    """HD753 uses both a variant report and fusion report for each sample.
+    Returns SampleManifest."""
+    manifest = SampleManifest()
+    for infile in find_files(inputfiles, include, exclude):
+        fname = os.path.basename(infile)
+        if IGNORE_PATTERN.search(fname):
+            manifest.badfiles.append(infile)
             continue
-        for ext in extensions:
-            if infile.endswith(ext):
-                sample = os.path.basename(infile).replace(ext,'')
-                runnum = sample.lstrip('HDhd70153').lstrip('_').lstrip('HEME')
-                runnum = runnum.split('_')[0]
-                # sort validation runs first from regular runs
-                if runnum.startswith("V"):
-                  runnum = " "+runnum
-                if runnum.isdigit():
-                    runnum = "{:04d}".format(int(runnum))
-                run = "HEME{}".format(runnum) if runnum else ''
-                samples[sample][extensions[ext]] = infile
-                samples[sample]['run'] = run
-                samples[sample]['control'] = control
-    return samples, badfiles
+        control = None
+        for pattern, ctrl in CONTROL_PATTERNS:
+            if pattern.search(fname):
+                control = ctrl
+                break
+        match = REPORT_PATTERN.match(fname)
+        if not control:
+            manifest.badfiles.append(infile)
+        elif match:
+            sample, suffix = match.groups()
+            d = manifest.add_file(sample, REPORT_SUFFIXES[suffix], infile)
+            d['run'] = report_run_name(sample)
+            d['control'] = control
+    manifest.remove_ambiguous()
+    return manifest
+
+def write_ambiguous(manifest):
+    """Write samples left out because they were found in two folders"""
+    for sample, paths in sorted(manifest.ambiguous.items()):
+        sys.stderr.write("Skipping {}, found in more than one folder:\n".\
+                         format(sample)+''.join([ "  {}\n".format(f) \
+                                                  for f in paths ]))
+
+def file_stat(path):
+    """Return [size, mtime] of path, or None if it does not exist"""
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None
+    return [st.st_size, st.st_mtime]
+
+class RunManifest:
+    """Input files processed for each sample with their size and mtime, 
+    and the output files made from them, grouped by run folder (the folder
+    of the sample's first input file).  Re-dropped samples are only 
+    reprocessed if an input was added or changed, or an output is missing,
+    which only needs a stat of each file.  If persist is set, each run
+    folder's manifest is saved in MANIFEST_FILE in that folder so this 
+    also holds for later sessions.
+    """
+    def __init__(self, filetypes, persist=True):
+        self.filetypes = filetypes
+        self.persist = persist
+        self.runs = {} # run folder -> {sample: entry}
+        self.changed = set()
+
+    def inputs(self, d):
+        """Return dict of input file paths by file type for sample dict d"""
+        return dict([ (ftype, os.path.abspath(d[ftype])) for ftype in \
+                      self.filetypes if d.get(ftype) ])
+
+    def run_entries(self, inputs):
+        folder = os.path.dirname(sorted(inputs.values())[0])
+        if folder not in self.runs:
+            self.runs[folder] = {}
+            manifestfile = os.path.join(folder, MANIFEST_FILE)
+            if self.persist and os.path.isfile(manifestfile):
+                try:
+                    with open(manifestfile, 'r') as fh:
+                        self.runs[folder] = json.load(fh)
+                except (IOError, ValueError), e:
+                    sys.stderr.write("Ignoring manifest {}: {}\n".format(
+                                     manifestfile, e))
+        return folder, self.runs[folder]
+
+    def is_current(self, sample, d, outdir=None):
+        """True if sample was already processed from the same, unchanged
+        input files into outdir and its outputs still exist"""
+        inputs = self.inputs(d)
+        if not inputs:
+            return False
+        folder, entries = self.run_entries(inputs)
+        entry = entries.get(sample)
+        if not entry or entry['outdir']!=outdir or \
+           sorted(entry['inputs'])!=sorted(inputs):
+            return False
+        for ftype, path in inputs.items():
+            if entry['inputs'][ftype]!=[path,]+(file_stat(path) or []):
+                return False
+        return all([ os.path.isfile(f) for f in entry['outputs'] ])
+
+    def record(self, sample, d, outputs=[], outdir=None):
+        """Save current size and mtime of the sample's inputs"""
+        inputs = self.inputs(d)
+        if not inputs:
+            return
+        folder, entries = self.run_entries(inputs)
+        entries[sample] = { 
+            'inputs': dict([ (ftype, [path,]+(file_stat(path) or [])) \
+                             for ftype, path in inputs.items() ]),
+            'outputs': [ os.path.abspath(f) for f in outputs if f ],
+            'outdir': outdir, }
+        self.changed.add(folder)
+
+    def save(self):
+        """Write manifests of run folders with newly processed samples"""
+        folders = self.changed if self.persist else []
+        for folder in folders:
+            manifestfile = os.path.join(folder, MANIFEST_FILE)
+            try:
+                with open(manifestfile+'.tmp', 'w') as fh:
+                    json.dump(self.runs[folder], fh, indent=1, sort_keys=True)
+                replace_file(manifestfile+'.tmp', manifestfile)
+            except (IOError, OSError), e:
+                sys.stderr.write("Cannot save manifest {}: {}\n".format(
+                                 manifestfile, e))
+        self.changed = set()
 
 def massage_data(data, vartype):
     """Unify differing formats and convert data types to appropriate types"""
@@ -327,17 +632,234 @@ def results_as_dict(cursor):
         data.append(d)
     return data
 
-def connect_db(dbfile):
-    sys.stdout.write("  Connecting to db {}\n".format(dbfile))
-    dbh = sqlite3.connect(dbfile)
+# DB connection settings.  WAL lets readers (spreadsheet generation) run
+# while another process writes.  WAL needs all processes on the same host;
+# if the file system does not support it sqlite keeps the old journal mode.
+DB_JOURNAL_MODE = 'WAL'
+DB_SYNCHRONOUS = 'NORMAL' # safe with WAL, avoids fsync on every commit
+DB_CACHE_SIZE = -16000 # negative value is size in KiB
+DB_BUSY_TIMEOUT = 30 # seconds to wait for a lock before raising an error
+DB_RETRIES = 5 # times to retry a commit if db is still locked
+DB_RETRY_WAIT = 2 # seconds, multiplied by attempt number
+DB_CONNECTIONS = {} # connections reused within process
+DB_CONNECTIONS_LOCK = threading.Lock()
+
+def connect_db(dbfile, readonly=False, log=None):
+    """Return connection to dbfile.  Connections are opened once per process
+    and reused.  A readonly connection is a separate connection that cannot
+    write, so reads do not hold up saving data.  Messages are written to 
+    log (default: stdout)."""
+    key = (os.path.realpath(dbfile), readonly)
+    with DB_CONNECTIONS_LOCK:
+        if key in DB_CONNECTIONS:
+            return DB_CONNECTIONS[key]
+        (log or sys.stdout).write("  Connecting to db {}{}\n".format(dbfile,
+                         ' (read only)' if readonly else ''))
+        # db may be opened in a control worker thread and used later in the
+        # main/GUI thread; each control's handle is only used by one thread
+        # at a time.
+        dbh = sqlite3.connect(dbfile, timeout=DB_BUSY_TIMEOUT,
+                              check_same_thread=False)
+        if readonly:
+            dbh.execute('PRAGMA query_only=ON')
+        else:
+            mode = dbh.execute('PRAGMA journal_mode={}'.format(
+                               DB_JOURNAL_MODE)).fetchone()[0]
+            if mode.upper()!=DB_JOURNAL_MODE:
+                sys.stderr.write("  WARNING: journal mode {} not ".format(
+                    DB_JOURNAL_MODE)+"available. Using {}\n".format(mode))
+            dbh.execute('PRAGMA synchronous={}'.format(DB_SYNCHRONOUS))
+        dbh.execute('PRAGMA cache_size={}'.format(DB_CACHE_SIZE))
+        DB_CONNECTIONS[key] = dbh
     return dbh
 
+def readonly_db(dbh):
+    """Return readonly connection to same db file as dbh"""
+    dbfile = dbh.execute('PRAGMA database_list').fetchone()[2]
+    return connect_db(dbfile, readonly=True)
+
+def close_db(dbh):
+    """Close connection and remove from reused connections"""
+    with DB_CONNECTIONS_LOCK:
+        for key, cached in DB_CONNECTIONS.items():
+            if cached is dbh:
+                del DB_CONNECTIONS[key]
+    dbh.close()
+
+def retry_if_locked(func, *args, **kwargs):
+    """Call func, retrying if db is still locked after the busy timeout"""
+    for attempt in range(1, DB_RETRIES+1):
+        try:
+            return func(*args, **kwargs)
+        except sqlite3.OperationalError, e:
+            if attempt==DB_RETRIES or not ('locked' in str(e) or \
+                                           'busy' in str(e)):
+                raise
+            sys.stderr.write("  DB busy ({}). Retry {} of {}\n".format(e,
+                             attempt, DB_RETRIES-1))
+            sys.stderr.flush()
+            time.sleep(DB_RETRY_WAIT*attempt)
+
+def commit_db(dbh):
+    retry_if_locked(dbh.commit)
+
 def add_schema(dbh, schemafile):
     sys.stdout.write("  Reading schema {}\n".format(schemafile))
     with open(schemafile, 'r') as fh:
         schema = ' '.join(fh.readlines())
         dbh.executescript(schema)
 
+# Tables written by export_tables.  Each has a change_seq column (see
+# change_seq_sql) so exports can pick up only the rows changed since.
+EXPORT_TABLES = ['sample', 'mutation', 'sample_mutation', 'fusion', 
+                 'sample_fusion', 'cnv', 'sample_cnv']
+
+CHANGE_SEQ_TRIGGER = """
+    CREATE TRIGGER IF NOT EXISTS {table}_{name}_change_seq
+        AFTER {event} ON {table}{when}
+    BEGIN
+        UPDATE change_counter SET seq=seq+1;
+        UPDATE {table} SET change_seq=(SELECT seq FROM change_counter)
+            WHERE rowid=NEW.rowid;
+    END;"""
+
+def change_seq_sql(tables):
+    """SQL adding a change_seq column to tables, set from a db-wide counter
+    by triggers when a row is inserted or updated.  sqlite lets only one
+    transaction write at a time, so change_seq increases in commit order,
+    unlike last_modified, which is set before the commit."""
+    sql = ["CREATE TABLE IF NOT EXISTS change_counter (seq INTEGER);",
+           "INSERT INTO change_counter (seq) SELECT 0 WHERE NOT EXISTS "+\
+           "(SELECT 1 FROM change_counter);"]
+    for table in tables:
+        sql.append("ALTER TABLE {} ADD COLUMN change_seq INTEGER DEFAULT 0;"\
+                   .format(table))
+        sql.append("CREATE INDEX IF NOT EXISTS {0}_change_seq_index ON {0}"\
+                   " (change_seq);".format(table))
+        sql.append(CHANGE_SEQ_TRIGGER.format(table=table, name='insert',
+                                             event='INSERT', when=''))
+        # the trigger's own update sets change_seq, so it does not fire again
+        sql.append(CHANGE_SEQ_TRIGGER.format(table=table, name='update',
+                   event='UPDATE',
+                   when=' WHEN NEW.change_seq IS OLD.change_seq'))
+    return "\n".join(sql)
+
+# Schema changes applied to existing dbs in order.  The db version is kept
+# in PRAGMA user_version; the schema file is version 0.
+DB_MIGRATIONS = [
+    (1, "indexes for sample, truth and count queries", """
+    CREATE INDEX IF NOT EXISTS mutation_expected_index
+        ON mutation (is_expected);
+    CREATE INDEX IF NOT EXISTS fusion_expected_index 
+        ON fusion (is_expected);
+    CREATE INDEX IF NOT EXISTS cnv_expected_index ON cnv (is_expected);
+    CREATE INDEX IF NOT EXISTS sample_status_index ON sample (sample_status);
+    CREATE INDEX IF NOT EXISTS sample_mutation_mutation_index
+        ON sample_mutation (mutation_id, sample_id, vaf);
+    CREATE INDEX IF NOT EXISTS sample_fusion_fusion_index
+        ON sample_fusion (fusion_id, sample_id);
+    CREATE INDEX IF NOT EXISTS sample_cnv_cnv_index
+        ON sample_cnv (cnv_id, sample_id, mean_z);
+    ANALYZE;
+    """),
+    (2, "indexes for variant history lookups", """
+    CREATE INDEX IF NOT EXISTS mutation_position_index 
+        ON mutation (position);
+    CREATE INDEX IF NOT EXISTS mutation_hgvs_index ON mutation (HGVS);
+    CREATE INDEX IF NOT EXISTS mutation_protein_index ON mutation (protein);
+    """),
+    (3, "change sequence for incremental exports", 
+     change_seq_sql(EXPORT_TABLES)),
+]
+
+# Hot queries, run through the functions that make them, with the 
+# index(es) each may use.  Each function is called with a PlanCursor and 
+# the control's TruthSet.  Checked by the check command against EXPLAIN
+# QUERY PLAN so a query or schema change that stops using an index is
+# noticed.
+QUERY_PLAN_CHECKS = [
+    ("get_samples", lambda cursor, truthset: get_samples(cursor, 
+     'HEME0001', 'HD701'), 'sample_index'),
+    ("get_num_variants_missing", lambda cursor, truthset:
+     get_num_variants_missing(cursor, 1, 'mutation'), 
+     'mutation_expected_index'),
+    ("get_num_variants_other", lambda cursor, truthset:
+     get_num_variants_other(cursor, 1, 'mutation'), 
+     ('sqlite_autoindex_sample_mutation_1', 
+      'sample_mutation_mutation_index')),
+    ("truths_from_db", lambda cursor, truthset: 
+     truthset.truths_from_db(cursor, 'mutation'), 'mutation_expected_index'),
+    ("db_summary", lambda cursor, truthset: truthset.db_summary(cursor),
+     'sample_status_index'),
+    ("db_summary", lambda cursor, truthset: truthset.db_summary(cursor),
+     'mutation_expected_index'),
+    ("get_vaf_history", lambda cursor, truthset: get_vaf_history(cursor,
+     position=truth_position(truthset)), 'mutation_position_index'),
+    ("get_vaf_history", lambda cursor, truthset: get_vaf_history(cursor,
+     position=truth_position(truthset)), 'sample_mutation_mutation_index'),
+]
+
+def get_db_version(dbh):
+    return dbh.execute('PRAGMA user_version').fetchone()[0]
+
+def migrate_db(dbh, migrations=DB_MIGRATIONS):
+    """Apply migrations newer than the db version.  Each migration and its
+    version number are saved in one transaction.  Returns db version."""
+    version = get_db_version(dbh)
+    for num, descr, sql in migrations:
+        if num <= version:
+            continue
+        sys.stdout.write("  Updating db to version {}: {}\n".format(num, 
+                         descr))
+        script = "BEGIN;\n{}\nPRAGMA user_version={};\nCOMMIT;".format(sql,
+                 num)
+        try:
+            retry_if_locked(dbh.executescript, script)
+        except sqlite3.Error:
+            try:
+                dbh.execute('ROLLBACK')
+            except sqlite3.Error:
+                pass
+            raise
+        version = num
+    return version
+
+class PlanCursor:
+    """Cursor that saves the EXPLAIN QUERY PLAN of each query it runs"""
+    def __init__(self, cursor):
+        self.cursor = cursor
+        self.plans = []
+
+    def execute(self, cmd, args=[]):
+        self.plans.extend([ row[-1] for row in self.cursor.connection.\
+                            execute('EXPLAIN QUERY PLAN '+cmd, args) ])
+        return self.cursor.execute(cmd, args)
+
+    def __iter__(self):
+        return iter(self.cursor)
+
+    def __getattr__(self, name):
+        return getattr(self.cursor, name)
+
+def truth_position(truthset):
+    """Position of first expected mutation, to look up in query checks"""
+    muts = truthset.data.get('mutation')
+    return muts[0]['position'] if muts else None
+
+def check_query_plans(dbh, truthset, checks=QUERY_PLAN_CHECKS):
+    """Check hot queries use one of their expected indexes.  Returns list 
+    of (query name, query plan) for queries that do not."""
+    problems = []
+    for name, func, indexes in checks:
+        if isinstance(indexes, str):
+            indexes = (indexes,)
+        cursor = PlanCursor(dbh.cursor())
+        func(cursor, truthset)
+        plan = cursor.plans
+        if not [ d for d in plan for i in indexes if i+' ' in d+' ' ]:
+            problems.append((name, '; '.join(plan)))
+    return problems
+
 def save_variants(cursor, dbtable, data, fields, is_expected=0):
     flist = ['id',]+ fields[:]
     if not 'is_expected' in flist: 
@@ -500,13 +1022,33 @@ def get_cnvs(cursor, gene=None, debug=False):
     results = results_as_dict(cursor)
     return results
 
+def strip_change_prefix(change, prefix):
+    """Return CDS or AA change without 'c.' or 'p.' prefix, as HGVS and
+    protein are saved in the db.  None if there is no change."""
+    if not change or change in ('NA', '.', '-'):
+        return None
+    return re.sub(r'^{}\.'.format(prefix), '', change)
+
 def save_sample_mutation(cursor, sample_id, d, fields, debug=False):
     mut = get_mutation(cursor, d['gene'], d['position'], d['ref'], d['var'])
     if debug: print "\nd{}\nmut {}".format(d, mut)
+    # report has CDS Change and AA Change; truth files have HGVS, protein
+    hgvs = d.get('HGVS') or strip_change_prefix(d.get('CDS_Change'), 'c')
+    protein = d.get('protein') or strip_change_prefix(d.get('AA_Change'), 
+                                                      'p')
     if not mut: # mutation not in db, so save
-        save_variants(cursor, 'mutation', [d,], fields)
+        row = dict(d)
+        row['HGVS'] = hgvs
+        row['protein'] = protein
+        save_variants(cursor, 'mutation', [row,], fields)
         mut = get_mutation(cursor, d['gene'], d['position'], d['ref'], 
                            d['var'], debug=debug)
+    elif (hgvs and not mut['HGVS']) or (protein and not mut['protein']):
+        # saved from a report before HGVS and protein were filled in
+        cursor.execute("UPDATE mutation SET HGVS=COALESCE(HGVS,?), "+\
+                       "protein=COALESCE(protein,?), last_modified=? "+\
+                       "WHERE id=?", [hgvs, protein, current_time(), 
+                       mut['id']])
     ins_sql = 'INSERT INTO sample_mutation (sample_id, mutation_id, vaf, '+\
               'vaf_status, last_modified) VALUES (?,?,?,?,?)'
     vals = [ d[f] if f in d else None for f in ('VAF%', 'status') ]
@@ -606,6 +1148,129 @@ def get_all_sample_cnvs(cursor):
     results = results_as_dict(cursor)
     return results
 
+# Sample-level columns needed from sample_<vartype> tables for spreadsheets
+SAMPLE_VARIANT_COLUMNS = {
+    'mutation': ['vaf',],
+    'fusion': [],
+    'cnv': ['mean_z',],
+}
+
+def iter_all_sample_variants(cursor, vartype, fields, exclude_status='FAIL'):
+    """Stream rows of sample variants for vartype as dicts.  Only the given
+    variant fields plus is_expected, variant id, sample name and sample-level
+    values are selected.  Samples with exclude_status are filtered out and 
+    rows are ordered by variant id in the db, not in python."""
+    columns = [ 'm.'+f for f in fields if f!='is_expected' ]
+    columns += ['m.is_expected', 'v.{}_id'.format(vartype), 's.sample_name']
+    columns += [ 'v.'+f for f in SAMPLE_VARIANT_COLUMNS[vartype] ]
+    cmd = "SELECT {1} FROM sample_{0} v JOIN {0} m ON v.{0}_id=m.id".format(
+              vartype, ', '.join(columns)) +\
+          " JOIN sample s ON v.sample_id=s.id WHERE s.sample_status IS NOT ?"+\
+          " ORDER BY v.{}_id, s.run_name, s.sample_name".format(vartype)
+    cursor.execute(cmd, [exclude_status,])
+    names = [ d[0] for d in cursor.description ]
+    for row in cursor:
+        yield dict(zip(names, row))
+
+VAF_HISTORY_FIELDS = ['gene', 'chr', 'position', 'ref', 'var', 'HGVS', 
+                      'protein', 'is_expected']
+
+def get_vaf_history(cursor, gene=None, position=None, hgvs=None, 
+                    protein=None, include_failed=False):
+    """Return VAF over time for mutations matching all the given values.
+    hgvs and protein may be given with or without the 'c.' and 'p.' prefix.
+
+    Returns a list of dicts, one per mutation, with the mutation fields and
+       'series': list of dicts with run_name, sample_name, sample_status
+                 and vaf, ordered by run
+       'stats': dict with num_detected, num_samples, detection, mean_vaf,
+                stddev_vaf, min_vaf and max_vaf over samples with the
+                mutation.  Computed in the db."""
+    where = []
+    args = []
+    if gene:
+        where.append("gene=?")
+        args.append(gene)
+    if position:
+        where.append("position=?")
+        args.append(int(position))
+    if hgvs:
+        where.append("HGVS=?")
+        args.append(strip_change_prefix(hgvs, 'c'))
+    if protein:
+        where.append("protein=?")
+        args.append(strip_change_prefix(protein, 'p'))
+    if not where:
+        return []
+    cmd = "SELECT id, {} FROM mutation WHERE {} ORDER BY gene, position".\
+          format(', '.join(VAF_HISTORY_FIELDS), ' AND '.join(where))
+    cursor.execute(cmd, args)
+    columns = [ d[0] for d in cursor.description ]
+    mutations = [ dict(zip(columns, row)) for row in cursor.fetchall() ]
+    if not mutations:
+        return []
+    byid = dict([ (d['id'], d) for d in mutations ])
+    idlist = ','.join(['?']*len(byid))
+    exclude_status = None if include_failed else 'FAIL'
+    cursor.execute("SELECT COUNT(*) FROM sample WHERE num_mutations>0 "+\
+                   "AND sample_status IS NOT ?", [exclude_status,])
+    num_samples = cursor.fetchone()[0]
+    cmd = "SELECT sm.mutation_id, COUNT(sm.vaf), AVG(sm.vaf), "+\
+          "MIN(sm.vaf), MAX(sm.vaf), SUM(sm.vaf*sm.vaf) "+\
+          "FROM sample_mutation sm JOIN sample s ON sm.sample_id=s.id "+\
+          "WHERE sm.mutation_id IN ({}) AND s.sample_status IS NOT ? ".\
+          format(idlist)+"GROUP BY sm.mutation_id"
+    cursor.execute(cmd, byid.keys()+[exclude_status,])
+    for d in mutations:
+        d['series'] = []
+        d['stats'] = {'num_detected':0, 'num_samples':num_samples, 
+                      'detection':0.0, 'mean_vaf':None, 'stddev_vaf':None,
+                      'min_vaf':None, 'max_vaf':None}
+    for (mut_id, num, mean, vmin, vmax, sumsq) in cursor:
+        stats = byid[mut_id]['stats']
+        stats.update({'num_detected':num, 'mean_vaf':mean, 
+                      'min_vaf':vmin, 'max_vaf':vmax})
+        if num_samples:
+            stats['detection'] = float(num)/num_samples
+        if num > 1: # sample standard deviation, same as Excel STDEV
+            var = max(sumsq - num*mean*mean, 0.0)/(num-1)
+            stats['stddev_vaf'] = math.sqrt(var)
+    cmd = "SELECT sm.mutation_id, s.run_name, s.sample_name, "+\
+          "s.sample_status, sm.vaf FROM sample_mutation sm "+\
+          "JOIN sample s ON sm.sample_id=s.id "+\
+          "WHERE sm.mutation_id IN ({}) AND s.sample_status IS NOT ? ".\
+          format(idlist)+"ORDER BY sm.mutation_id, s.run_name, s.sample_name"
+    cursor.execute(cmd, byid.keys()+[exclude_status,])
+    for (mut_id, run_name, sample_name, status, vaf) in cursor:
+        byid[mut_id]['series'].append({'run_name':run_name, 
+            'sample_name':sample_name, 'sample_status':status, 'vaf':vaf})
+    for d in mutations:
+        del d['id']
+    return mutations
+
+def format_vaf_history(history, outformat='tsv'):
+    """Format results of get_vaf_history as tsv or json string.  A control
+    column is added if results have a 'control' key."""
+    if outformat=='json':
+        return json.dumps(history, indent=2, sort_keys=True)+"\n"
+    statfields = ['num_detected', 'num_samples', 'detection', 'mean_vaf',
+                  'stddev_vaf', 'min_vaf', 'max_vaf']
+    seriesfields = ['run_name', 'sample_name', 'sample_status', 'vaf']
+    fields = VAF_HISTORY_FIELDS + statfields + seriesfields
+    has_control = [ d for d in history if 'control' in d ]
+    if has_control:
+        fields.insert(0, 'control')
+    lines = ["\t".join(fields)]
+    for d in history:
+        vals = [d.get('control'),] if has_control else []
+        vals += [ d[f] for f in VAF_HISTORY_FIELDS ]
+        vals += [ d['stats'][f] for f in statfields ]
+        for point in d['series']:
+            row = vals + [ point[f] for f in seriesfields ]
+            lines.append("\t".join(['' if v is None else str(v) \
+                                     for v in row]))
+    return "\n".join(lines)+"\n"
+
 #-----------------------------------------------------------------------------
 
 def mut_key(d):
@@ -668,11 +1333,13 @@ class TruthSet:
         columns.remove('id')
         columns.remove('is_expected')
         columns.remove('last_modified')
+        if 'change_seq' in columns:
+            columns.remove('change_seq')
         return data, datadict, columns
 
-    def db_summary(self):
+    def db_summary(self, cursor=None):
         msgs = [self.name+self.ctrl_version_tag+'\n',]
-        cursor = self.cursor
+        cursor = cursor or self.cursor
         cursor.execute('SELECT COUNT(*)' +\
             ', (SELECT COUNT(*) FROM sample WHERE sample_status=?)'*2 +\
             ' FROM sample', ['PASS', 'FAIL'])
@@ -829,7 +1496,7 @@ class VariantSet:
                     for d in vdata:
                         save_sample_mutation(cursor, sample['id'], d, fields)
             update_sample_counts(cursor, sample['id'])
-            self.dbh.commit()
+            commit_db(self.dbh)
         vafs = get_sample_mutations(cursor, sample['id'])
         sys.stdout.write('    Have {} mutations for sample {}:{} in db.\n'.\
                          format(len(vafs), runname, sampname))
@@ -837,39 +1504,40 @@ class VariantSet:
         return 1
 
 
-def check_db(ctrl):
-    sys.stdout.write("\n{}: checking db\n".format(ctrl))
-    dbfile = REFS[ctrl]['SQLITEDB']
+def check_db(context):
+    refs = context.refs
+    sys.stdout.write("\n{}: checking db\n".format(context.ctrl))
+    dbfile = refs['SQLITEDB']
     is_new_db = not os.path.exists(dbfile)
     dbh = connect_db(dbfile)
     cursor = dbh.cursor()
     msgs = []
     if is_new_db:
-        add_schema(dbh, REFS[ctrl]['SCHEMAFILE'])
+        add_schema(dbh, refs['SCHEMAFILE'])
         msgs.append("  Saving truths\n")
-        tinfo = parse_truths(REFS[ctrl]['TRUTHFILE'], mut_key)
+        tinfo = parse_truths(refs['TRUTHFILE'], mut_key)
         sys.stdout.write("    {} mutations\n".format(len(tinfo['data'])))
         save_variants(cursor, 'mutation', tinfo['data'], tinfo['fields'])
-        dbh.commit()
+        commit_db(dbh)
         cursor.execute('SELECT COUNT(*) FROM mutation')
         msgs.append("    {} rows inserted into {}\n".format(
                     cursor.fetchone()[0], 'mutation'))
-        if 'FUSIONFILE' in REFS[ctrl]:
-            finfo = parse_truths(REFS[ctrl]['FUSIONFILE'], fusion_key)
+        if 'FUSIONFILE' in refs:
+            finfo = parse_truths(refs['FUSIONFILE'], fusion_key)
             sys.stdout.write("    {} fusions\n".format(len(finfo['data'])))
             save_variants(cursor, 'fusion', finfo['data'], finfo['fields'])
-            dbh.commit()
+            commit_db(dbh)
             cursor.execute('SELECT COUNT(*) FROM fusion')
             msgs.append("    {} rows inserted into {}\n".format(
                     cursor.fetchone()[0], 'fusion'))
             tinfo['fusion_data'] = finfo['data']
             tinfo['fusion_fields'] = finfo['fields']
             tinfo['fusion_datadict'] = finfo['datadict']
-        if 'CNVFILE' in REFS[ctrl]:
-            cinfo = parse_truths(REFS[ctrl]['CNVFILE'], cnv_key)
+        if 'CNVFILE' in refs:
+            cinfo = parse_truths(refs['CNVFILE'], cnv_key)
             sys.stdout.write("    {} CNVs\n".format(len(cinfo['data'])))
             save_variants(cursor, 'cnv', cinfo['data'], cinfo['fields'])
-            dbh.commit()
+            commit_db(dbh)
             cursor.execute('SELECT COUNT(*) FROM cnv')
             msgs.append("    {} rows inserted into {}\n".format(
                     cursor.fetchone()[0], 'cnv'))
@@ -881,30 +1549,286 @@ def check_db(ctrl):
 #        msgs = db_summary(cursor)
         sys.stdout.write(''.join(msgs))
         sys.stdout.flush()
+    migrate_db(dbh)
+    context.dbh = dbh
     return dbh
 
+TRUTH_FILES = [ ('mutation', 'TRUTHFILE', mut_key), 
+                ('fusion', 'FUSIONFILE', fusion_key),
+                ('cnv', 'CNVFILE', cnv_key), ]
+
+def same_db_value(dbval, val):
+    """Compare a db value with a value read from a tab file"""
+    if dbval is None:
+        return val in (None, '')
+    if isinstance(dbval, (int, long, float)):
+        try:
+            return float(val)==dbval
+        except (TypeError, ValueError):
+            return False
+    return unicode(dbval)==val
+
+def diff_truths(cursor, vartype, tinfo):
+    """Compare parsed truth file with variants in db.  Returns lists of
+    rows to insert, rows to update (truth fields changed) and (is_expected,
+    id) flips for variants no longer in the truth file."""
+    cursor.execute("SELECT * FROM {}".format(vartype))
+    dbcolumns = [ d[0] for d in cursor.description ]
+    create_dkey = dict((v, k) for v, f, k in TRUTH_FILES)[vartype]
+    dbrows = {}
+    for d in results_as_dict(cursor):
+        dbrows[create_dkey(d)] = d
+    fields = [ f for f in tinfo['fields'] if f in dbcolumns ]
+    unknown = [ f for f in tinfo['fields'] if f not in dbcolumns ]
+    if unknown:
+        sys.stderr.write("  WARNING: ignoring {} truth fields not in db: {}\n"\
+                         .format(vartype, ', '.join(unknown)))
+    inserts = []
+    updates = []
+    for dkey, d in tinfo['datadict'].items():
+        # same default as save_variants
+        if not d.get('is_expected'):
+            d['is_expected'] = 0
+        if dkey not in dbrows:
+            inserts.append(d)
+            continue
+        dbrow = dbrows[dkey]
+        if not all([ same_db_value(dbrow[f], d[f]) for f in fields ]) or \
+           not same_db_value(dbrow['is_expected'], d['is_expected']):
+            d['id'] = dbrow['id']
+            d['was_expected'] = dbrow['is_expected']
+            updates.append(d)
+    flips = [ (0, d['id']) for dkey, d in dbrows.items() if d['is_expected'] \
+              and dkey not in tinfo['datadict'] ]
+    return fields, inserts, updates, flips
+
+def recount_samples(cursor, vartype, timestamp, all_samples=False):
+    """Recount missing and other variants of vartype for samples that have
+    variants modified at timestamp, or all samples if the set of expected
+    variants changed.  Returns number of samples updated."""
+    cmd = """UPDATE sample SET 
+          num_{0}s_missing=(SELECT COUNT(*) FROM {0} v WHERE v.is_expected=1
+              AND v.id NOT IN (SELECT sv.{0}_id FROM sample_{0} sv 
+              WHERE sv.sample_id=sample.id)),
+          num_{0}s_other=(SELECT COUNT(*) FROM {0} v, sample_{0} sv
+              WHERE v.id=sv.{0}_id AND v.is_expected=0 
+              AND sv.sample_id=sample.id),
+          last_modified=?""".format(vartype)
+    args = [timestamp,]
+    if not all_samples:
+        cmd += """ WHERE id IN (SELECT sv.sample_id FROM sample_{0} sv, {0} v
+              WHERE v.id=sv.{0}_id AND v.last_modified=?)""".format(vartype)
+        args.append(timestamp)
+    cursor.execute(cmd, args)
+    return cursor.rowcount
+
+def reload_truths(dbh, refs):
+    """Update truths in an existing db from the truth files in refs.  Only
+    new or changed truths are written and variants dropped from the truth
+    files are flipped to not expected, all in one transaction.  Counts are
+    then recomputed for the samples affected.  Returns list of messages."""
+    cursor = dbh.cursor()
+    timestamp = current_time()
+    msgs = []
+    try:
+        for vartype, ftype, create_dkey in TRUTH_FILES:
+            if ftype not in refs:
+                continue
+            tinfo = parse_truths(refs[ftype], create_dkey)
+            fields, inserts, updates, flips = diff_truths(cursor, vartype, 
+                                                          tinfo)
+            flist = fields + [ f for f in ('is_expected',) if f not in fields ]
+            if inserts:
+                cmd = "INSERT INTO {} ({}, last_modified) VALUES ({}?)".format(
+                      vartype, ','.join(flist), '?,'*len(flist))
+                cursor.executemany(cmd, [ [ d.get(f) for f in flist ]+\
+                                   [timestamp,] for d in inserts ])
+            if updates:
+                cmd = "UPDATE {} SET {}, last_modified=? WHERE id=?".format(
+                      vartype, ', '.join([ f+'=?' for f in flist ]))
+                cursor.executemany(cmd, [ [ d.get(f) for f in flist ]+\
+                                   [timestamp, d['id']] for d in updates ])
+            if flips:
+                cmd = "UPDATE {} SET is_expected=?, last_modified=?".format(
+                      vartype)+" WHERE id=?"
+                cursor.executemany(cmd, [ (v, timestamp, i) for v, i in flips ])
+            msgs.append("    {}s: {} inserted, {} updated, {} no longer "\
+                        "expected\n".format(vartype, len(inserts), 
+                        len(updates), len(flips)))
+            if not (inserts or updates or flips):
+                continue
+            # missing counts of all samples depend on the expected set
+            expected_changed = bool(inserts or flips) or any([ 
+                not same_db_value(d['was_expected'], d['is_expected']) 
+                for d in updates ])
+            numsamples = recount_samples(cursor, vartype, timestamp, 
+                                         expected_changed)
+            msgs.append("      recounted {} samples\n".format(numsamples))
+        commit_db(dbh)
+    except Exception:
+        dbh.rollback()
+        raise
+    return msgs
+
+def reload_control_truths(context, ctrl_version):
+    """--reload-truths: update truths for one control, then regenerate its
+    spreadsheet.  Returns messages."""
+    msgs = ["{}: reloading truths\n".format(context.ctrl),]
+    check_db(context)
+    msgs.extend(reload_truths(context.dbh, context.refs))
+    context.truthset = TruthSet(context.ctrl, context.dbh, ctrl_version)
+    update_control_spreadsheet(context)
+    close_db(readonly_db(context.dbh))
+    close_db(context.dbh)
+    return msgs
+
+def open_control_session(context, ctrl_version):
+    """Open db and load truth set for one control.  Returns db summary."""
+    check_db(context)
+    context.truthset = TruthSet(context.ctrl, context.dbh, ctrl_version)
+    return context.truthset.db_summary()
+
+def update_control_spreadsheet(context):
+    # read from a readonly connection so saving data is not held up
+    return generate_excel_spreadsheet(context.ctrl, readonly_db(context.dbh),
+               context.truthset.fields, context.refs['SPREADSHEET'])
+
+
+#----export.py----------------------------------------------------------------
+
+EXPORT_STATE_FILE = 'export_state.json'
+
+def export_state(outdir):
+    """Return dict of export state, keyed by table, of dicts with the 
+    latest change_seq exported"""
+    statefile = os.path.join(outdir, EXPORT_STATE_FILE)
+    if not os.path.isfile(statefile):
+        return {}
+    with open(statefile, 'r') as fh:
+        return json.load(fh)
+
+def save_export_state(outdir, state):
+    statefile = os.path.join(outdir, EXPORT_STATE_FILE)
+    with open(statefile+'.tmp', 'w') as ofh:
+        json.dump(state, ofh, indent=2, sort_keys=True)
+    replace_file(statefile+'.tmp', statefile)
+
+def write_export_file(outfile, columns, rows, outformat):
+    """Write rows as a parquet file or, if outformat is csv, a csv file"""
+    if outformat=='parquet':
+        coldata = [ [ row[i] for row in rows ] for i in range(len(columns)) ]
+        table = pyarrow.Table.from_arrays(
+                    [ pyarrow.array(c) for c in coldata ], columns)
+        pyarrow.parquet.write_table(table, outfile)
+    else:
+        with open(outfile, 'wb') as ofh:
+            writer = csv.writer(ofh)
+            writer.writerow(columns)
+            for row in rows:
+                writer.writerow([ v.encode('utf-8') if isinstance(v, unicode) \
+                                  else v for v in row ])
+
+def export_tables(dbh, tables, outdir, outformat=None, full=False):
+    """Export db tables to outdir as columnar files, one folder per table
+    and one file per export: outdir/<table>/<table>-<datetime>.<format>
+
+    Only rows with change_seq later than the last export (saved in
+    outdir/EXPORT_STATE_FILE) are written unless full is True.  Rows that
+    are updated get a new change_seq and are exported again, so readers
+    should keep the row with the highest change_seq per key.  Deleted rows
+    are not tracked.
+
+    outformat is parquet (needs pyarrow) or csv.  Default is parquet if 
+    pyarrow is installed.  Returns dict of num rows written by table."""
+    if not outformat:
+        outformat = 'parquet' if pyarrow else 'csv'
+    elif outformat=='parquet' and not pyarrow:
+        sys.stdout.write("  WARNING: pyarrow not installed. Writing csv\n")
+        outformat = 'csv'
+    if not os.path.isdir(outdir):
+        os.makedirs(outdir)
+    state = {} if full else export_state(outdir)
+    stamp = datetime.datetime.now().strftime("%Y%m%d-%H%M%S")
+    cursor = dbh.cursor()
+    numrows = {}
+    for table in tables:
+        cmd = "SELECT * FROM {}".format(table)
+        args = []
+        # state saved before change_seq has last_modified values; those
+        # tables are exported in full once
+        if isinstance(state.get(table), dict):
+            cmd += " WHERE change_seq>?"
+            args.append(state[table]['change_seq'])
+        cursor.execute(cmd+" ORDER BY change_seq", args)
+        columns = [ d[0] for d in cursor.description ]
+        rows = cursor.fetchall()
+        numrows[table] = len(rows)
+        sys.stdout.write("  {}: {} rows\n".format(table, len(rows)))
+        if not rows:
+            continue
+        tabledir = os.path.join(outdir, table)
+        if not os.path.isdir(tabledir):
+            os.makedirs(tabledir)
+        outfile = os.path.join(tabledir, "{}-{}.{}".format(table, stamp,
+                               outformat))
+        write_export_file(outfile, columns, rows, outformat)
+        i_seq = columns.index('change_seq')
+        state[table] = {'change_seq': max([ r[i_seq] for r in rows ])}
+    save_export_state(outdir, state)
+    sys.stdout.flush()
+    return numrows
 
 #----spreadsheet.py-----------------------------------------------------------
 
+def build_vaf_matrix(numrows, numcols, rows, cols, vals):
+    """Return numrows x numcols float array with vals at (rows, cols) and
+    NaN elsewhere"""
+    vafs = np.full((numrows, numcols), np.nan)
+    if vals:
+        vafs[rows, cols] = np.array(vals, dtype=float)
+    return vafs
+
 def mutation_sheet_data(ctrl, dbh, samples, tfields):
-    allmuts = get_all_sample_mutations(dbh.cursor())
+    """Compile mutation sheet data from one pass over the db.  For each of
+    horizon, expected and not_expected, data[expecttype] maps the sort key
+    to the mutation fields and data['vafs'][expecttype] holds the sorted 
+    keys and their VAF matrix (variants x samples['good'])."""
+    # failed samples are skipped in db query
+    allmuts = iter_all_sample_variants(dbh.cursor(), 'mutation', tfields)
     data = { 'title': ctrl+' mutations', 
              'hiderows': [0, ],
-             'horizon':defaultdict(dict), 
-             'expected':defaultdict(dict), 
-             'not_expected':defaultdict(dict) }
+             'horizon':{}, 
+             'expected':{}, 
+             'not_expected':{},
+             'vafs':{} }
+    colidx = dict((s, j) for j, s in enumerate(samples['good']))
+    rowidx = dict((t, {}) for t in ('horizon', 'expected', 'not_expected'))
+    cells = dict((t, ([], [], [])) for t in rowidx)
     for d in allmuts:
-        if not d['sample_status']=='FAIL': # skip failed samples
-            if d['horizon'] and d['is_expected']:
-                vdict = data['horizon']
-                dkey = int(d['mutation_id']) # sort by order in db
-            elif d['is_expected']:
-                vdict = data['expected']
-                dkey = int(d['mutation_id']) # sort by order in db
-            else:
-                vdict = data['not_expected']
-                dkey = mut_key(d) # sort by gene, position
-            vdict[dkey][d['sample_name']] = d
+        if d['horizon'] and d['is_expected']:
+            expecttype = 'horizon'
+            dkey = int(d['mutation_id']) # sort by order in db
+        elif d['is_expected']:
+            expecttype = 'expected'
+            dkey = int(d['mutation_id']) # sort by order in db
+        else:
+            expecttype = 'not_expected'
+            dkey = mut_key(d) # sort by gene, position
+        if dkey not in data[expecttype]:
+            data[expecttype][dkey] = d
+            rowidx[expecttype][dkey] = len(rowidx[expecttype])
+        col = colidx.get(d['sample_name'])
+        if col is not None:
+            rows, cols, vals = cells[expecttype]
+            rows.append(rowidx[expecttype][dkey])
+            cols.append(col)
+            vals.append(d['vaf'])
+    for expecttype in rowidx:
+        rowkeys = sorted(data[expecttype])
+        vafs = build_vaf_matrix(len(rowkeys), len(colidx), 
+                                *cells[expecttype])
+        order = [ rowidx[expecttype][k] for k in rowkeys ]
+        data['vafs'][expecttype] = (rowkeys, vafs[order])
     numexpected = len(data['expected']) + len(data['horizon'])
     data['header'] = [ "# This spreadsheet is automatically generated." +\
            " Any edits will be lost in future versions.",
@@ -918,26 +1842,28 @@ def mutation_sheet_data(ctrl, dbh, samples, tfields):
     return data
 
 def fusion_sheet_data(ctrl, dbh, samples, tfields):
-    allfusions = get_all_sample_fusions(dbh.cursor())
-    if not allfusions:
-        return None
+    # failed samples are skipped in db query
+    allfusions = iter_all_sample_variants(dbh.cursor(), 'fusion', tfields)
     data = { 'title': ctrl+' fusions',
              'hiderows': [0, ],
              'expected':defaultdict(dict), 
              'horizon':defaultdict(dict), 
              'not_expected':defaultdict(dict) }
+    numrows = 0
     for d in allfusions:
-        if not d['sample_status']=='FAIL':
-            if d['horizon'] and d['is_expected']:
-                vdict = data['horizon']
-                dkey = int(d['fusion_id']) # sort by order in db
-            elif d['is_expected']:
-                vdict = data['expected']
-                dkey = int(d['fusion_id']) # sort by order in db
-            else:
-                vdict = data['not_expected']
-                dkey = int(d['fusion_id']) # sort by order in db
-            vdict[dkey][d['sample_name']] = d
+        numrows += 1
+        if d.get('horizon') and d['is_expected']:
+            vdict = data['horizon']
+            dkey = int(d['fusion_id']) # sort by order in db
+        elif d['is_expected']:
+            vdict = data['expected']
+            dkey = int(d['fusion_id']) # sort by order in db
+        else:
+            vdict = data['not_expected']
+            dkey = int(d['fusion_id']) # sort by order in db
+        vdict[dkey][d['sample_name']] = d
+    if not numrows:
+        return None
     numexpected = len(data['expected']) + len(data['horizon'])
     data['header'] = [ "# This spreadsheet is automatically generated." +\
            " Any edits will be lost in future versions.",
@@ -949,26 +1875,28 @@ def fusion_sheet_data(ctrl, dbh, samples, tfields):
     return data
 
 def cnv_sheet_data(ctrl, dbh, samples, tfields):
-    allcnvs = get_all_sample_cnvs(dbh.cursor())
-    if not allcnvs:
-        return None
+    # failed samples are skipped in db query
+    allcnvs = iter_all_sample_variants(dbh.cursor(), 'cnv', tfields)
     data = { 'title': ctrl+' CNVs',
              'hiderows': [0, ],
              'expected':defaultdict(dict), 
              'horizon':defaultdict(dict), 
              'not_expected':defaultdict(dict) }
+    numrows = 0
     for d in allcnvs:
-        if not d['sample_status']=='FAIL':
-            if d['HorizonCopies'] and d['is_expected']:
-                vdict = data['horizon']
-                dkey = int(d['cnv_id']) # sort by order in db
-            elif d['is_expected']:
-                vdict = data['expected']
-                dkey = int(d['cnv_id']) # sort by order in db
-            else:
-                vdict = data['not_expected']
-                dkey = int(d['cnv_id']) # sort by order in db
-            vdict[dkey][d['sample_name']] = d
+        numrows += 1
+        if d['HorizonCopies'] and d['is_expected']:
+            vdict = data['horizon']
+            dkey = int(d['cnv_id']) # sort by order in db
+        elif d['is_expected']:
+            vdict = data['expected']
+            dkey = int(d['cnv_id']) # sort by order in db
+        else:
+            vdict = data['not_expected']
+            dkey = int(d['cnv_id']) # sort by order in db
+        vdict[dkey][d['sample_name']] = d
+    if not numrows:
+        return None
     numexpected = len(data['expected']) + len(data['horizon'])
     data['header'] = [ "# This spreadsheet is automatically generated." +\
            " Any edits will be lost in future versions.", 
@@ -1025,18 +1953,18 @@ def add_formats_to_workbook(workbook):
                                        'border': 1, 'border_color':'#CDCDCD'})
     return wbformat
 
-def add_avg_stddev_columns(worksheet, rownum, colavg, colstd, mutdat,
+def add_avg_stddev_columns(worksheet, rownum, colavg, colstd, numdetected,
                            runrange, expecttype):
     if expecttype!='not_expected':
         worksheet.write_array_formula(rownum, colavg, rownum, colavg,
                     '{'+'=AVERAGE(IF(ISBLANK({0}),0,{0}))'.format(
                     runrange)+'}')
-        if len(mutdat)>1:
+        if numdetected>1:
             worksheet.write_array_formula(rownum, colstd, rownum, colstd,
                     '{'+'=STDEV(IF(ISBLANK({0}),0,{0}))'.format(runrange)+'}')
     else:
         worksheet.write(rownum, colavg, '=AVERAGE({})'.format(runrange))
-        if len(mutdat)>1:
+        if numdetected>1:
             worksheet.write(rownum, colstd, '=STDEV({})'.format(runrange))
 
  
@@ -1083,26 +2011,25 @@ def add_mutation_sheet_excel(workbook, wbformat, samples, data,
                  wbformat['gray_perc']
       if expecttype=='not_expected':
           percformat=wbformat['dkgray_perc']
-      for sortkey in sorted(data[expecttype]):
+      rowkeys, vafs = data['vafs'][expecttype]
+      numdetected = np.count_nonzero(~np.isnan(vafs), axis=1)
+      # blank cells for absent samples, written in bulk per row
+      vafrows = np.where(np.isnan(vafs), None, vafs).tolist()
+      for sortkey, vafrow, numdet in zip(rowkeys, vafrows, numdetected):
         numvariants += 1
         rownum += 1
-        vdat = [ data[expecttype][sortkey][sample] if sample \
-               in data[expecttype][sortkey] else None \
-               for sample in samples['good'] ] 
-        vdat2 = [ d for d in vdat if d ] # dicts with data only
+        mutinfo = data[expecttype][sortkey]
         for colnum, f in enumerate(data['fields']):
-            v = vdat2[0][f] if f in vdat2[0] else ''
+            v = mutinfo[f] if f in mutinfo else ''
             if colnum == i_position: # format as number
                 worksheet.write_number(rownum, colnum, v)
             else:
                 worksheet.write(rownum, colnum, v)
         skipcalc = len(calc_fields)
-        for i, d in enumerate(vdat):
-            if d: worksheet.write_number(rownum, colnum+i+skipcalc+1, 
-                                         float(d['vaf']))
+        worksheet.write_row(rownum, colnum+skipcalc+1, vafrow)
         runrange = "{1}{0}:{2}{0}".format(rownum+1, runcolxl_s, runcolxl_e)
         add_avg_stddev_columns(worksheet, rownum, i_col_avg, i_col_std,
-                               vdat2, runrange, expecttype)
+                               numdet, runrange, expecttype)
         colnum += skipcalc
         worksheet.write(rownum, colnum, '=COUNT({})/{}'.format(runrange, 
                         len(samples['good'])), percformat)
@@ -1246,7 +2173,7 @@ def add_cnv_sheet_excel(workbook, wbformat, samples, data, fieldfunc=None):
                                          float(d['mean_z']))
         runrange = "{1}{0}:{2}{0}".format(rownum+1, runcolxl_s, runcolxl_e)
         add_avg_stddev_columns(worksheet, rownum, i_col_avg, i_col_std,
-                               vdat2, runrange, expecttype)
+                               len(vdat2), runrange, expecttype)
         colnum += skipcalc
         worksheet.write(rownum, colnum, '=COUNT({})/{}'.format(runrange, 
                         len(samples['good'])), percformat)
@@ -1269,18 +2196,83 @@ def add_cnv_sheet_excel(workbook, wbformat, samples, data, fieldfunc=None):
     return {'num_runs':numruns, 'num_samples':numsamples, 
             'num_variants':numvariants}
 
-def generate_excel_spreadsheet(ctrl, dbh, tfields, outfile):
+def sheet_stamps(dbh, tfields):
+    """Return a cheap stamp of the db state each sheet is built from
+
+    A sheet can only change if rows were added or removed (count) or 
+    rewritten (last_modified) in the sample, variant or sample-variant 
+    tables it reads, or if the layout (VERSION, truth fields) changed.
+    """
+    cursor = dbh.cursor()
+    cursor.execute("SELECT COUNT(*), MAX(last_modified) FROM sample")
+    samplestate = tuple(cursor.fetchone())
+    stamps = {}
+    for vartype in VARTYPES:
+        state = [VERSION, tfields[vartype], samplestate]
+        for table in (vartype, 'sample_'+vartype):
+            cursor.execute("SELECT COUNT(*), MAX(last_modified) FROM "+table)
+            state.append(tuple(cursor.fetchone()))
+        stamps[vartype] = hashlib.md5(repr(state)).hexdigest()
+    return stamps
+
+def sheet_content_hash(samples, data):
+    """Hash of everything written to a sheet, ignoring db timestamps"""
+    content = json.dumps([samples, data], sort_keys=True, 
+                         default=lambda v: v.tolist() \
+                         if isinstance(v, np.ndarray) else str(v))
+    return hashlib.md5(content).hexdigest()
+
+def sheet_state_file(outfile):
+    return os.path.splitext(outfile)[0]+'.sheets.json'
+
+def read_sheet_state(outfile):
+    """Return stamps, content hashes and counts saved with the spreadsheet"""
+    statefile = sheet_state_file(outfile)
+    if not os.path.isfile(outfile) or not os.path.isfile(statefile):
+        return {}
+    try:
+        with open(statefile, 'r') as fh:
+            return json.load(fh)
+    except ValueError:
+        return {}
+
+def save_sheet_state(outfile, state):
+    statefile = sheet_state_file(outfile)
+    with open(statefile+'.tmp', 'w') as fh:
+        json.dump(state, fh, indent=1, sort_keys=True)
+    replace_file(statefile+'.tmp', statefile)
+
+def generate_excel_spreadsheet(ctrl, dbh, tfields, outfile, force=False):
+    """Write the control spreadsheet, skipped if no sheet content changed
+
+    The db stamps are checked first so an untouched db costs a few queries.
+    Otherwise the sheet data is compiled and its content hash compared to
+    the last build, so re-saving identical reports does not rewrite the 
+    file.  xlsxwriter can only write whole workbooks, so all sheets are 
+    rewritten if any changed.  Returns dict of counts by vartype, each with
+    'seconds' spent on the sheet and 'changed' set if its content changed.
+    """
     compile_sheet_data = { 'mutation': mutation_sheet_data,
                            'fusion': fusion_sheet_data, 
                            'cnv': cnv_sheet_data, }
     add_sheet_excel = { 'mutation': add_mutation_sheet_excel, 
                         'fusion': add_fusion_sheet_excel, 
                         'cnv': add_cnv_sheet_excel, }
-    sys.stdout.write("\nCreating {} Excel file:\n{}\n".format(ctrl, outfile))
-    workbook = xlsxwriter.Workbook(outfile)
-    wbformat = add_formats_to_workbook(workbook)
-    nums = {}
+    state = read_sheet_state(outfile)
+    if force:
+        state = {}
+    oldnums = state.get('nums', {})
+    stamps = sheet_stamps(dbh, tfields)
+    if state.get('stamps')==stamps:
+        sys.stdout.write("\n{} Excel file up to date:\n{}\n".format(ctrl, 
+                         outfile))
+        for vartype in oldnums:
+            oldnums[vartype].update({ 'seconds': 0, 'changed': False })
+        return oldnums
+    sheets = []
+    hashes = {}
     for vartype in VARTYPES:
+        starttime = time.time()
         all_samples = get_samples(dbh.cursor(), vartype=vartype)
         samples = { 'failed': [], 'good': [], 'runs': [] }
         for d in sorted(all_samples, reverse=True, key=lambda d: \
@@ -1291,9 +2283,31 @@ def generate_excel_spreadsheet(ctrl, dbh, tfields, outfile):
                 samples['good'].append(d['sample_name'])
                 samples['runs'].append(d['run_name'])
         data = compile_sheet_data[vartype](ctrl, dbh, samples, tfields[vartype])
+        hashes[vartype] = sheet_content_hash(samples, data)
+        sheets.append((vartype, samples, data, time.time()-starttime))
+    if state.get('hashes')==hashes:
+        sys.stdout.write("\n{} Excel file content unchanged:\n{}\n".format(
+                         ctrl, outfile))
+        for vartype in oldnums:
+            oldnums[vartype].update({ 'seconds': 0, 'changed': False })
+        state['stamps'] = stamps
+        save_sheet_state(outfile, state)
+        return oldnums
+    sys.stdout.write("\nCreating {} Excel file:\n{}\n".format(ctrl, outfile))
+    workbook = xlsxwriter.Workbook(outfile)
+    wbformat = add_formats_to_workbook(workbook)
+    nums = {}
+    for vartype, samples, data, seconds in sheets:
+        starttime = time.time()
         if data and (data.get('horizon') or data.get('expected')):
             nums[vartype] = add_sheet_excel[vartype](workbook, wbformat, 
                             samples, data, fieldfunc=field2reportfield) 
+            nums[vartype]['seconds'] = seconds + time.time() - starttime
+            nums[vartype]['changed'] = \
+                state.get('hashes', {}).get(vartype)!=hashes[vartype]
+            sys.stdout.write("  {} sheet: {:.2f}s{}\n".format(vartype, 
+                nums[vartype]['seconds'], 
+                '' if nums[vartype]['changed'] else ' (unchanged)'))
 #    if data.get('fusion') and (data['fusion'].get('expected') or data['fusion'].get('horizon')):
 #        nums = add_fusion_sheet_excel(workbook, wbformat, samples['fusion'], 
 #               data['fusion'], fieldfunc=field2reportfield) 
@@ -1303,32 +2317,35 @@ def generate_excel_spreadsheet(ctrl, dbh, tfields, outfile):
     workbook.close()
     wb = openpyxl.load_workbook(outfile)
     wb.save(outfile)
+    save_sheet_state(outfile, { 'stamps': stamps, 'hashes': hashes, 
+                                'nums': nums })
     sys.stdout.flush()
     return nums
 
 #----gui.py-------------------------------------------------------------------
 
 class StampQC_App(wx.App):
-    def __init__(self, dbhs, tinfo, controls, msg=None, **kwargs):
-        self.dbh = dbhs
-        self.tinfo = tinfo
+    def __init__(self, contexts, controls, args, msg=None, **kwargs):
+        self.contexts = contexts
         self.controls = controls
+        self.args = args
         self.msg = msg
         wx.App.__init__(self, kwargs)
 
     def OnInit(self):
-        self.frame = StampFrame(self.dbh, self.tinfo, self.controls, 
+        self.frame = StampFrame(self.contexts, self.controls, self.args,
                                 msg=self.msg)
         self.frame.Show()
         self.SetTopWindow(self.frame)
         return True
 
 class StampFrame(wx.Frame):
-    def __init__(self, dbh, tinfo, controls, msg=None):
+    def __init__(self, contexts, controls, args, msg=None):
         wx.Frame.__init__(self, None, title="HEME QC v{}".format(VERSION), 
                           size=(550,525))
-        self.dbh = dbh
-        self.tinfo = tinfo
+        self.contexts = contexts
+        self.tinfo = dict([ (ctrl, contexts[ctrl].truthset) \
+                            for ctrl in contexts ])
         self.controls = controls
         ctrl_version = get_ctrl_version()
         self.ctrl_version = ' (HEME{})'.format(' '+ctrl_version) if \
@@ -1350,6 +2367,7 @@ class StampFrame(wx.Frame):
         save_tooltip = "Update spreadsheet and database with data entered.\n"
         button_save.SetToolTip(wx.ToolTip(save_tooltip))
         self.Bind(wx.EVT_BUTTON, self.UpdateSpreadsheetAndDB, button_save)
+        self.button_save = button_save
         button_quit = wx.Button(panel, -1, "Quit", style=wx.BU_EXACTFIT)
         self.Bind(wx.EVT_BUTTON, self.OnCloseMe, button_quit)
         self.Bind(wx.EVT_CLOSE, self.OnCloseWindow)
@@ -1368,7 +2386,7 @@ class StampFrame(wx.Frame):
         sizer.Add(button_sizer, 0, wx.ALL|wx.EXPAND, 5)
         panel.SetSizer(sizer)
 
-        dt = VariantReportDrop(self.text, self.notebook, self.tinfo)
+        dt = VariantReportDrop(self.text, self.notebook, self.tinfo, args)
         self.text.SetDropTarget(dt)
 
     def PrintReports(self, event):
@@ -1401,6 +2419,10 @@ class StampFrame(wx.Frame):
 
     def UpdateSpreadsheetAndDB(self, event):
         self.text.AppendText("\nUpdating data:\n")
+        # Read entries in GUI thread; db and spreadsheet work for each
+        # control is then done concurrently in per-control workers, started
+        # from a background thread so the window stays responsive.
+        tosave = defaultdict(list)
         if not self.notebook.results:
             self.text.AppendText("  No data to save to db.\n")
         else:
@@ -1421,43 +2443,81 @@ class StampFrame(wx.Frame):
                     continue
                 statusnum = entries['status'].GetSelection()
                 status = entries['status'].GetString(statusnum)
-                saved = info['vinfo'].save2db(status, force=True)
-                if saved:
-                    self.text.AppendText(
-                        "        Saved {} data to db.\n".format(sample))
-                else:
-                    self.text.AppendText(
-                        "        {} not saved to db.\n".format(sample))
-            summ = []
-            for ctrl in self.controls:
-#                summ.append(ctrl+self.ctrl_version+'\n')
-                summ.extend(self.tinfo[ctrl].db_summary())
-                summ.append('\n')
-            self.notebook.tabOne.ChangeMessage(''.join(summ))
+                tosave[info['control']].append((info, status))
+        contexts = dict([ (ctrl, self.contexts[ctrl]) \
+                          for ctrl in self.controls ])
+        self.button_save.Disable()
+        worker = threading.Thread(target=self._update_controls,
+                                  args=(contexts, tosave))
+        worker.daemon = True
+        worker.start()
+
+    def _update_controls(self, contexts, tosave):
+        """Worker thread: update controls, then show results in GUI thread"""
         try:
-            for ctrl in self.controls:
-                self.text.AppendText("  Updating {} spreadsheet.\n".format(
-                                     ctrl))
-                res = generate_excel_spreadsheet(ctrl, self.dbh[ctrl], 
-                  self.tinfo[ctrl].fields, REFS[ctrl]['SPREADSHEET'])
-                counts = []
-                for vartype, nums in sorted(res.items()):
-                    counts.append("{} {}s".format(nums['num_variants'], vartype))
-                numruns = res['mutation']['num_runs'] if res.get('mutation') else 0
-                msg = "      {} ({} runs)".format(ctrl, numruns)
-                if counts:
-                    msg += ': '+', '.join(counts)
-                self.text.AppendText(msg+'\n')
-#                if res['failedsamples']:
-#                    self.text.AppendText(
-#                         "      Failed samples not included: {}\n".format(
-#                         ", ".join(sorted(res['failedsamples']))))
+            results = run_per_control(self._update_control, contexts, tosave)
         except Exception, e:
-            self.text.AppendText("    ERROR: {}{}\n\n".format(
-                                       type(e).__name__, e))
-            raise
+            results = dict([ (ctrl, {'msgs': [], 'summary': [], 'error': e})\
+                             for ctrl in self.controls ])
+        wx.CallAfter(self.ShowUpdateResults, results)
+
+    def ShowUpdateResults(self, results):
+        self.button_save.Enable()
+        summ = []
+        error = None
+        for ctrl in self.controls:
+            res = results[ctrl]
+            self.text.AppendText(''.join(res['msgs']))
+            summ.extend(res['summary'])
+            summ.append('\n')
+            if res['error'] and not error:
+                error = res['error']
+        if self.notebook.results:
+            self.notebook.tabOne.ChangeMessage(''.join(summ))
+        if error:
+            raise error
         self.text.AppendText("\n")
 
+    def _update_control(self, context, tosave):
+        """Save samples to db and update spreadsheet for one control.
+        Runs in a worker thread, so messages are returned for the GUI
+        thread to display."""
+        ctrl = context.ctrl
+        res = {'msgs': [], 'summary': [], 'error': None}
+        msgs = res['msgs']
+        for info, status in tosave.get(ctrl, []):
+            sample = info['vinfo'].sample
+            saved = info['vinfo'].save2db(status, force=True)
+            if saved:
+                msgs.append("        Saved {} data to db.\n".format(sample))
+            else:
+                msgs.append("        {} not saved to db.\n".format(sample))
+        res['summary'] = context.truthset.db_summary()
+        try:
+            msgs.append("  Updating {} spreadsheet.\n".format(ctrl))
+            sheetnums = update_control_spreadsheet(context)
+            counts = []
+            rebuilt = []
+            for vartype, nums in sorted(sheetnums.items()):
+                counts.append("{} {}s".format(nums['num_variants'], vartype))
+                if nums.get('changed'):
+                    rebuilt.append("{} {:.1f}s".format(vartype, 
+                                                       nums['seconds']))
+            numruns = sheetnums['mutation']['num_runs'] \
+                      if sheetnums.get('mutation') else 0
+            msg = "      {} ({} runs)".format(ctrl, numruns)
+            if counts:
+                msg += ': '+', '.join(counts)
+            if rebuilt:
+                msg += '\n      rebuilt sheets: '+', '.join(rebuilt)
+            else:
+                msg += '\n      spreadsheet unchanged, not rebuilt'
+            msgs.append(msg+'\n')
+        except Exception, e:
+            msgs.append("    ERROR: {}{}\n\n".format(type(e).__name__, e))
+            res['error'] = e
+        return res
+
     def OnCloseMe(self, event):
         self.Close(True)
 
@@ -1465,42 +2525,44 @@ class StampFrame(wx.Frame):
         self.Destroy()
         
 class VariantReportDrop(wx.FileDropTarget):
-    def __init__(self, window, notebook, tinfo):
+    def __init__(self, window, notebook, tinfo, args):
         wx.FileDropTarget.__init__(self)
         self.window = window
         self.notebook = notebook
         self.tinfo = tinfo
+        self.args = args
         self.num_samples = 0
+        # not persisted: a new session needs the tabs to set sample status
+        self.runmanifest = RunManifest(REPORT_SUFFIXES.values(), 
+                                       persist=False)
 
     def OnDropFiles(self, x, y, filenames):
-        oldfiles = self.notebook.ReportFiles()
-        oldsamples2files, oldbadfiles = group_files_by_sample(oldfiles)
-        samples2files, badfiles = group_files_by_sample(filenames)
+        oldsamples2files = self.notebook.ReportSamples()
+        manifest = group_files_by_sample(filenames, self.args.include,
+                                         self.args.exclude)
+        samples2files = manifest.samples
+        badfiles = manifest.badfiles
         if badfiles:
             for badfile in badfiles:
                self.window.AppendText("ERROR: "+badfile+'\n')
                self.window.AppendText("    Bad input.  This does not look" +\
                    " like an HD701 variant report.\n")
+        for sample, paths in sorted(manifest.ambiguous.items()):
+            self.window.AppendText("ERROR: {} found in more than one "\
+                                   "folder, skipped:\n".format(sample))
+            self.window.AppendText(''.join([ "    {}\n".format(f) \
+                                             for f in paths ]))
         # check if sample data needs updating with new files or
         # skip if sample is only previously dropped files
         for sample, d in sorted(samples2files.items()):
             if sample in oldsamples2files:
-                updatesample = False
                 old_d = oldsamples2files[sample]
-                for reporttype in ('v_report', 'f_report', 'c_report'):
-                    if reporttype in d:
-                        if reporttype in old_d and \
-                           old_d[reporttype]==d[reporttype]:
-                            continue
-                        else:
-                            updatesample=True
-                    elif reporttype in old_d:
+                for reporttype in REPORT_SUFFIXES.values():
+                    if reporttype not in d and reporttype in old_d:
                         d[reporttype] = old_d[reporttype]
-                        updatesample = True
-                if updatesample:
-                    self.notebook.DeletePageSample(sample)
-                else: # no need to update
-                    continue
+                if self.runmanifest.is_current(sample, d):
+                    continue # same files, not changed since shown
+                self.notebook.DeletePageSample(sample)
             run = d['run']
             ctrl = d['control']
             self.num_samples += 1
@@ -1530,6 +2592,7 @@ class VariantReportDrop(wx.FileDropTarget):
                              'status': summary['Status'],})
                 title = "{}: {}".format(self.num_samples, sample)
                 self.notebook.AddResultsTab(info, title=title)
+                self.runmanifest.record(sample, d)
 #            except KeyError, e:
 #                self.window.AppendText("    ERROR:  Bad file format.  " +\
 #                    "This does not look like a variant or fusion report.\n")
@@ -1577,17 +2640,16 @@ class StampNotebook(fnb.FlatNotebook):
         self.results.insert(selected, res)
         self.entries.insert(selected, ent)
 
-    def ReportFiles(self):
-        """Return list of variant and fusion report files in notebook"""
-        reports = []
+    def ReportSamples(self):
+        """Return dict of report files in notebook by sample and type"""
+        reports = {}
         for info in self.results:
             if not info: continue
-            if 'file' in info:
-                reports.append(info['file'])
-            if 'fusion_file' in info:
-                reports.append(info['fusion_file'])
-            if 'cnv_file' in info:
-                reports.append(info['cnv_file'])
+            d = reports.setdefault(info['sample'], {})
+            for key, reporttype in (('file', 'v_report'), 
+                  ('fusion_file', 'f_report'), ('cnv_file', 'c_report')):
+                if key in info:
+                    d[reporttype] = info[key]
         return reports
 
     def DeletePageSample(self, sample):
@@ -1667,18 +2729,172 @@ class TabPanel_Results(wx.Panel):
         panelSizer.Add(infoSizer, 0, wx.ALIGN_LEFT)
         self.SetSizer(panelSizer)
 
-def run_gui(dbhs, tinfo, msgs, controls):
+def run_gui(contexts, msgs, controls, args):
     if not controls:
         sys.stderr.write("\nERROR: no control data found\n")
         time.sleep(5) 
         sys.exit()
     msg = '\n'.join(msgs)
-    app = StampQC_App(dbhs, tinfo, controls, msg=msg)
+    app = StampQC_App(contexts, controls, args, msg=msg)
     app.MainLoop()
 
 #-----------------------------------------------------------------------------
 
+def check_control_reports(context, samples2files, args):
+    """Check, save and print reports for samples of one control, then
+    regenerate the control's spreadsheet and close its db."""
+    ctrl = context.ctrl
+    for sample, d in sorted(samples2files.items()):
+        if d['control']!=ctrl:
+            continue
+        run = d['run']
+        sys.stdout.write("\nSample: {}\tRun: {}\tControl: {}\n".format(
+                         sample, run, ctrl))
+        vinfo = VariantSet(sample, run, ctrl, context.truthset)
+        outfile = {}
+        if 'v_report' in d:
+            outfile['mutation'] = d['v_report'].replace('.txt','')+\
+                                  ".checked.txt"
+            vinfo.add_variants(d['v_report'], 'mutation')
+        if 'f_report' in d:
+            outfile['fusion'] = d['f_report'].replace('.txt','')+\
+                                  ".checked.txt"
+            vinfo.add_variants(d['f_report'], 'fusion')
+        if 'c_report' in d:
+            outfile['cnv'] = d['c_report'].replace('.txt','')+\
+                                  ".checked.txt"
+            vinfo.add_variants(d['c_report'], 'cnv')
+        summary = vinfo.compare_variants(args.status)
+        vinfo.save2db(summary['Status'], args.force)
+        if args.text:
+            if args.outdir:
+                for vartype in outfile:
+                    outfile[vartype] = os.path.join(args.outdir, 
+                                       os.path.basename(outfile[vartype]))
+            print_checked_file(vinfo, context.truthset, outfile)
+    nums = update_control_spreadsheet(context)
+    close_db(readonly_db(context.dbh))
+    close_db(context.dbh)
+    return nums
+
+def run_query_command(argv):
+    """heme_qc.py query: print VAF history of a variant from the dbs"""
+    descr = "Print VAF of a variant across runs from the HD701 db."
+    parser = ArgumentParser(prog=os.path.basename(sys.argv[0])+' query',
+                            description=descr)
+    parser.add_argument("-g", "--gene", help="Gene name")
+    parser.add_argument("-p", "--position", type=int, help="Position")
+    parser.add_argument("--hgvs", help="CDS change, ie. c.1799T>A")
+    parser.add_argument("--protein", help="AA change, ie. p.V600E")
+    parser.add_argument("-f", "--format", default='tsv', dest='outformat',
+                        choices=['tsv', 'json'], 
+                        help="Output format (default: tsv)")
+    parser.add_argument("-o", "--outfile", help="Output file (default: stdout)")
+    parser.add_argument("--include-failed", default=False, 
+                        action='store_true', help="Include FAIL samples")
+    parser.add_argument("--resultdir", default=DEFAULT_RESULTS_DIR,
+                        help="Directory to find databases")
+    args = parser.parse_args(argv)
+    if not (args.gene or args.position or args.hgvs or args.protein):
+        parser.error("need at least one of --gene, --position, --hgvs, "+\
+                     "--protein")
+    # messages go to stderr to keep them out of the results
+    contexts = check_existing_dbs(args.resultdir, get_ctrl_version(), 
+                                  log=sys.stderr)
+    if not contexts:
+        sys.exit("\nERROR: no control data found\n")
+    out = open(args.outfile, 'w') if args.outfile else sys.stdout
+    history = []
+    for ctrl in sorted(contexts):
+        dbh = connect_db(contexts[ctrl].refs['SQLITEDB'], readonly=True,
+                         log=sys.stderr)
+        results = get_vaf_history(dbh.cursor(), args.gene, args.position, 
+                      args.hgvs, args.protein, args.include_failed)
+        for d in results:
+            d['control'] = ctrl
+        history.extend(results)
+    sys.stderr.write("{} matching variants\n".format(len(history)))
+    out.write(format_vaf_history(history, args.outformat))
+    if args.outfile:
+        out.close()
+
+def check_control_queries(context, ctrl_version):
+    """Check one control's hot queries use their indexes.  Returns list of
+    (query name, query plan) for queries that do not."""
+    open_control_session(context, ctrl_version)
+    dbh = readonly_db(context.dbh)
+    problems = check_query_plans(dbh, context.truthset)
+    for name, plan in problems:
+        sys.stdout.write("  {}: {} query not using index: {}\n".format(
+                         context.ctrl, name, plan))
+    sys.stdout.write("{}: {} of {} queries use their indexes\n".format(
+                     context.ctrl, len(QUERY_PLAN_CHECKS)-len(problems),
+                     len(QUERY_PLAN_CHECKS)))
+    close_db(dbh)
+    close_db(context.dbh)
+    return problems
+
+def run_check_command(argv):
+    """heme_qc.py check: check hot queries use their indexes"""
+    descr = "Check that the main QC db queries use their indexes."
+    parser = ArgumentParser(prog=os.path.basename(sys.argv[0])+' check',
+                            description=descr)
+    parser.add_argument("--resultdir", default=DEFAULT_RESULTS_DIR,
+                        help="Directory to find databases")
+    parser.add_argument("--resourcedir", default=DEFAULT_RESOURCE_DIR,
+                        help="Directory to find truth files, and db schema")
+    args = parser.parse_args(argv)
+    ctrl_version = get_ctrl_version()
+    contexts = check_references(args.resourcedir, args.resultdir, ctrl_version)
+    contexts = check_existing_dbs(args.resultdir, ctrl_version, contexts)
+    if not contexts:
+        sys.exit("\nERROR: no control data found\n")
+    results = run_per_control(check_control_queries, contexts, ctrl_version)
+    return 1 if [ c for c in results if results[c] ] else 0
+
+def export_control_db(context, outdir, outformat, full):
+    """Export one control's db to a subdirectory of outdir"""
+    outdir = os.path.join(outdir, context.ctrl)
+    sys.stdout.write("\n{}: exporting db to {}\n".format(context.ctrl, 
+                     outdir))
+    dbh = connect_db(context.refs['SQLITEDB'])
+    migrate_db(dbh)
+    return export_tables(readonly_db(dbh), EXPORT_TABLES, outdir, outformat,
+                         full)
+
+def run_export_command(argv):
+    """heme_qc.py export: write db tables as parquet or csv files"""
+    descr = "Export QC db tables as parquet (or csv) files.  Only rows"
+    descr += " modified since the last export are written unless --full."
+    parser = ArgumentParser(prog=os.path.basename(sys.argv[0])+' export',
+                            description=descr)
+    parser.add_argument("-o", "--outdir", 
+                        default=os.path.join(DEFAULT_RESULTS_DIR, 'export'),
+                        help="Directory to save files.  Each control is"+\
+                             " saved in a subdirectory.")
+    parser.add_argument("-f", "--format", dest='outformat', 
+                        choices=['parquet', 'csv'], help="Output format "+\
+                        "(default: parquet if pyarrow installed, else csv)")
+    parser.add_argument("--full", default=False, action='store_true',
+                        help="Export all rows, not only new rows")
+    parser.add_argument("--resultdir", default=DEFAULT_RESULTS_DIR,
+                        help="Directory to find databases")
+    args = parser.parse_args(argv)
+    contexts = check_existing_dbs(args.resultdir, get_ctrl_version())
+    if not contexts:
+        sys.exit("\nERROR: no control data found\n")
+    run_per_control(export_control_db, contexts, args.outdir, 
+                    args.outformat, args.full)
+
 if __name__=='__main__':
+    if len(sys.argv) > 1 and sys.argv[1]=='query':
+        run_query_command(sys.argv[2:])
+        sys.exit()
+    elif len(sys.argv) > 1 and sys.argv[1]=='export':
+        run_export_command(sys.argv[2:])
+        sys.exit()
+    elif len(sys.argv) > 1 and sys.argv[1]=='check':
+        sys.exit(run_check_command(sys.argv[2:]))
     descr = "Checks Heme-STAMP HD701 variant for expected variants."
     descr += " Creates new annotated variant report(s) in the same"
     descr += " directory unless otherwise specified."
@@ -1703,59 +2919,54 @@ if __name__=='__main__':
     parser.add_argument("--safe", default=True, action='store_false',
                         dest="force",
                         help="Do not overwrite existing data in db.")
+    parser.add_argument("--include", action='append',
+                        help="Of files found in folders, only use those"+\
+                             " whose name matches this glob (can be"+\
+                             " repeated).  Files given as arguments are"+\
+                             " always used.")
+    parser.add_argument("--exclude", action='append',
+                        help="Skip files and subfolders matching this glob"+\
+                             " (can be repeated)")
+    parser.add_argument("--reload-truths", default=False, action='store_true',
+                        help="Update truths in the db from the truth files "+\
+                             "in resourcedir and recount samples")
 
     args = parser.parse_args()
-    dbh = {}
-    tinfo = {}
     msgs = []
     # Use STAMP V2 data if V2 in name of script
     ctrl_version = get_ctrl_version()
     sys.stdout.write("Control version: {}\n".format(ctrl_version))
-    check_references(args.resourcedir, args.resultdir, ctrl_version)
-    controls = check_existing_dbs(args.resultdir, ctrl_version)
+    if args.reload_truths:
+        # truth file paths are only kept if the db is not checked first
+        contexts = check_references(args.resourcedir, args.resultdir, 
+                                    ctrl_version)
+        if not contexts:
+            sys.exit("\nERROR: no truth files found\n")
+        results = run_per_control(reload_control_truths, contexts, 
+                                  ctrl_version)
+        for ctrl in sorted(results):
+            sys.stdout.write(''.join(results[ctrl]))
+        sys.exit()
+    contexts = check_references(args.resourcedir, args.resultdir, ctrl_version)
+    contexts = check_existing_dbs(args.resultdir, ctrl_version, contexts)
+    controls = sorted(contexts)
+    summaries = run_per_control(open_control_session, contexts, ctrl_version)
     for ctrl in controls:
-        dbh[ctrl] = check_db(ctrl)
-        tinfo[ctrl] = TruthSet(ctrl, dbh[ctrl], ctrl_version)
-        summary = tinfo[ctrl].db_summary()
-        msgs.append(''.join(summary))
+        msgs.append(''.join(summaries[ctrl]))
     sys.stdout.write('\n'.join(msgs))
     if len(args.reports)==0:
-        run_gui(dbh, tinfo, msgs, controls)
+        run_gui(contexts, msgs, controls, args)
     else:
         if not controls:
             sys.exit("\nERROR: no control data found\n")
-        samples = {}
-        samples2files, badfiles = group_files_by_sample(args.reports)
-        outfile = {}
+        manifest = group_files_by_sample(args.reports, args.include, 
+                                         args.exclude)
+        write_ambiguous(manifest)
+        samples2files = manifest.samples
         for sample, d in sorted(samples2files.items()):
-            run = d['run']
-            ctrl = d['control']
-            sys.stdout.write("\nSample: {}\tRun: {}\tControl: {}\n".format(
-                             sample, run, ctrl))
-            vinfo = VariantSet(sample, run, ctrl, tinfo[ctrl])
-            if 'v_report' in d:
-                outfile['mutation'] = d['v_report'].replace('.txt','')+\
-                                      ".checked.txt"
-                vinfo.add_variants(d['v_report'], 'mutation')
-            if 'f_report' in d:
-                outfile['fusion'] = d['f_report'].replace('.txt','')+\
-                                      ".checked.txt"
-                vinfo.add_variants(d['f_report'], 'fusion')
-            if 'c_report' in d:
-                outfile['cnv'] = d['c_report'].replace('.txt','')+\
-                                      ".checked.txt"
-                vinfo.add_variants(d['c_report'], 'cnv')
-            summary = vinfo.compare_variants(args.status)
-            vinfo.save2db(summary['Status'], args.force)
-            if args.text:
-                if args.outdir:
-                    for vartype in outfile:
-                        outfile[vartype] = os.path.join(args.outdir, 
-                                           os.path.basename(outfile[vartype]))
-                print_checked_file(vinfo, tinfo[ctrl], outfile)
-        for ctrl in controls:
-            generate_excel_spreadsheet(ctrl, dbh[ctrl], tinfo[ctrl].fields, 
-                                       REFS[ctrl]['SPREADSHEET'])
-            dbh[ctrl].close()
+            if not d['control'] in contexts:
+                sys.stderr.write("No truth data for {} in db. ".format(
+                                 d['control'])+"Skipping {}\n".format(sample))
+        run_per_control(check_control_reports, contexts, samples2files, args)
 
 
@@ -0,0 +1,349 @@
+#!/usr/bin/env python
+
+"""
+Run the Heme-STAMP post-run tools on a run folder:
+
+heme_sample2barcode -- sample2barcode.txt from the Excel coversheet
+heme_water_barcode  -- water barcode counts from barcode_counts.txt
+heme_postprocess    -- formatted variant, depth and fusion reports
+heme_qc             -- HD701 control variant report checks
+
+Each tool runs as its own process once the stages it requires are done,
+so independent stages run at the same time.  A stage whose input files
+and command are unchanged since it last succeeded, and whose output files
+are still as it left them, is not run again.
+"""
+
+import os
+import sys
+import datetime
+import fnmatch
+import hashlib
+import json
+import subprocess
+import time
+from argparse import ArgumentParser
+
+PROGRAM=os.path.basename(sys.argv[0])
+VERSION="0.1"
+BUILD="261019"
+PROGVERSION = "{} v{}".format(PROGRAM, VERSION)
+
+#----common.py----------------------------------------------------------------
+
+def getScriptPath():
+    return os.path.dirname(os.path.realpath(sys.argv[0]))
+
+def datetime_string():
+    dt = datetime.datetime.now().strftime("%Y%m%d-%H%M%S")
+    return dt
+
+def replace_file(src, dst):
+    """Rename src to dst, replacing dst.  os.rename does not replace an
+    existing file on Windows."""
+    if os.name=='nt' and os.path.exists(dst):
+        os.remove(dst)
+    os.rename(src, dst)
+
+TOOLS_DIR = os.path.join(getScriptPath(), os.pardir, os.pardir)
+STATE_FILE = '.heme_run_state.json' # see RunState
+POLL_SECONDS = 0.2
+
+#----stages.py----------------------------------------------------------------
+
+class Stage:
+    """One tool run on a run folder.
+
+    name -- stage name, also used for its log file
+    script -- tool script path
+    patterns -- file name globs of the stage's input files
+    outputs -- file name globs of the stage's output files and dbs
+    requires -- names of stages that must succeed first
+    """
+    def __init__(self, name, script, patterns, outputs=[], requires=[]):
+        self.name = name
+        self.script = script
+        self.patterns = patterns
+        self.outputs = outputs
+        self.requires = requires
+
+    def inputs(self, files):
+        """Return input files of stage from list of files in run folder"""
+        return [ f for f in files if any([ fnmatch.fnmatch(
+                 os.path.basename(f).lower(), p) for p in self.patterns ]) ]
+
+    def command(self, inputs, args):
+        """Return command line running the stage on inputs"""
+        cmd = [ args.python, self.script ]
+        if self.name=='sample2barcode':
+            cmd += ['-o', args.outdir] if args.outdir else []
+        elif self.name=='water_barcode':
+            cmd += ['-s', '-x', '--status', args.status]
+            cmd += ['--datadir', args.water_datadir] if args.water_datadir \
+                   else []
+        elif self.name=='postprocess': # finds its files in the folder,
+            cmd += ['-o', args.outdir] if args.outdir else [] # which keeps
+            cmd += ['-j', str(args.jobs)] # the command line short
+            return cmd + [args.runfolder]
+        elif self.name=='qc':
+            cmd += ['-o', args.outdir] if args.outdir else []
+            cmd += ['-x', '--status', args.status]
+            cmd += ['--resultdir', args.qc_resultdir] if args.qc_resultdir \
+                   else []
+        return cmd + inputs
+
+    def output_dirs(self, inputs, args):
+        """Return folders the stage writes its outputs to"""
+        if self.name=='water_barcode':
+            return [ args.water_datadir or os.path.join(TOOLS_DIR,
+                     'heme_water_barcode', 'data') ]
+        elif self.name=='qc':
+            return [ args.qc_resultdir or os.path.join(TOOLS_DIR, 'heme_qc',
+                     'results') ]
+        elif args.outdir:
+            return [ args.outdir ]
+        return sorted(set([ os.path.dirname(f) for f in inputs ]))
+
+    def find_outputs(self, inputs, args, since):
+        """Return output files of stage modified since time since"""
+        outputs = []
+        for outdir in self.output_dirs(inputs, args):
+            try:
+                names = os.listdir(outdir)
+            except OSError:
+                continue
+            for f in names:
+                if not any([ fnmatch.fnmatch(f.lower(), p) for p in
+                             self.outputs ]):
+                    continue
+                path = os.path.abspath(os.path.join(outdir, f))
+                stat = file_stat(path)
+                if stat and stat[1] >= since:
+                    outputs.append(path)
+        return sorted(outputs)
+
+# Stages run in this order when they can.  None of the tools uses another
+# tool's output, so all stages are independent; requires is where a stage
+# that needs another's output would declare it.
+STAGES = [
+    Stage('sample2barcode', os.path.join(TOOLS_DIR, 'heme_sample2barcode',
+          'heme_sample2barcode.py'), ['*coversheet*.xlsx'],
+          ['sample2barcode*.txt']),
+    Stage('water_barcode', os.path.join(TOOLS_DIR, 'heme_water_barcode',
+          'scripts', 'heme_water_barcode.py'), ['barcode_counts*.txt'],
+          ['heme_water_barcode_counts.db']),
+    Stage('postprocess', os.path.join(TOOLS_DIR, 'heme_postprocess',
+          'scripts', 'heme_postprocess.py'), ['*.variant_report.txt',
+          '*.vcf', '*.vcf.gz', '*.depth_report_indels.txt',
+          '*.depth_report_snvs.txt', '*.fusions.filtered.txt'],
+          ['*.variant_report.xlsx', '*.depth_report_*.xlsx', 
+           '*.gene_coverage.txt', '*.low_coverage_comment.txt',
+           '*.fusions.with_transcripts.txt', '*_accepted.vcf*',
+           '*_rejected.vcf*']),
+    Stage('qc', os.path.join(TOOLS_DIR, 'heme_qc', 'scripts', 'heme_qc.py'),
+          ['*hd*701*.variant_report.txt', '*hd*701*.fusions.filtered.txt',
+           '*hd*701*.cnvs', '*hd*753*.variant_report.txt', 
+           '*hd*753*.fusions.filtered.txt', '*hd*753*.cnvs'],
+          ['hemeqc_*.db']),
+]
+
+# files matching the input patterns above that are tool outputs or are
+# not used by the tools
+OUTPUT_PATTERNS = ['*_accepted.vcf', '*_rejected.vcf', '*_accepted.vcf.gz',
+                   '*_rejected.vcf.gz', '*.nobarcodes.*', '*.unfiltered.vcf*']
+
+def find_run_files(runfolder, skipdirs=[]):
+    """Return sorted files in runfolder and its subfolders, except hidden
+    files and folders and folders in skipdirs"""
+    skipdirs = [ os.path.abspath(d) for d in skipdirs if d ]
+    files = []
+    for dirpath, dirnames, filenames in os.walk(runfolder):
+        dirnames[:] = [ d for d in dirnames if not d.startswith('.') and \
+                        os.path.abspath(os.path.join(dirpath, d)) not in \
+                        skipdirs ]
+        files.extend([ os.path.join(dirpath, f) for f in filenames \
+                       if not f.startswith('.') and not any([
+                       fnmatch.fnmatch(f.lower(), p) for p in
+                       OUTPUT_PATTERNS ]) ])
+    return sorted(files)
+
+def file_stat(path):
+    """Return [size, mtime] of path, or None if it does not exist"""
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None
+    return [st.st_size, st.st_mtime]
+
+def stage_signature(cmd, inputs):
+    """Return hash of stage command and size and mtime of its inputs"""
+    stamps = [ [os.path.abspath(f)]+(file_stat(f) or []) for f in inputs ]
+    return hashlib.md5(json.dumps([cmd, stamps])).hexdigest()
+
+class RunState:
+    """Signature and output files (with their size and mtime) of the last
+    successful run of each stage, saved in STATE_FILE in the run folder"""
+    def __init__(self, runfolder):
+        self.statefile = os.path.join(runfolder, STATE_FILE)
+        self.stages = {}
+        if os.path.isfile(self.statefile):
+            try:
+                with open(self.statefile, 'r') as fh:
+                    self.stages = json.load(fh)
+            except (IOError, ValueError), e:
+                sys.stderr.write("Ignoring {}: {}\n".format(self.statefile, e))
+
+    def is_current(self, name, signature):
+        """True if stage last succeeded with signature and its outputs have
+        not been deleted or changed since, e.g. a db that was reset"""
+        stage = self.stages.get(name, {})
+        if stage.get('signature')!=signature or 'outputs' not in stage:
+            return False
+        return all([ file_stat(f)==stat for f, stat in
+                     stage['outputs'].items() ])
+
+    def record(self, name, signature, seconds, outputs=[]):
+        self.stages[name] = { 'signature': signature, 'seconds': seconds,
+                              'date': datetime_string(),
+                              'outputs': dict([ (f, file_stat(f)) for f in
+                                                outputs ]) }
+
+    def save(self):
+        try:
+            with open(self.statefile+'.tmp', 'w') as fh:
+                json.dump(self.stages, fh, indent=1, sort_keys=True)
+            replace_file(self.statefile+'.tmp', self.statefile)
+        except (IOError, OSError), e:
+            sys.stderr.write("Cannot save {}: {}\n".format(self.statefile, e))
+
+#----scheduler.py-------------------------------------------------------------
+
+def start_stage(stage, cmd, logdir):
+    logfile = os.path.join(logdir, 'heme_run.{}.log'.format(stage.name))
+    logfh = open(logfile, 'w')
+    logfh.write(' '.join(cmd)+'\n\n')
+    logfh.flush()
+    proc = subprocess.Popen(cmd, stdout=logfh, stderr=subprocess.STDOUT)
+    return { 'proc': proc, 'log': logfh, 'start': time.time(),
+             'logfile': logfile, 'stage': stage }
+
+def run_stages(stages, files, state, args, logdir):
+    """Run stages on the run folder files, each as soon as the stages it
+    requires have succeeded.  Returns dict of results by stage name with
+    status (done, cached, no input, failed, skipped), seconds and log."""
+    results = {}
+    pending = list(stages)
+    running = {}
+    names = [ s.name for s in stages ] # other required stages not run
+    while pending or running:
+        for stage in list(pending):
+            requires = [ r for r in stage.requires if r in names ]
+            if [ r for r in requires if r not in results or \
+                 not results[r]['status'] ]:
+                continue
+            pending.remove(stage)
+            result = { 'status': None, 'seconds': 0.0, 'log': None }
+            results[stage.name] = result
+            failed = [ r for r in requires if \
+                       results[r]['status'] not in ('done', 'cached') ]
+            inputs = stage.inputs(files)
+            if failed:
+                result['status'] = 'skipped'
+                continue
+            elif not inputs:
+                result['status'] = 'no input'
+                continue
+            cmd = stage.command(inputs, args)
+            result['signature'] = stage_signature(cmd, inputs)
+            if not args.force and state.is_current(stage.name,
+                                                   result['signature']):
+                result['status'] = 'cached'
+                continue
+            sys.stderr.write("Starting {} ({} files)\n".format(stage.name,
+                             len(inputs)))
+            running[stage.name] = start_stage(stage, cmd, logdir)
+            running[stage.name]['inputs'] = inputs
+            result['log'] = running[stage.name]['logfile']
+        for name, job in running.items():
+            if job['proc'].poll() is None:
+                continue
+            job['log'].close()
+            result = results[name]
+            result['seconds'] = time.time() - job['start']
+            if job['proc'].returncode==0:
+                result['status'] = 'done'
+                # whole seconds, for file systems with coarse mtimes
+                outputs = job['stage'].find_outputs(job['inputs'], args,
+                                                    int(job['start']))
+                state.record(name, result['signature'], result['seconds'],
+                             outputs)
+            else:
+                result['status'] = 'failed'
+            sys.stderr.write("Finished {} in {:.1f}s: {}\n".format(name,
+                             result['seconds'], result['status']))
+            del running[name]
+        if running:
+            time.sleep(POLL_SECONDS)
+    state.save()
+    return results
+
+def write_timing_report(stages, results, seconds):
+    busy = sum([ r['seconds'] for r in results.values() ])
+    sys.stderr.write("\nRun finished in {:.1f}s ".format(seconds) +\
+                     "({:.1f}s of stage time)\n".format(busy))
+    sys.stderr.write("  {:<16s}{:<10s}{:>10s}  {}\n".format('Stage',
+                     'Status', 'Time(s)', 'Log'))
+    for stage in stages:
+        r = results[stage.name]
+        sys.stderr.write("  {:<16s}{:<10s}{:>10.1f}  {}\n".format(stage.name,
+                         r['status'], r['seconds'], r['log'] or ''))
+    sys.stderr.flush()
+
+#-----------------------------------------------------------------------------
+if __name__=='__main__':
+    descr = "Runs heme_sample2barcode, heme_water_barcode, heme_postprocess"
+    descr += " and heme_qc on the files in a run folder."
+    parser = ArgumentParser(description=descr)
+    parser.add_argument("runfolder", help="Heme-STAMP run folder")
+    parser.add_argument("-o", "--outdir",
+                        help="Directory to save output file(s) and logs")
+    parser.add_argument("-j", "--jobs", type=int, default=1,
+                        help="Number of samples heme_postprocess processes "+\
+                             "in parallel (default: 1)")
+    parser.add_argument("-s", "--status", default='PASS',
+                        help="Status for water barcode and QC data "+\
+                             "(default: PASS)")
+    parser.add_argument("--water-datadir",
+                        help="heme_water_barcode database and spreadsheet "+\
+                             "directory (default: the tool's)")
+    parser.add_argument("--qc-resultdir",
+                        help="heme_qc database and spreadsheet directory "+\
+                             "(default: the tool's)")
+    parser.add_argument("--stages",
+                        help="Comma-separated stages to run (default: all)")
+    parser.add_argument("-f", "--force", default=False, action='store_true',
+                        help="Run stages even if inputs are unchanged")
+    parser.add_argument("--python", default=sys.executable,
+                        help="Python interpreter for the tools")
+
+    args = parser.parse_args()
+    if not os.path.isdir(args.runfolder):
+        sys.exit("Run folder {} not found".format(args.runfolder))
+    stages = STAGES
+    if args.stages:
+        names = args.stages.split(',')
+        unknown = [ n for n in names if n not in [ s.name for s in STAGES ] ]
+        if unknown:
+            sys.exit("Unknown stage(s): {}".format(', '.join(unknown)))
+        stages = [ s for s in STAGES if s.name in names ]
+    logdir = args.outdir or args.runfolder
+    if not os.path.isdir(logdir):
+        os.makedirs(logdir)
+    starttime = time.time()
+    files = find_run_files(args.runfolder, [args.outdir])
+    state = RunState(args.runfolder)
+    results = run_stages(stages, files, state, args, logdir)
+    write_timing_report(stages, results, time.time()-starttime)
+    if [ r for r in results.values() if r['status'] in ('failed',
+                                                        'skipped') ]:
+        sys.exit(1)
@@ -8,13 +8,20 @@ Create sample2barcode.txt file from Excel coversheet for Heme-STAMP.
 
 import os
 import sys
+import datetime
+import multiprocessing
 import openpyxl
 import re
+import threading
+import time
 import traceback
+import zipfile
 import wx
 import wx.richtext 
+import xml.etree.cElementTree as ET
 from collections import defaultdict
 from argparse import ArgumentParser
+from StringIO import StringIO
 
 PROGRAM=os.path.basename(__file__)
 VERSION="1.1"
@@ -32,14 +39,257 @@ SAMPLETYPES = [ 'PB',   'NormalPB',
                 'BMA',  'NormalBMA',  
                 'FFPE', 'NormalFFPE', ]
 
+STAMPRUN_PATT = re.compile(
+    r'(?:heme|stamp)\s*[id:\s]*[\s_]*(\d+)([a-z]*)[\s_]*\b', flags=re.I)
+
+#----xlsx.py------------------------------------------------------------------
+
+# .xlsx sheets are read straight from the XML in the zip file, a row at a
+# time, without openpyxl cell objects.  Other files go through openpyxl.
+XLSX_NS = '{http://schemas.openxmlformats.org/spreadsheetml/2006/main}'
+XLSX_REL_NS = \
+    '{http://schemas.openxmlformats.org/officeDocument/2006/relationships}'
+XLSX_PKG_NS = '{http://schemas.openxmlformats.org/package/2006/relationships}'
+
+def is_xlsx_zip(filename):
+    if not zipfile.is_zipfile(filename):
+        return False
+    zf = zipfile.ZipFile(filename)
+    try:
+        return 'xl/workbook.xml' in zf.namelist()
+    finally:
+        zf.close()
+
+def xlsx_sheet_paths(zf):
+    """Return paths of worksheet XML in zip, active sheet first, then the
+    others in workbook order"""
+    workbook = ET.fromstring(zf.read('xl/workbook.xml'))
+    rels = ET.fromstring(zf.read('xl/_rels/workbook.xml.rels'))
+    targets = dict([ (r.get('Id'), r.get('Target')) for r in \
+                     rels.iter(XLSX_PKG_NS+'Relationship') ])
+    paths = []
+    for sheet in workbook.iter(XLSX_NS+'sheet'):
+        target = targets[sheet.get(XLSX_REL_NS+'id')]
+        paths.append(target.lstrip('/') if target.startswith('/') \
+                     else 'xl/'+target)
+    active = 0
+    view = workbook.find(XLSX_NS+'bookViews/'+XLSX_NS+'workbookView')
+    if view is not None:
+        active = int(view.get('activeTab', 0))
+    if active < len(paths):
+        paths.insert(0, paths.pop(active))
+    return paths
+
+def xlsx_text(elem):
+    """Text of shared or inline string element, without phonetic runs"""
+    t = elem.find(XLSX_NS+'t')
+    if t is not None:
+        return t.text or ''
+    return ''.join([ r.findtext(XLSX_NS+'t') or '' for r in \
+                     elem.findall(XLSX_NS+'r') ])
+
+def xlsx_shared_strings(zf):
+    strings = []
+    if 'xl/sharedStrings.xml' not in zf.namelist():
+        return strings
+    for event, elem in ET.iterparse(zf.open('xl/sharedStrings.xml')):
+        if elem.tag == XLSX_NS+'si':
+            strings.append(xlsx_text(elem))
+            elem.clear()
+    return strings
+
+def xlsx_column(ref):
+    """0-based column of cell reference like 'AB12'"""
+    col = 0
+    for ch in ref:
+        if ch.isdigit():
+            break
+        col = col*26 + ord(ch.upper()) - ord('A') + 1
+    return col - 1
+
+XLSX_DATE_FORMATS = ['%Y-%m-%dT%H:%M:%S.%f', '%Y-%m-%dT%H:%M:%S',
+                     '%Y-%m-%dT%H:%M', '%Y-%m-%d', ]
+
+def xlsx_date(v):
+    """datetime of ISO 8601 date cell value, or the value if not parsed"""
+    for fmt in XLSX_DATE_FORMATS:
+        try:
+            return datetime.datetime.strptime(v.rstrip('Z'), fmt)
+        except ValueError:
+            pass
+    return v
+
+def xlsx_value(cell, strings):
+    """Cell value as openpyxl returns it: numbers as int or float, dates
+    as datetime.  Values of other cell types are strings."""
+    ctype = cell.get('t', 'n')
+    if ctype == 'inlineStr':
+        inline = cell.find(XLSX_NS+'is')
+        return xlsx_text(inline) if inline is not None else None
+    v = cell.findtext(XLSX_NS+'v')
+    if v is None:
+        return None
+    elif ctype == 's':
+        return strings[int(v)]
+    elif ctype == 'b':
+        return v == '1'
+    elif ctype == 'd':
+        return xlsx_date(v)
+    elif ctype != 'n':
+        return v
+    elif '.' in v or 'E' in v or 'e' in v:
+        return float(v)
+    return int(v)
+
+def iter_xlsx_rows(zf, path, strings):
+    """Yield list of cell values of each row in worksheet XML"""
+    sheetdata = None
+    for event, elem in ET.iterparse(zf.open(path), events=('start', 'end')):
+        if event == 'start':
+            if elem.tag == XLSX_NS+'sheetData':
+                sheetdata = elem
+            continue
+        if elem.tag != XLSX_NS+'row':
+            continue
+        cells = []
+        for cell in elem.iter(XLSX_NS+'c'):
+            ref = cell.get('r')
+            if ref:
+                cells.extend([None] * (xlsx_column(ref) - len(cells)))
+            cells.append(xlsx_value(cell, strings))
+        yield cells
+        if sheetdata is not None:
+            sheetdata.clear() # drop rows already read
+        else:
+            elem.clear()
+
+def workbook_sheets(workbook):
+    """Return sheets of workbook, active sheet first"""
+    if is_xlsx_zip(workbook):
+        zf = zipfile.ZipFile(workbook)
+        try:
+            return xlsx_sheet_paths(zf)
+        finally:
+            zf.close()
+    wb = openpyxl.load_workbook(workbook, read_only=True)
+    names = wb.sheetnames
+    active = wb.active.title
+    return [active] + [ n for n in names if n != active ]
+
+def iter_sheet_rows(workbook, sheet):
+    """Yield list of cell values, without trailing blanks, of each row of 
+    sheet (from workbook_sheets)"""
+    if is_xlsx_zip(workbook):
+        zf = zipfile.ZipFile(workbook)
+        try:
+            strings = xlsx_shared_strings(zf)
+            for cells in iter_xlsx_rows(zf, sheet, strings):
+                while cells and cells[-1]==None:
+                    cells.pop() # remove trailing blanks
+                yield cells
+        finally:
+            zf.close()
+        return
+    wb = openpyxl.load_workbook(workbook, read_only=True)
+    for row in wb[sheet].iter_rows():
+        cells = [ cell.value for cell in row ]
+        while cells and cells[-1]==None:
+            cells.pop() # remove trailing blanks
+        yield cells
+
+#----names.py-----------------------------------------------------------------
+
+# Name characters replaced before the naming rules
+NAME_REPLACEMENTS = [ (',', '_'), ('(', '_'), (')', ''), ]
+# Entry usually Last, First or Last_First.  Research samples usually 
+# sample_research, so don't split into last, first if '_research'
+NAME_SPLIT_PATT = re.compile(r'[_,]+\s*(?!research)')
+INITIAL_PATT = re.compile(r'([A-Z])[a-z]*')
+SPACE_COMMA_PATT = re.compile(r'[\s,]+')
+# only allow English letters, digits, hyphens and underscores
+NONWORD_PATT = re.compile(r'[^-\w]')
+CONTROL = 'HD701'
+CONTROL_PATT = re.compile(CONTROL, flags=re.I)
+
+class SampleNamer:
+    """Sample names of a run from coversheet Name, lab# and mrn#, with the
+    patterns compiled once, the run number in the control name pattern.
+
+    Rules, first that applies:
+      control name with run number -- Name
+      control name -- HD701_HEME<run>
+      lab# or mrn# -- [SAMPLETYPE_]<last name><first initials>_<lab#>_<mrn#>
+      otherwise -- Name
+    then characters other than letters, digits, - and _ are removed."""
+    def __init__(self, runnum, sampletypes=SAMPLETYPES):
+        self.runnum = runnum
+        self.sampletypes = frozenset(sampletypes)
+        self.control_run_patt = re.compile(r'({}).*{}'.format(CONTROL, 
+                                           runnum), flags=re.I)
+        self.control_name = "{}_HEME{}".format(CONTROL, runnum)
+
+    def sample_name(self, name, lab='', mrn=''):
+        """Return sample name for Name and stripped lab# and mrn# (mrn# ''
+        if not digits)"""
+        for old, new in NAME_REPLACEMENTS:
+            name = name.replace(old, new)
+        if self.control_run_patt.match(name):
+            sample = name
+        # add run num to control name if not already present
+        elif CONTROL_PATT.match(name):
+            sample = self.control_name
+        # Patient samples should have lab# or mrn#
+        elif lab or mrn:
+            # Change name to last name + first initial(s)
+            # Validation samples may start with SAMPLETYPE_
+            names = NAME_SPLIT_PATT.split(name, 1)
+            last = names.pop(0)
+            sampletype = ''
+            if last in self.sampletypes:
+                sampletype = last
+                names = NAME_SPLIT_PATT.split(name, 2)[1:]
+                last = names.pop(0)
+            first = names.pop() if names else ''
+            first = INITIAL_PATT.sub(r'\1', first)
+            name = SPACE_COMMA_PATT.sub('', last+first)
+            if lab and lab in name: 
+                # if lab entry already in name, don't duplicate
+                lab = ''
+            sample = '_'.join((name, lab, mrn))
+            if sampletype:
+                sample = sampletype + '_' + sample
+        else:
+            sample = name
+        # non-ASCII characters are removed, so sample is ASCII
+        return str(NONWORD_PATT.sub('', sample))
+
+    def sample_names(self, records):
+        """Return list of sample names of (Name, lab#, mrn#) records, e.g. 
+        to rename samples of past runs; repeated records are named once"""
+        names = {}
+        samples = []
+        for record in records:
+            if record not in names:
+                names[record] = self.sample_name(*record)
+            samples.append(names[record])
+        return samples
+
 #----classes------------------------------------------------------------------
 
 class STAMPCoversheet():
+    """Coversheet is read a row at a time.  On creation only the rows up
+    to the column names are read, from the first sheet (active sheet 
+    first) that has them; the run number is taken from those rows.  Data 
+    rows are read again when the sample2barcode lines are made."""
     def __init__(self, coversheet, outdir=None, debug=False):
         self.coversheet = coversheet
         self.runnum = None
         self.fields = None
-        self.data = []
+        self.sheet = None
+        self.fieldrow = None
+        self.sample2barcode = None
+        self.duplicates = 0
+        self.warnings = []
         self.outdir = None
         self.outfile = None
         self.debug = debug
@@ -51,90 +301,73 @@ class STAMPCoversheet():
             traceback.print_exc()
 
     def _parse_coversheet(self):
-        stamprun_patt = re.compile(
-            r'(?:heme|stamp)\s*[id:\s]*[\s_]*(\d+)([a-z]*)[\s_]*\b', flags=re.I)
-        wb = openpyxl.load_workbook(self.coversheet, read_only=True)
-        wx = wb.active
-        for row in wx.iter_rows():
-            cells = [ cell.value for cell in row ]
-            while cells and cells[-1]==None:
-                cells.pop() # remove trailing blanks
-            if self.fields and cells:
-                # data lines have both Name and barcode fields
-                d = dict(zip(self.fields, cells))
-                if d.get('Name') and d.get('barcode'):
-                    self.data.append(d)
-            elif 'Name' in cells and 'lab#' in cells and 'mrn#' in cells:
-                # column names
-                self.fields = cells
-            else: 
-                # possible header line with run# info
-                line = "\t".join([str(c) for c in cells]) + "\n"
-                m = stamprun_patt.search(line)
-                if m:
-                    self.runnum = "{:04d}".format(int(m.group(1)))
-                    if m.group(2) and len(m.group(2))<5:
-                        self.runnum += m.group(2)
+        for sheet in workbook_sheets(self.coversheet):
+            runnum = None
+            rows = iter_sheet_rows(self.coversheet, sheet)
+            for i, cells in enumerate(rows):
+                if 'Name' in cells and 'lab#' in cells and 'mrn#' in cells:
+                    # column names
+                    self.fields = cells
+                    self.sheet = sheet
+                    self.fieldrow = i
+                    self.runnum = runnum
+                    break
+                elif cells:
+                    # possible header line with run# info
+                    line = "\t".join([str(c) for c in cells]) + "\n"
+                    m = STAMPRUN_PATT.search(line)
+                    if m:
+                        runnum = "{:04d}".format(int(m.group(1)))
+                        if m.group(2) and len(m.group(2))<5:
+                            runnum += m.group(2)
+            rows.close()
+            if self.fields:
+                break
+
+    def iter_data(self):
+        """Yield dict keyed by field of each data row"""
+        if not self.fields:
+            return
+        rows = iter_sheet_rows(self.coversheet, self.sheet)
+        for i, cells in enumerate(rows):
+            if i <= self.fieldrow or not cells:
+                continue
+            # data lines have both Name and barcode fields
+            d = dict(zip(self.fields, cells))
+            if d.get('Name') and d.get('barcode'):
+                yield d
 
     def format_sample2barcode(self):
-        self.sample2barcode = []
+        """Return list of sample2barcode lines"""
+        self.sample2barcode = list(self.iter_sample2barcode())
+        return self.sample2barcode
+
+    def iter_sample2barcode(self):
+        """Yield sample2barcode lines as coversheet rows are read"""
+        namer = SampleNamer(self.runnum)
         samples_seen = {}
-        for d in self.data:
-            name = d['Name'].replace(',','_').replace('(','_').replace(')','')
+        self.duplicates = 0
+        self.warnings = []
+        for d in self.iter_data():
             lab = str(d['lab#']).strip() if d.get('lab#') else ''
             mrn = str(d['mrn#']).strip() if d.get('mrn#') else ''
             barcode = d['barcode'].strip()
             if not mrn.isdigit():
                 if mrn: 
-                    print "WARNING: MRN not digit '{}'".format(mrn)
+                    self.warnings.append("MRN not digit '{}'".format(mrn))
+                    print "WARNING: " + self.warnings[-1]
                 mrn = ''
-            # Check if control sample
-            ctrl_patt = '(hd701).*{}'.format(self.runnum)
-            if re.match(ctrl_patt, name, flags=re.I):
-                sample = name
-            # add run num to control name if not already present
-            elif re.match('hd701', name, flags=re.I):
-                sample = "HD701_HEME{}".format(self.runnum)
-            # Patient samples should have lab# or mrn#
-            elif lab or mrn: 
-                # Change name to last name + first initial(s)
-                #  * Entry usually Last, First or Last_First
-                #  * Research samples usually sample_research, so don't
-                #    split into last, first if '_research'
-                #  * Validation samples may start with SAMPLETYPE_
-#                names = re.split('[_,]+\s*(?!research)', name.replace('-', ''), 1)
-                names = re.split('[_,]+\s*(?!research)', name, 1)
-                last = names.pop(0)
-                sampletype = ''
-                if last in SAMPLETYPES:
-                    sampletype = last
-                    names = re.split('[_,]+\s*(?!research)', name, 2)[1:]
-                    last = names.pop(0)
-                first = names.pop() if names else ''
-                first = re.sub('([A-Z])[a-z]*', r'\1', first)
-                name = re.sub('[\s,]+', '', last+first)
-                if lab and lab in name: 
-                    # if lab entry already in name, don't duplicate
-                    lab = ''
-                sample = '_'.join([ v.encode('utf-8') for v in (name, lab, mrn)])
-                if sampletype:
-                    sample = "{}_{}".format(sampletype, sample)
-            else:
-                sample = name
-            # remove spaces and non-standard characters
-            # only allow English letters, digits, hyphens and underscores
-            #sample = re.sub(r'[\s\.\x9F-\xFF]', '', sample)
-            sample = re.sub(r'[^-\w]', '', sample)
+            sample = namer.sample_name(d['Name'], lab, mrn)
             # make sure not to have duplicate names
             if sample in samples_seen:
+                self.duplicates += 1
                 samples_seen[sample] += 1
                 sample += '-{}'.format(samples_seen[sample])
             samples_seen[sample] = 1
-            self.sample2barcode.append("{}\t{}".format(sample, barcode))
             if self.debug:
-                print "{:50s}\t{:30s}\t{}".format(sample, name, d['Name'])
+                print "{:50s}\t{}".format(sample, d['Name'])
                 sys.stdout.flush()
-        return self.sample2barcode
+            yield "{}\t{}".format(sample, barcode)
 
     def get_output_filename(self, outdir=None):
         if not outdir:
@@ -150,10 +383,219 @@ class STAMPCoversheet():
     def write_sample2barcode_file(self, outfile=None):
         if not outfile:
             outfile = self.outfile
-        if not self.sample2barcode:
-            self.format_sample2barcode()
+        lines = self.sample2barcode
+        if lines is None:
+            lines = self.iter_sample2barcode()
         with open(outfile, 'w') as ofh:
-            ofh.write("\n".join(self.sample2barcode)+"\n")
+            for line in lines:
+                ofh.write(line+"\n")
+
+#----barcodes.py--------------------------------------------------------------
+
+# barcodes samples must not have (heme_water_barcode BARCODES)
+RESERVED_BARCODES = {'NNNNGTCA':'water',}
+
+def barcode_core(barcode):
+    """Upper case barcode without leading Ns (barcode_counts files have
+    NNNN before the index bases)"""
+    return barcode.strip().upper().lstrip('N')
+
+def hamming(a, b):
+    return len([ 1 for x, y in zip(a, b) if x != y ])
+
+def read_barcode_whitelist(filename):
+    """Return set of barcodes (cores) in first column of whitelist file"""
+    whitelist = set()
+    with open(filename, 'rU') as fh:
+        for line in fh:
+            fields = line.split()
+            if fields and not fields[0].startswith('#'):
+                whitelist.add(barcode_core(fields[0]))
+    return whitelist
+
+class BarcodeChecker:
+    """Checks the barcodes of sample2barcode lines before they are written.
+
+    Errors: barcode of more than one sample, reserved (water) barcode, or
+    barcode not in whitelist (if given).  Warnings: barcodes one base 
+    apart.  Instead of comparing all pairs, each barcode is put in a 
+    bucket for each position with that base masked; barcodes sharing a 
+    bucket differ only at that position.  Reserved barcodes are compared
+    with the same number of bases at the end of each barcode.  If block 
+    is set, files with errors are not written."""
+    def __init__(self, whitelist=None, reserved=RESERVED_BARCODES, 
+                 block=True):
+        self.whitelist = whitelist
+        self.reserved = dict([ (barcode_core(b), name) for b, name in \
+                               reserved.items() ])
+        self.block = block
+
+    def check(self, lines):
+        """Return lists of error and warning messages for lines"""
+        errors = []
+        warnings = []
+        samples = defaultdict(list)
+        for line in lines:
+            sample, barcode = line.split("\t", 1)
+            samples[barcode_core(barcode)].append(sample)
+        buckets = defaultdict(list)
+        for core in sorted(samples):
+            names = ", ".join(samples[core])
+            if len(samples[core]) > 1:
+                errors.append("Barcode {} used by {}".format(core, names))
+            if self.whitelist is not None and core not in self.whitelist:
+                errors.append("Barcode {} of {} not in whitelist".format(
+                              core, names))
+            for rcore, rname in sorted(self.reserved.items()):
+                if len(core) < len(rcore):
+                    continue
+                dist = hamming(core[len(core)-len(rcore):], rcore)
+                if dist == 0:
+                    errors.append("Barcode {} of {} is the {} barcode".format(
+                                  core, names, rname))
+                elif dist == 1:
+                    warnings.append("Barcode {} of {} is one base from the "\
+                                    "{} barcode".format(core, names, rname))
+            for i in range(len(core)):
+                buckets[core[:i]+'.'+core[i+1:]].append(core)
+        for key in sorted(buckets):
+            cores = buckets[key]
+            for i in range(len(cores)):
+                for other in cores[i+1:]:
+                    warnings.append("Barcodes {} of {} and {} of {} are one "\
+                        "base apart".format(cores[i], ", ".join(samples[
+                        cores[i]]), other, ", ".join(samples[other])))
+        return errors, warnings
+
+def barcode_checker(args):
+    """Return BarcodeChecker for command line args"""
+    whitelist = None
+    if args.whitelist:
+        whitelist = read_barcode_whitelist(args.whitelist)
+    return BarcodeChecker(whitelist, block=not args.warn_barcodes)
+
+#----batch.py-----------------------------------------------------------------
+
+def convert_coversheet(coversheet, outdir=None, debug=False, capture=False,
+                       checker=None):
+    """Write sample2barcode file of coversheet, catching errors so other
+    coversheets are still converted.  Barcodes are checked first with
+    checker (default BarcodeChecker()).  If capture is set, messages are 
+    returned in the result instead of written.  Returns dict with 
+    coversheet, recognized, runnum, sample2barcode lines, duplicates,
+    warnings, barcode_errors, barcode_warnings, outfile (None if not 
+    written), error and log."""
+    if checker is None:
+        checker = BarcodeChecker()
+    result = { 'coversheet': coversheet, 'recognized': False, 
+               'runnum': None, 'lines': [], 'duplicates': 0, 'warnings': [],
+               'barcode_errors': [], 'barcode_warnings': [],
+               'outfile': None, 'error': None, 'log': '' }
+    stdout, stderr = sys.stdout, sys.stderr
+    if capture:
+        sys.stdout = sys.stderr = StringIO()
+    try:
+        sys.stdout.write("\nCoversheet {}\n".format(coversheet))
+        s2bdata = STAMPCoversheet(coversheet, outdir=outdir, debug=debug)
+        result['runnum'] = s2bdata.runnum
+        if not s2bdata.fields:
+            sys.stderr.write("  WARNING: Unrecognized format {}\n".\
+            format(coversheet))
+        else:
+            result['recognized'] = True
+            result['lines'] = s2bdata.format_sample2barcode()
+            result['duplicates'] = s2bdata.duplicates
+            result['warnings'] = list(s2bdata.warnings)
+            if not result['lines']:
+                sys.stdout.write("  WARNING: No data {}\n".format(coversheet))
+            else:
+                errors, warnings = checker.check(result['lines'])
+                result['barcode_errors'] = errors
+                result['barcode_warnings'] = warnings
+                result['warnings'] += warnings
+                level = 'ERROR' if checker.block else 'WARNING'
+                for msg in errors:
+                    sys.stdout.write("  {}: {}\n".format(level, msg))
+                for msg in warnings:
+                    sys.stdout.write("  WARNING: {}\n".format(msg))
+                if errors and checker.block:
+                    sys.stdout.write("  Not writing {}: barcode errors\n".\
+                                     format(s2bdata.outfile))
+                else:
+                    result['warnings'] += errors
+                    sys.stdout.write("  Writing {}\n".format(s2bdata.outfile))
+                    s2bdata.write_sample2barcode_file()
+                    result['outfile'] = s2bdata.outfile
+    except (Exception, SystemExit), e:
+        result['error'] = "{}: {}".format(type(e).__name__, e)
+        sys.stderr.write("  ERROR: {}\n".format(result['error']))
+    finally:
+        if capture:
+            result['log'] = sys.stdout.getvalue()
+            sys.stdout, sys.stderr = stdout, stderr
+    return result
+
+def run_coversheet_job(job):
+    coversheet, outdir, debug, checker = job
+    return convert_coversheet(coversheet, outdir, debug, True, checker)
+
+def iter_conversions(coversheets, outdir=None, debug=False, jobs=1,
+                     capture=False, checker=None):
+    """Yield convert_coversheet results in coversheet order.  If jobs>1 or
+    capture is set, coversheets are converted in a pool of jobs processes
+    and their messages are in the results' log instead of written."""
+    if capture or (jobs > 1 and len(coversheets) > 1):
+        pool = multiprocessing.Pool(max(1, min(jobs, len(coversheets))))
+        try:
+            for result in pool.imap(run_coversheet_job, 
+                        [ (c, outdir, debug, checker) for c in coversheets ]):
+                yield result
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        for coversheet in coversheets:
+            yield convert_coversheet(coversheet, outdir, debug, 
+                                     checker=checker)
+
+# statuses of coversheets that need fixing; the exit status is 1 if any
+FAILED_STATUSES = ('ERROR', 'barcode errors')
+
+def result_status(result):
+    if result['error']:
+        return "ERROR"
+    elif not result['recognized']:
+        return "unrecognized"
+    elif result['barcode_errors'] and not result['outfile']:
+        return "barcode errors"
+    elif not result['outfile']:
+        return "no data"
+    return "written"
+
+def write_summary(results, seconds):
+    written = [ r for r in results if r['outfile'] ]
+    sys.stdout.write("\nConverted {} of {} coversheets in {:.1f}s\n".format(
+                     len(written), len(results), seconds))
+    sys.stdout.write("  {:<40s}{:>7s}{:>9s}{:>6s}{:>10s}  {}\n".format(
+                     'Coversheet', 'Run', 'Samples', 'Dups', 'Warnings', 
+                     'Status'))
+    for r in results:
+        sys.stdout.write("  {:<40s}{:>7s}{:>9d}{:>6d}{:>10d}  {}\n".format(
+                         os.path.basename(r['coversheet']), r['runnum'] or '-',
+                         len(r['lines']), r['duplicates'], len(r['warnings']),
+                         result_status(r)))
+    for r in results:
+        if r['error']:
+            sys.stdout.write("  FAILED {}: {}\n".format(r['coversheet'], 
+                                                        r['error']))
+    outfiles = defaultdict(int)
+    for r in written:
+        outfiles[r['outfile']] += 1
+    for outfile in sorted(outfiles):
+        if outfiles[outfile] > 1:
+            sys.stdout.write("  WARNING: {} written by {} coversheets\n".\
+                             format(outfile, outfiles[outfile]))
+    sys.stdout.flush()
 
 
 #----gui.py-------------------------------------------------------------------
@@ -253,6 +695,7 @@ class FileDropProcessing(wx.FileDropTarget):
         wx.FileDropTarget.__init__(self)
         self.window = window
         self.args = args
+        self.checker = barcode_checker(args)
         self.num_samples = 0
         self.current_pos = 0
 
@@ -281,32 +724,60 @@ class FileDropProcessing(wx.FileDropTarget):
         self.current_pos = self.window.GetCaretPosition()
 
     def OnDropFiles(self, x, y, coversheets):
-        coversheet_data = []
-        num = 0
-        for coversheet in coversheets:
-            s2bdata = STAMPCoversheet(coversheet, debug=self.args.debug)
-            if s2bdata.fields:
-                coversheet_data.append(s2bdata)
-            else:
-                self.WriteFormattedText(normaltext="Not a recognized input file:  {}".\
-                    format(os.path.basename(coversheet)))
-                sys.stderr.write("  WARNING: Unrecognized format {}\n".format(coversheet))
-            num += 1
-            label = " {}".format(num) if len(coversheets)>1 else ''
-            self.WriteFormattedText("\nCoversheet{}: ".format(label), 
-                                    os.path.basename(coversheet))
-            sys.stdout.write("\nCoversheet {}\n".format(coversheet))
-            formatted_data = s2bdata.format_sample2barcode()
-            if not formatted_data:
+        # convert in a background thread so the window stays responsive
+        worker = threading.Thread(target=self.ConvertCoversheets,
+                                  args=(coversheets,))
+        worker.daemon = True
+        worker.start()
+        return True
+
+    def ConvertCoversheets(self, coversheets):
+        """Worker thread: coversheets are converted in worker processes
+        and the results shown by the GUI thread"""
+        starttime = time.time()
+        results = []
+        for result in iter_conversions(coversheets, debug=self.args.debug,
+                                       jobs=self.args.jobs, capture=True,
+                                       checker=self.checker):
+            results.append(result)
+            wx.CallAfter(self.ShowResult, result, len(results), 
+                         len(coversheets))
+        wx.CallAfter(self.ShowSummary, results, time.time()-starttime)
+
+    def ShowResult(self, result, num, total):
+        sys.stdout.write(result['log'])
+        sys.stdout.flush()
+        coversheet = os.path.basename(result['coversheet'])
+        if not result['recognized']:
+            self.WriteFormattedText(normaltext="Not a recognized input file:  {}".\
+                format(coversheet))
+        label = " {}".format(num) if total>1 else ''
+        self.WriteFormattedText("\nCoversheet{}: ".format(label), coversheet)
+        if result['error']:
+            self.WriteFormattedText(newline=False,
+                normaltext="ERROR: {}\n".format(result['error']))
+        elif not result['lines']:
+            self.WriteFormattedText(newline=False,
+                normaltext="No data in {}\n".format(coversheet))
+        else:
+            self.WriteFormattedText(normaltext="    "+"\n    ".join(result['lines']))
+            for msg in result['barcode_errors']:
+                self.WriteFormattedText("Barcode error: ", msg)
+            for msg in result['barcode_warnings']:
+                self.WriteFormattedText("Barcode warning: ", msg)
+            if not result['outfile']:
                 self.WriteFormattedText(newline=False,
-                    normaltext="No data in {}\n".format(os.path.basename(coversheet)))
-                sys.stdout.write("  WARNING: No data {}\n".format(s2bdata.coversheet))
+                    normaltext="Not writing file: barcode errors\n")
             else:
-                self.WriteFormattedText(normaltext="    "+"\n    ".join(formatted_data))
                 self.WriteFormattedText(newline=False,
-                    normaltext="Writing {}\n".format(s2bdata.outfile))
-                sys.stdout.write("  Writing {}\n".format(s2bdata.outfile))
-                s2bdata.write_sample2barcode_file()
+                    normaltext="Writing {}\n".format(result['outfile']))
+
+    def ShowSummary(self, results, seconds):
+        write_summary(results, seconds)
+        if len(results) > 1:
+            self.WriteFormattedText(newline=False, 
+                normaltext="\nConverted {} of {} coversheets\n".format(
+                len([ r for r in results if r['outfile'] ]), len(results)))
 
 def run_gui(args):
     app = Sample2Barcode_App(args)
@@ -320,27 +791,36 @@ if __name__=='__main__':
                         help="STAMP excel coversheets")
     parser.add_argument("-o", "--outdir", 
                         help="Directory to save output file(s)")
+    parser.add_argument("-j", "--jobs", type=int, default=1,
+                        help="Number of coversheets to convert in parallel "+\
+                             "(default: 1)")
+    parser.add_argument("--whitelist",
+                        help="File of allowed barcodes, one per line")
+    parser.add_argument("--warn-barcodes", default=False, 
+                        action='store_true', help="Write sample2barcode "+\
+                        "file even if barcodes are repeated, the water "+\
+                        "barcode or not in whitelist")
     parser.add_argument("--debug", default=False, action='store_true',
                         help="Write debugging messages")
 
+    multiprocessing.freeze_support() # for pyinstaller executables
     args = parser.parse_args()
+    if args.whitelist and not os.path.isfile(args.whitelist):
+        sys.exit("Whitelist file {} not found".format(args.whitelist))
     if not args.coversheets:
         run_gui(args)
     else:
-        for coversheet in args.coversheets:
-            sys.stdout.write("\nCoversheet {}\n".format(coversheet))
-            s2bdata = STAMPCoversheet(coversheet, outdir=args.outdir,
-                                      debug=args.debug)
-            if not s2bdata.fields:
-                sys.stderr.write("  WARNING: Unrecognized format {}\n".\
-                format(coversheet))
-            else:
-                formatted_data = s2bdata.format_sample2barcode()
-                if not formatted_data:
-                    sys.stdout.write("  WARNING: No data {}\n".format(coversheet))
-                else:
-                    sys.stdout.write("  Writing {}\n".format(s2bdata.outfile))
-                    s2bdata.write_sample2barcode_file()
+        starttime = time.time()
+        results = []
+        for result in iter_conversions(args.coversheets, args.outdir, 
+                                       args.debug, args.jobs, 
+                                       checker=barcode_checker(args)):
+            sys.stdout.write(result['log'])
+            sys.stdout.flush()
+            results.append(result)
+        write_summary(results, time.time()-starttime)
+        if [ r for r in results if result_status(r) in FAILED_STATUSES ]:
+            sys.exit(1)
 
 
             
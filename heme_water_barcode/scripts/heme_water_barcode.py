@@ -6,7 +6,10 @@ Record barcode counts for water control in HEME runs.
 
 import os
 import sys
+import csv
 import datetime
+import hashlib
+import json
 import openpyxl
 import operator
 import re
@@ -17,6 +20,11 @@ import wx.lib.agw.flatnotebook as fnb
 import xlsxwriter
 from collections import defaultdict
 from argparse import ArgumentParser
+try: # optional, for parquet export
+    import pyarrow
+    import pyarrow.parquet
+except ImportError:
+    pyarrow = None
 
 VERSION="1.0"
 BUILD="180420"
@@ -44,6 +52,13 @@ REFS = {'SCHEMAFILE': PROJECT.lower()+'_barcode_schema.sql',
 
 #----fileops.py---------------------------------------------------------------
 
+def replace_file(src, dst):
+    """Rename src to dst, replacing dst.  os.rename does not replace an
+    existing file on Windows."""
+    if os.name=='nt' and os.path.exists(dst):
+        os.remove(dst)
+    os.rename(src, dst)
+
 def parse_barcode_file(infile, debug=False):
     data = {}
     with open(infile, 'r') as fh:
@@ -96,17 +111,188 @@ def analyze_barcode_data(bcdata):
 
 #----dbops.py-----------------------------------------------------------------
 
-def connect_db(dbfile):
-    sys.stderr.write("  Connecting to db {}\n".format(dbfile))
-    dbh = sqlite3.connect(dbfile)
+# DB connection settings.  WAL lets readers (spreadsheet generation) run
+# while another process writes.  WAL needs all processes on the same host;
+# if the file system does not support it sqlite keeps the old journal mode.
+DB_JOURNAL_MODE = 'WAL'
+DB_SYNCHRONOUS = 'NORMAL' # safe with WAL, avoids fsync on every commit
+DB_CACHE_SIZE = -8000 # negative value is size in KiB
+DB_BUSY_TIMEOUT = 30 # seconds to wait for a lock before raising an error
+DB_RETRIES = 5 # times to retry a commit if db is still locked
+DB_RETRY_WAIT = 2 # seconds, multiplied by attempt number
+DB_CONNECTIONS = {} # connections reused within process
+
+def connect_db(dbfile, readonly=False):
+    """Return connection to dbfile.  Connections are opened once per process
+    and reused.  A readonly connection is a separate connection that cannot
+    write, so reads do not hold up saving data."""
+    key = (os.path.realpath(dbfile), readonly)
+    if key in DB_CONNECTIONS:
+        return DB_CONNECTIONS[key]
+    sys.stderr.write("  Connecting to db {}{}\n".format(dbfile,
+                     ' (read only)' if readonly else ''))
+    dbh = sqlite3.connect(dbfile, timeout=DB_BUSY_TIMEOUT)
+    if readonly:
+        dbh.execute('PRAGMA query_only=ON')
+    else:
+        mode = dbh.execute('PRAGMA journal_mode={}'.format(
+                           DB_JOURNAL_MODE)).fetchone()[0]
+        if mode.upper()!=DB_JOURNAL_MODE:
+            sys.stderr.write("  WARNING: journal mode {} not ".format(
+                DB_JOURNAL_MODE)+"available. Using {}\n".format(mode))
+        dbh.execute('PRAGMA synchronous={}'.format(DB_SYNCHRONOUS))
+    dbh.execute('PRAGMA cache_size={}'.format(DB_CACHE_SIZE))
+    DB_CONNECTIONS[key] = dbh
     return dbh
 
+def readonly_db(dbh):
+    """Return readonly connection to same db file as dbh"""
+    dbfile = dbh.execute('PRAGMA database_list').fetchone()[2]
+    return connect_db(dbfile, readonly=True)
+
+def close_db(dbh):
+    """Close connection and remove from reused connections"""
+    for key, cached in DB_CONNECTIONS.items():
+        if cached is dbh:
+            del DB_CONNECTIONS[key]
+    dbh.close()
+
+def retry_if_locked(func, *args, **kwargs):
+    """Call func, retrying if db is still locked after the busy timeout"""
+    for attempt in range(1, DB_RETRIES+1):
+        try:
+            return func(*args, **kwargs)
+        except sqlite3.OperationalError, e:
+            if attempt==DB_RETRIES or not ('locked' in str(e) or \
+                                           'busy' in str(e)):
+                raise
+            sys.stderr.write("  DB busy ({}). Retry {} of {}\n".format(e,
+                             attempt, DB_RETRIES-1))
+            sys.stderr.flush()
+            time.sleep(DB_RETRY_WAIT*attempt)
+
+def commit_db(dbh):
+    retry_if_locked(dbh.commit)
+
 def add_schema(dbh, schemafile):
     sys.stderr.write("  Reading schema {}\n".format(schemafile))
     with open(schemafile, 'r') as fh:
         schema = ' '.join(fh.readlines())
         dbh.executescript(schema)
 
+# Tables written by export_tables.  Each has a change_seq column (see
+# change_seq_sql) so exports can pick up only the rows changed since.
+EXPORT_TABLES = ['run', 'barcode', 'barcode_counts']
+
+CHANGE_SEQ_TRIGGER = """
+    CREATE TRIGGER IF NOT EXISTS {table}_{name}_change_seq
+        AFTER {event} ON {table}{when}
+    BEGIN
+        UPDATE change_counter SET seq=seq+1;
+        UPDATE {table} SET change_seq=(SELECT seq FROM change_counter)
+            WHERE rowid=NEW.rowid;
+    END;"""
+
+def change_seq_sql(tables):
+    """SQL adding a change_seq column to tables, set from a db-wide counter
+    by triggers when a row is inserted or updated.  sqlite lets only one
+    transaction write at a time, so change_seq increases in commit order,
+    unlike last_modified, which is set before the commit."""
+    sql = ["CREATE TABLE IF NOT EXISTS change_counter (seq INTEGER);",
+           "INSERT INTO change_counter (seq) SELECT 0 WHERE NOT EXISTS "+\
+           "(SELECT 1 FROM change_counter);"]
+    for table in tables:
+        sql.append("ALTER TABLE {} ADD COLUMN change_seq INTEGER DEFAULT 0;"\
+                   .format(table))
+        sql.append("CREATE INDEX IF NOT EXISTS {0}_change_seq_index ON {0}"\
+                   " (change_seq);".format(table))
+        sql.append(CHANGE_SEQ_TRIGGER.format(table=table, name='insert',
+                                             event='INSERT', when=''))
+        # the trigger's own update sets change_seq, so it does not fire again
+        sql.append(CHANGE_SEQ_TRIGGER.format(table=table, name='update',
+                   event='UPDATE',
+                   when=' WHEN NEW.change_seq IS OLD.change_seq'))
+    return "\n".join(sql)
+
+# Schema changes applied to existing dbs in order.  The db version is kept
+# in PRAGMA user_version; the schema file is version 0.
+DB_MIGRATIONS = [
+    (1, "covering index for barcode count queries", """
+    CREATE INDEX IF NOT EXISTS barcode_counts_run_index
+        ON barcode_counts (run_id, barcode_id, bc_count);
+    ANALYZE;
+    """),
+    (2, "change sequence for incremental exports", 
+     change_seq_sql(EXPORT_TABLES)),
+]
+
+# Hot queries, run through the functions that make them, with the 
+# index(es) each may use.  Checked by the check command against EXPLAIN 
+# QUERY PLAN so a query or schema change that stops using an index is 
+# noticed.
+QUERY_PLAN_CHECKS = [
+    ("get_run", lambda cursor: get_run(cursor, 'HEME0001'), 'run_index'),
+    ("get_barcode_counts_for_run_id", 
+     lambda cursor: get_barcode_counts_for_run_id(cursor, 1),
+     'barcode_counts_run_index'),
+]
+
+def get_db_version(dbh):
+    return dbh.execute('PRAGMA user_version').fetchone()[0]
+
+def migrate_db(dbh, migrations=DB_MIGRATIONS):
+    """Apply migrations newer than the db version.  Each migration and its
+    version number are saved in one transaction.  Returns db version."""
+    version = get_db_version(dbh)
+    for num, descr, sql in migrations:
+        if num <= version:
+            continue
+        sys.stderr.write("  Updating db to version {}: {}\n".format(num, 
+                         descr))
+        script = "BEGIN;\n{}\nPRAGMA user_version={};\nCOMMIT;".format(sql,
+                 num)
+        try:
+            retry_if_locked(dbh.executescript, script)
+        except sqlite3.Error:
+            try:
+                dbh.execute('ROLLBACK')
+            except sqlite3.Error:
+                pass
+            raise
+        version = num
+    return version
+
+class PlanCursor:
+    """Cursor that saves the EXPLAIN QUERY PLAN of each query it runs"""
+    def __init__(self, cursor):
+        self.cursor = cursor
+        self.plans = []
+
+    def execute(self, cmd, args=[]):
+        self.plans.extend([ row[-1] for row in self.cursor.connection.\
+                            execute('EXPLAIN QUERY PLAN '+cmd, args) ])
+        return self.cursor.execute(cmd, args)
+
+    def __iter__(self):
+        return iter(self.cursor)
+
+    def __getattr__(self, name):
+        return getattr(self.cursor, name)
+
+def check_query_plans(dbh, checks=QUERY_PLAN_CHECKS):
+    """Check hot queries use one of their expected indexes.  Returns list 
+    of (query name, query plan) for queries that do not."""
+    problems = []
+    for name, func, indexes in checks:
+        if isinstance(indexes, str):
+            indexes = (indexes,)
+        cursor = PlanCursor(dbh.cursor())
+        func(cursor)
+        plan = cursor.plans
+        if not [ d for d in plan for i in indexes if i+' ' in d+' ' ]:
+            problems.append((name, '; '.join(plan)))
+    return problems
+
 def current_time():
     return datetime.datetime.now()
 
@@ -175,9 +361,9 @@ def get_barcode_id(cursor, barcode):
     return ans[0] if ans else None
 
 def save_barcode(cursor, barcode):
-    fields = ['barcode',]
+    fields = ['barcode', 'last_modified']
     cursor.execute("INSERT OR IGNORE INTO barcode ({})".format(", ".join(fields))+\
-        " VALUES (?)", [barcode,])
+        " VALUES (?,?)", [barcode, current_time()])
 
 def get_barcode_counts_for_run_id(cursor, run_id):
     cmd = "SELECT b.barcode, bc.bc_count FROM barcode_counts bc, barcode b" +\
@@ -226,6 +412,7 @@ def check_db(datadir, docsdir):
         runs = get_runs(cursor, status='PASS')
         numruns = len(runs)
         msgs.append("    {} runs saved".format(numruns))
+    migrate_db(dbh)
     sys.stderr.flush()
     return (dbh, msgs)
 
@@ -248,7 +435,91 @@ def save_rundata_db(dbh, rundata, status='PASS'):
         numruns_saved += 1
         for barcode, d in sorted(rundata[run_name]['bc_counts'].items()):
             save_barcode_count(cursor, run_name, barcode, d['count'])
-    dbh.commit()
+    commit_db(dbh)
+
+#----export.py----------------------------------------------------------------
+
+EXPORT_STATE_FILE = 'export_state.json'
+
+def export_state(outdir):
+    """Return dict of export state, keyed by table, of dicts with the 
+    latest change_seq exported"""
+    statefile = os.path.join(outdir, EXPORT_STATE_FILE)
+    if not os.path.isfile(statefile):
+        return {}
+    with open(statefile, 'r') as fh:
+        return json.load(fh)
+
+def save_export_state(outdir, state):
+    statefile = os.path.join(outdir, EXPORT_STATE_FILE)
+    with open(statefile+'.tmp', 'w') as ofh:
+        json.dump(state, ofh, indent=2, sort_keys=True)
+    replace_file(statefile+'.tmp', statefile)
+
+def write_export_file(outfile, columns, rows, outformat):
+    """Write rows as a parquet file or, if outformat is csv, a csv file"""
+    if outformat=='parquet':
+        coldata = [ [ row[i] for row in rows ] for i in range(len(columns)) ]
+        table = pyarrow.Table.from_arrays(
+                    [ pyarrow.array(c) for c in coldata ], columns)
+        pyarrow.parquet.write_table(table, outfile)
+    else:
+        with open(outfile, 'wb') as ofh:
+            writer = csv.writer(ofh)
+            writer.writerow(columns)
+            for row in rows:
+                writer.writerow([ v.encode('utf-8') if isinstance(v, unicode) \
+                                  else v for v in row ])
+
+def export_tables(dbh, tables, outdir, outformat=None, full=False):
+    """Export db tables to outdir as columnar files, one folder per table
+    and one file per export: outdir/<table>/<table>-<datetime>.<format>
+
+    Only rows with change_seq later than the last export (saved in
+    outdir/EXPORT_STATE_FILE) are written unless full is True.  Rows that
+    are updated get a new change_seq and are exported again, so readers
+    should keep the row with the highest change_seq per key.  Deleted rows
+    are not tracked.
+
+    outformat is parquet (needs pyarrow) or csv.  Default is parquet if 
+    pyarrow is installed.  Returns dict of num rows written by table."""
+    if not outformat:
+        outformat = 'parquet' if pyarrow else 'csv'
+    elif outformat=='parquet' and not pyarrow:
+        sys.stderr.write("  WARNING: pyarrow not installed. Writing csv\n")
+        outformat = 'csv'
+    if not os.path.isdir(outdir):
+        os.makedirs(outdir)
+    state = {} if full else export_state(outdir)
+    stamp = datetime.datetime.now().strftime("%Y%m%d-%H%M%S")
+    cursor = dbh.cursor()
+    numrows = {}
+    for table in tables:
+        cmd = "SELECT * FROM {}".format(table)
+        args = []
+        # state saved before change_seq has last_modified values; those
+        # tables are exported in full once
+        if isinstance(state.get(table), dict):
+            cmd += " WHERE change_seq>?"
+            args.append(state[table]['change_seq'])
+        cursor.execute(cmd+" ORDER BY change_seq", args)
+        columns = [ d[0] for d in cursor.description ]
+        rows = cursor.fetchall()
+        numrows[table] = len(rows)
+        sys.stderr.write("  {}: {} rows\n".format(table, len(rows)))
+        if not rows:
+            continue
+        tabledir = os.path.join(outdir, table)
+        if not os.path.isdir(tabledir):
+            os.makedirs(tabledir)
+        outfile = os.path.join(tabledir, "{}-{}.{}".format(table, stamp,
+                               outformat))
+        write_export_file(outfile, columns, rows, outformat)
+        i_seq = columns.index('change_seq')
+        state[table] = {'change_seq': max([ r[i_seq] for r in rows ])}
+    save_export_state(outdir, state)
+    sys.stderr.flush()
+    return numrows
 
 #----spreadsheet.py-----------------------------------------------------------
 
@@ -352,15 +623,58 @@ def add_barcode_sheet_excel(workbook, wbformat, rundata):
     for i in [0, ]:
         worksheet.set_row(i, None, None, {'hidden': True})
 
-def create_excel_spreadsheet(rundata, outfile):
+def sheet_content_hash(rundata):
+    """Hash of everything written to the barcode sheet, ignoring db ids 
+    and timestamps"""
+    content = [VERSION, len(rundata)]
+    for run in sorted(rundata):
+        if rundata[run]['run_status']!='PASS':
+            continue
+        counts = [ rundata[run]['bc_counts'][barcode]['count'] 
+                   for barcode in sorted(BARCODES) ]
+        content.append([run, rundata[run]['total_reads'], counts])
+    return hashlib.md5(json.dumps(content)).hexdigest()
+
+def sheet_state_file(outfile):
+    return os.path.splitext(outfile)[0]+'.sheets.json'
+
+def read_sheet_state(outfile):
+    """Return the content hash saved with the spreadsheet"""
+    statefile = sheet_state_file(outfile)
+    if not os.path.isfile(outfile) or not os.path.isfile(statefile):
+        return {}
+    try:
+        with open(statefile, 'r') as fh:
+            return json.load(fh)
+    except ValueError:
+        return {}
+
+def save_sheet_state(outfile, state):
+    statefile = sheet_state_file(outfile)
+    with open(statefile+'.tmp', 'w') as fh:
+        json.dump(state, fh, indent=1, sort_keys=True)
+    replace_file(statefile+'.tmp', statefile)
+
+def create_excel_spreadsheet(rundata, outfile, force=False):
+    """Write the barcode spreadsheet unless its content is unchanged since
+    the last build.  Returns seconds spent, or None if skipped."""
+    contenthash = sheet_content_hash(rundata)
+    if not force and read_sheet_state(outfile).get('hash')==contenthash:
+        sys.stderr.write("\nBarcode Excel file content unchanged:\n{}\n".\
+                         format(outfile))
+        return None
+    starttime = time.time()
     sys.stderr.write("\nCreating barcode Excel file:\n{}\n".format(outfile))
     workbook = xlsxwriter.Workbook(outfile)
     wbformat = add_formats_to_workbook(workbook)
-    nums = add_barcode_sheet_excel(workbook, wbformat, rundata)
+    add_barcode_sheet_excel(workbook, wbformat, rundata)
     workbook.close()
     wb = openpyxl.load_workbook(outfile)
     wb.save(outfile)
-    return nums
+    save_sheet_state(outfile, { 'hash': contenthash })
+    seconds = time.time() - starttime
+    sys.stderr.write("  barcode sheet: {:.2f}s\n".format(seconds))
+    return seconds
 
 #----gui.py-------------------------------------------------------------------
 
@@ -437,16 +751,25 @@ class MainFrame(wx.Frame):
                 else:
                     self.text.AppendText(
                         "    {}: {} not saved to db.\n".format(filenum, run))
-            allrundata = get_rundata_from_db(dbh)
+            # read from a readonly connection so saving data is not held up
+            allrundata = get_rundata_from_db(readonly_db(self.dbh))
             numruns = len(allrundata)
             msg = "    {} runs saved".format(numruns)
             self.notebook.tabOne.ChangeMessage(msg)
             if numruns:
                 try:
                     self.text.AppendText("  Updating spreadsheet.\n")
-                    create_excel_spreadsheet(allrundata, self.spreadsheet)
+                    seconds = create_excel_spreadsheet(allrundata, 
+                                                       self.spreadsheet)
                     self.text.AppendText(
                         "      Spreadsheet now contains {} runs\n".format(numruns))
+                    if seconds is None:
+                        self.text.AppendText(
+                            "      Spreadsheet unchanged, not rebuilt\n")
+                    else:
+                        self.text.AppendText(
+                            "      Rebuilt spreadsheet in {:.1f}s\n".format(
+                            seconds))
                 except Exception, e:
                     self.text.AppendText("    ERROR: {}{}\n\n".format(
                                          type(e).__name__, e))
@@ -613,7 +936,61 @@ def run_gui(dbh, msgs, spreadsheet):
 
 #-----------------------------------------------------------------------------
 
+def run_export_command(argv):
+    """heme_water_barcode.py export: write db tables as parquet or csv"""
+    descr = "Export water barcode db tables as parquet (or csv) files."
+    descr += "  Only rows modified since the last export are written unless"
+    descr += " --full."
+    parser = ArgumentParser(prog=os.path.basename(sys.argv[0])+' export',
+                            description=descr)
+    parser.add_argument("-o", "--outdir", 
+                        default=os.path.join(DEFAULT_DATA_DIR, 'export'),
+                        help="Directory to save files")
+    parser.add_argument("-f", "--format", dest='outformat', 
+                        choices=['parquet', 'csv'], help="Output format "+\
+                        "(default: parquet if pyarrow installed, else csv)")
+    parser.add_argument("--full", default=False, action='store_true',
+                        help="Export all rows, not only new rows")
+    parser.add_argument("--datadir", default=DEFAULT_DATA_DIR,
+                        help="Directory to find database")
+    parser.add_argument("--docsdir", default=DEFAULT_DOCS_DIR,
+                        help="Directory to find db schema")
+    args = parser.parse_args(argv)
+    dbh, msgs = check_db(args.datadir, args.docsdir)
+    sys.stderr.write("\nExporting db to {}\n".format(args.outdir))
+    export_tables(readonly_db(dbh), EXPORT_TABLES, args.outdir, 
+                  args.outformat, args.full)
+    close_db(readonly_db(dbh))
+    close_db(dbh)
+
+def run_check_command(argv):
+    """heme_water_barcode.py check: check hot queries use their indexes"""
+    descr = "Check that the main water barcode db queries use their indexes."
+    parser = ArgumentParser(prog=os.path.basename(sys.argv[0])+' check',
+                            description=descr)
+    parser.add_argument("--datadir", default=DEFAULT_DATA_DIR,
+                        help="Directory to find database")
+    parser.add_argument("--docsdir", default=DEFAULT_DOCS_DIR,
+                        help="Directory to find db schema")
+    args = parser.parse_args(argv)
+    dbh, msgs = check_db(args.datadir, args.docsdir)
+    problems = check_query_plans(readonly_db(dbh))
+    for name, plan in problems:
+        sys.stderr.write("  {} query not using index: {}\n".format(name, 
+                         plan))
+    sys.stderr.write("{} of {} queries use their indexes\n".format(
+                     len(QUERY_PLAN_CHECKS)-len(problems), 
+                     len(QUERY_PLAN_CHECKS)))
+    close_db(readonly_db(dbh))
+    close_db(dbh)
+    return 1 if problems else 0
+
 if __name__=='__main__':
+    if len(sys.argv) > 1 and sys.argv[1]=='export':
+        run_export_command(sys.argv[2:])
+        sys.exit()
+    elif len(sys.argv) > 1 and sys.argv[1]=='check':
+        sys.exit(run_check_command(sys.argv[2:]))
     descr = "Saves barcode counts for {} water barcode: {}.".format(
             PROJECT, ', '.join(BARCODES.keys()))
     parser = ArgumentParser(description=descr)
@@ -661,9 +1038,10 @@ if __name__=='__main__':
         if args.save:
             save_rundata_db(dbh, rundata, status=args.status)
         if args.excel:
-            allrundata = get_rundata_from_db(dbh)
+            allrundata = get_rundata_from_db(readonly_db(dbh))
             allrundata.update(rundata)
             create_excel_spreadsheet(allrundata, spreadsheet)
-    dbh.close()
+            close_db(readonly_db(dbh))
+    close_db(dbh)
 
 